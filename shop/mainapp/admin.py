@@ -1,20 +1,99 @@
 from django.contrib import admin
+from django.db.models import Q
 
 from .models import *
 
 
 admin.site.register(Category)
-admin.site.register(CartProduct)
-admin.site.register(Cart)
-admin.site.register(Customer)
-admin.site.register(Product)
+
+
+@admin.register(Product)
+class ProductAdmin(admin.ModelAdmin):
+    list_display = ("title", "category", "price", "stock")
+    list_select_related = ("category",)
+    list_filter = ("category",)
+    search_fields = ("title", "slug")    # нужен для autocomplete_fields в других админках
+
+
+@admin.register(Customer)
+class CustomerAdmin(admin.ModelAdmin):
+    list_display = ("id", "__str__", "phone")
+    list_select_related = ("user",)    # __str__ покупателя обращается к user
+    raw_id_fields = ("user", "orders")    # вместо списков из всех пользователей и всех заказов
+    search_fields = ("user__username", "user__last_name", "phone")
+
+
+@admin.register(Cart)
+class CartAdmin(admin.ModelAdmin):
+    list_display = ("id", "owner", "total_product", "final_price", "in_order", "for_anonymous_user", "updated_at")
+    list_select_related = ("owner__user",)
+    list_filter = ("in_order", "for_anonymous_user")
+    raw_id_fields = ("owner", "products")
+    show_full_result_count = False    # без лишнего COUNT(*) по всей таблице при фильтрах
+
+
+@admin.register(CartProduct)
+class CartProductAdmin(admin.ModelAdmin):
+    list_display = ("id", "product", "cart", "qty", "final_price")
+    list_select_related = ("product", "cart")
+    raw_id_fields = ("user", "cart")
+    autocomplete_fields = ("product",)
+    show_full_result_count = False
+
+
+class OrderItemInline(admin.TabularInline):    # позиции заказа только для просмотра - это копия на момент оформления
+    model = OrderItem
+    fields = ("product", "title", "price", "qty", "final_price")
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("product")
+
+
+def status_transition(status, from_statuses):
+    """
+    Действие админки: перевести выбранные заказы в status одним UPDATE (без загрузки заказов).
+    Меняются только заказы в одном из from_statuses, остальные пропускаются
+    """
+    def action(modeladmin, request, queryset):
+        updated = queryset.filter(status__in=from_statuses).update(status=status)
+        modeladmin.message_user(request, f"Статус изменен у заказов: {updated}")
+    action.__name__ = f"mark_{status}"
+    action.short_description = f"Статус: {dict(Order.STATUS_CHOICES)[status]}"
+    return action
 
 
 # admin.site.register(Order)    # регистрация модели так или как ниже
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
+    inlines = (OrderItemInline,)
     fields = (
         "customer", "first_name", "last_name",
         "phone", "cart", "address", "status",
         "buying_type", "comment", "order_date"
     )
+    list_display = ("id", "customer", "status", "buying_type", "order_date", "total_products", "final_price")
+    list_select_related = ("customer__user",)    # покупатель и его пользователь - в том же запросе, что и заказы
+    list_filter = ("status", "buying_type", "order_date")    # у каждого поля свой индекс
+    search_fields = ("phone",)
+    autocomplete_fields = ("customer",)
+    raw_id_fields = ("cart",)    # корзин столько же, сколько заказов - только ввод id
+    ordering = ("-id",)
+    show_full_result_count = False
+    actions = (
+        status_transition(Order.STATUS_IN_PROGRESS, (Order.STATUS_NEW,)),
+        status_transition(Order.STATUS_READY, (Order.STATUS_NEW, Order.STATUS_IN_PROGRESS)),
+        status_transition(Order.STATUS_COMPLETED, (Order.STATUS_READY,)),
+    )
+
+    def get_search_results(self, request, queryset, search_term):
+        # поиск по индексам: номер заказа или телефон целиком (icontains читал бы всю таблицу)
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        condition = Q(phone=search_term)
+        if search_term.isdigit() and len(search_term) < 19:    # в пределах bigint
+            condition |= Q(id=int(search_term))
+        return queryset.filter(condition), False
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class MainappConfig(AppConfig):
     name = 'mainapp'
+
+    def ready(self):
+        from . import signals    # подключение обработчиков сигналов
+        from . import db    # настройка соединений с бд (PRAGMA SQLite, проверка постоянных соединений)
@@ -0,0 +1,40 @@
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from .db import close_unusable_connections
+from .metrics import current_collector
+
+
+def _collected(func, *args, **kwargs):    # запросы func попадают в метрики текущего запроса
+    collector = current_collector.get()
+    with collector.collect() if collector is not None else nullcontext():
+        return func(*args, **kwargs)
+
+
+def _in_own_connection(func, *args, **kwargs):
+    # поток пула живет дольше запроса - соединение с бд проверяется перед каждой выборкой,
+    # как в начале обычного запроса (CONN_MAX_AGE, сломанные соединения), и остается
+    # открытым для следующих выборок этого потока
+    close_old_connections()
+    close_unusable_connections()
+    return _collected(func, *args, **kwargs)
+
+
+async def run_query(func, *args, **kwargs):
+    """
+    Независимая выборка из бд в отдельном потоке со своим соединением.
+    Несколько run_query в asyncio.gather выполняются одновременно.
+    func должна вернуть уже вычисленные данные (список, а не ленивый queryset)
+    """
+    return await sync_to_async(_in_own_connection, thread_sensitive=False)(func, *args, **kwargs)
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Код, который обращается к состоянию запроса (сессия, пользователь) или рендерит шаблон, -
+    в общем синхронном потоке, как и остальной синхронный код запроса
+    """
+    return await sync_to_async(_collected, thread_sensitive=True)(func, *args, **kwargs)
+
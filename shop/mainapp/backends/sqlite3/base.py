@@ -0,0 +1,19 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite с выбором режима начала транзакции (OPTIONS["transaction_mode"] - как в новых версиях Django).
+    По умолчанию транзакция DEFERRED: блокировка на запись берется только на первом INSERT/UPDATE,
+    и если другое соединение уже пишет, SQLite сразу отвечает "database is locked", не дожидаясь busy_timeout.
+    IMMEDIATE берет блокировку в начале transaction.atomic - конкурирующие записи ждут друг друга
+    """
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        kwargs.pop("transaction_mode", None)    # не параметр sqlite3.connect
+        return kwargs
+
+    def _start_transaction_under_autocommit(self):
+        transaction_mode = self.settings_dict["OPTIONS"].get("transaction_mode")
+        self.cursor().execute(f"BEGIN {transaction_mode}" if transaction_mode else "BEGIN")
@@ -0,0 +1,47 @@
+import time
+
+from django.core.cache import cache
+
+
+# Версионированный кеш: ключ данных содержит номер версии, поэтому для инвалидации
+# достаточно увеличить версию - старые записи просто перестают читаться и вытесняются сами
+
+
+def get_cache_version(name):
+    key = f"version:{name}"
+    version = cache.get(key)
+    if version is None:
+        # начальная версия - текущее время, чтобы после вытеснения счетчика из кеша
+        # не вернуться к номеру, под которым уже лежат устаревшие данные
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(name):
+    key = f"version:{name}"
+    try:
+        return cache.incr(key)
+    except ValueError:    # счетчика нет в кеше
+        return get_cache_version(name)
+
+
+def versioned_key(name, *parts):    # ключ данных для текущей версии
+    return ":".join([name, str(get_cache_version(name)), *map(str, parts)])
+
+
+CATALOG_CACHE = "catalog"    # версия каталога (товары, категории, характеристики) - ETag и кеш страниц каталога
+CATALOG_MODIFIED_KEY = "catalog:modified"    # время последнего изменения каталога (Last-Modified)
+
+
+def bump_catalog_version():
+    bump_cache_version(CATALOG_CACHE)
+    cache.set(CATALOG_MODIFIED_KEY, int(time.time()), None)
+
+
+def get_catalog_modified():
+    modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified is None:    # изменений еще не было (или счетчик вытеснен) - считаем, что каталог изменился сейчас
+        cache.add(CATALOG_MODIFIED_KEY, int(time.time()), None)
+        modified = cache.get(CATALOG_MODIFIED_KEY)
+    return modified
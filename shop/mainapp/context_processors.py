@@ -0,0 +1,21 @@
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from .cache import versioned_key
+from .models import Category
+
+
+CATEGORY_NAV_CACHE = "category_nav"
+
+
+def get_category_nav():    # список категорий для меню (из кеша, один запрос в бд после каждого изменения категорий)
+    key = versioned_key(CATEGORY_NAV_CACHE)
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(Category.objects.only("name", "slug").order_by("id"))
+        cache.set(key, categories, None)
+    return categories
+
+
+def categories(request):    # категории доступны во всех шаблонах (загружаются только если шаблон к ним обращается)
+    return {"categories": SimpleLazyObject(get_category_nav)}
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):    # настройки SQLite, которые действуют на соединение - при каждом открытии
+    if connection.vendor != "sqlite":
+        return
+    for name, value in settings.SQLITE_PRAGMAS.items():    # напрямую через sqlite3 - это не запросы приложения (метрики, логи)
+        connection.connection.execute(f"PRAGMA {name} = {value}")
+
+
+def set_sqlite_journal_mode(connection, mode=None):    # режим журнала записывается в файл бд; возвращает установленный режим
+    connection.ensure_connection()
+    return connection.connection.execute(f"PRAGMA journal_mode = {mode or settings.SQLITE_JOURNAL_MODE}").fetchone()[0]
+
+
+def close_unusable_connections():
+    """
+    Проверка постоянных соединений (CONN_MAX_AGE) перед повторным использованием - аналог
+    CONN_HEALTH_CHECKS из Django 4.1: соединение, которое закрыл сервер бд (перезапуск, таймаут),
+    закрывается здесь, и запрос открывает новое вместо ошибки
+    """
+    for connection in connections.all():
+        if connection.settings_dict.get("CONN_HEALTH_CHECKS") and connection.connection is not None \
+                and not connection.in_atomic_block and not connection.is_usable():
+            connection.close()
+
+
+@receiver(request_started)
+def check_connections(sender, **kwargs):    # после close_old_connections Django (тот подключен раньше)
+    close_unusable_connections()
@@ -0,0 +1,103 @@
+import csv
+import json
+
+from specs.models import CategoryFeature, ProductFeatures
+
+from .models import Product, Order, OrderItem
+
+
+EXPORT_CHUNK_SIZE = 1000    # строк за один запрос к бд
+EXPORT_FORMATS = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson; charset=utf-8"}
+
+PRODUCT_COLUMNS = ["id", "slug", "title", "category", "price", "description"]
+ORDER_COLUMNS = [
+    "id", "created_date", "status", "buying_type", "first_name", "last_name", "phone", "address",
+    "order_date", "comment", "total_products", "final_price",
+]
+ORDER_ITEM_COLUMNS = ["product", "product_title", "price", "qty", "final_price"]
+
+
+def iter_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Строки queryset пачками по возрастанию id (курсор по id, а не OFFSET).
+    Каждая пачка - отдельный короткий запрос, поэтому между пачками можно делать
+    свои запросы (характеристики, позиции заказа), а память не зависит от размера таблицы
+    """
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id).order_by("id")[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1]["id"]
+
+
+def iter_products(chunk_size=EXPORT_CHUNK_SIZE):    # товары с категорией и значениями характеристик {имя: значение}
+    queryset = Product.objects.values("id", "slug", "title", "category__slug", "price", "description")
+    for chunk in iter_chunks(queryset, chunk_size):
+        features = {}
+        for product_id, name, value in ProductFeatures.objects.filter(
+            product_id__in=[row["id"] for row in chunk]
+        ).values_list("product_id", "feature__feature_name", "value"):
+            features.setdefault(product_id, {})[name] = value
+        for row in chunk:
+            row["category"] = row.pop("category__slug")
+            row["features"] = features.get(row["id"], {})
+            yield row
+
+
+def iter_orders(chunk_size=EXPORT_CHUNK_SIZE):    # заказы с позициями (копии товаров на момент оформления)
+    queryset = Order.objects.values(*ORDER_COLUMNS)
+    for chunk in iter_chunks(queryset, chunk_size):
+        items = {}
+        for row in OrderItem.objects.filter(order_id__in=[row["id"] for row in chunk]).order_by("id").values(
+            "order_id", "product__slug", "title", "price", "qty", "final_price"
+        ):
+            items.setdefault(row.pop("order_id"), []).append({
+                "product": row.pop("product__slug"), "product_title": row.pop("title"), **row,
+            })
+        for row in chunk:
+            row["items"] = items.get(row["id"], [])
+            yield row
+
+
+class Echo:    # "файл" для csv.writer: возвращает строку вместо записи
+    def write(self, value):
+        return value
+
+
+def render_jsonl(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False, default=str) + "\n"
+
+
+def render_products_csv(records):    # характеристики - отдельные колонки feature:<имя>, как в import_catalog
+    feature_names = sorted(set(CategoryFeature.objects.values_list("feature_name", flat=True)))
+    writer = csv.writer(Echo())
+    yield writer.writerow(PRODUCT_COLUMNS + [f"feature:{name}" for name in feature_names])
+    for record in records:
+        yield writer.writerow(
+            [record[column] for column in PRODUCT_COLUMNS] + [record["features"].get(name, "") for name in feature_names]
+        )
+
+
+def render_orders_csv(records):    # строка на каждую позицию заказа, поля заказа повторяются
+    writer = csv.writer(Echo())
+    yield writer.writerow(ORDER_COLUMNS + ORDER_ITEM_COLUMNS)
+    for record in records:
+        order = [record[column] for column in ORDER_COLUMNS]
+        for item in record["items"] or [dict.fromkeys(ORDER_ITEM_COLUMNS, "")]:
+            yield writer.writerow(order + [item[column] for column in ORDER_ITEM_COLUMNS])
+
+
+EXPORTS = {    # имя выгрузки -> (записи, рендер csv)
+    "products": (iter_products, render_products_csv),
+    "orders": (iter_orders, render_orders_csv),
+}
+
+
+def render_export(name, export_format, chunk_size=EXPORT_CHUNK_SIZE):    # генератор строк файла выгрузки
+    records, render_csv = EXPORTS[name]
+    if export_format == "csv":
+        return render_csv(records(chunk_size))
+    return render_jsonl(records(chunk_size))
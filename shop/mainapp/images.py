@@ -0,0 +1,88 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, features
+
+from .cache import bump_catalog_version
+from .models import Product
+
+
+logger = logging.getLogger(__name__)
+
+RENDITION_WIDTHS = (320, 640, 960)    # ширины уменьшенных копий изображения товара
+RENDITION_DIR = "renditions"    # подпапка рядом с оригиналами (mainapp/renditions/)
+WEBP_SUPPORTED = features.check("webp")    # Pillow может быть собран без поддержки WebP
+RENDITION_FORMATS = (("JPEG", "jpg"), ("WEBP", "webp")) if WEBP_SUPPORTED else (("JPEG", "jpg"),)
+MARK_BATCH_SIZE = 500    # имен изображений в одном UPDATE (ограничение SQLite на число параметров)
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="renditions")    # генерация не задерживает ответ на запрос
+
+
+def rendition_name(image_name, width, extension):    # mainapp/macbook.jpg -> mainapp/renditions/macbook_320.jpg
+    directory, filename = os.path.split(image_name)
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, RENDITION_DIR, f"{stem}_{width}.{extension}").replace(os.sep, "/")
+
+
+def has_renditions(image_name):    # копии создаются все сразу, поэтому достаточно проверить последнюю (обращение к хранилищу)
+    return default_storage.exists(rendition_name(image_name, RENDITION_WIDTHS[-1], RENDITION_FORMATS[-1][1]))
+
+
+def generate_renditions(image_name, force=False):
+    """
+    Создать уменьшенные копии изображения (все ширины, JPEG и WebP).
+    Копии не больше оригинала: для маленького изображения ширина копии остается исходной
+    """
+    if not force and has_renditions(image_name):
+        return False
+    try:
+        with default_storage.open(image_name) as file:
+            original = Image.open(file)
+            original.load()
+    except (OSError, ValueError):    # файла нет или это не изображение
+        logger.warning("Не удалось открыть изображение %s", image_name)
+        return False
+    if original.mode not in ("RGB", "L"):
+        original = original.convert("RGB")
+    for width in RENDITION_WIDTHS:
+        image = original.copy()
+        image.thumbnail((width, image.height))    # пропорциональное уменьшение по ширине
+        for image_format, extension in RENDITION_FORMATS:
+            buffer = BytesIO()
+            image.save(buffer, image_format, quality=82, optimize=True)
+            name = rendition_name(image_name, width, extension)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            default_storage.save(name, ContentFile(buffer.getvalue()))
+    return True
+
+
+def mark_renditions_ready(image_names):
+    """
+    Отметить товары с этими изображениями (Product.renditions_ready) - карточки выводят копии
+    по флагу и не проверяют файлы в хранилище. Возвращает количество отмеченных товаров
+    """
+    image_names = list(image_names)
+    marked = 0
+    for start in range(0, len(image_names), MARK_BATCH_SIZE):
+        marked += Product.objects.filter(
+            image__in=image_names[start:start + MARK_BATCH_SIZE], renditions_ready=False
+        ).update(renditions_ready=True)
+    return marked
+
+
+def schedule_renditions(image_name):    # создать копии в фоновом потоке после фиксации транзакции
+    if image_name:
+        transaction.on_commit(lambda: _executor.submit(_generate_and_invalidate, image_name))
+
+
+def _generate_and_invalidate(image_name):    # появились копии - в кешированных страницах каталога нужен srcset
+    close_old_connections()    # поток пула живет дольше запроса
+    if generate_renditions(image_name) or has_renditions(image_name):    # копии могли остаться от прежнего сохранения
+        mark_renditions_ready([image_name])
+        bump_catalog_version()
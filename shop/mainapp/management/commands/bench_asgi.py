@@ -0,0 +1,89 @@
+import asyncio
+import importlib
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+from django.urls import clear_url_caches
+
+from .bench_shop import bench_environment, seed_shop
+
+
+@contextmanager
+def catalog_views(use_async):    # переключить страницы каталога на async варианты (urls.py читает настройку при импорте)
+    try:
+        with override_settings(ASYNC_CATALOG_VIEWS=use_async):
+            reload_urlconf()
+            yield
+    finally:
+        reload_urlconf()    # маршруты по исходной настройке
+
+
+def reload_urlconf():
+    importlib.reload(importlib.import_module("mainapp.urls"))
+    importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+    clear_url_caches()
+
+
+class Command(BaseCommand):
+    help = (
+        "Пропускная способность страниц каталога при одновременных запросах: синхронные представления "
+        "через WSGI обработчик (поток на запрос) против async представлений через ASGI обработчик. "
+        "Запросы выполняются в процессе тестовыми клиентами, без сети - сравнивается только работа Django и бд"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=1000, help="Количество товаров в каталоге")
+        parser.add_argument("--requests", type=int, default=300, help="Запросов на каждый уровень параллельности")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50], help="Одновременных запросов")
+
+    def handle(self, *args, **options):
+        with bench_environment():
+            seed_shop(options["size"])
+            paths = ["/", "/category/category-0/", "/products/product-0/"]
+            self.stdout.write(f"{'параллельно':<14}{'WSGI зап/с':>12}{'p95 мс':>10}{'ASGI зап/с':>12}{'p95 мс':>10}")
+            for concurrency in options["concurrency"]:
+                urls = [paths[i % len(paths)] for i in range(options["requests"])]
+                with catalog_views(False):
+                    wsgi = self.run_wsgi(urls, concurrency)
+                with catalog_views(True):
+                    asgi = asyncio.run(self.run_asgi(urls, concurrency))
+                self.stdout.write(
+                    f"{concurrency:<14}{wsgi[0]:>12.0f}{wsgi[1]:>10.1f}{asgi[0]:>12.0f}{asgi[1]:>10.1f}"
+                )
+
+    def run_wsgi(self, urls, concurrency):
+        def get(url):
+            started = time.perf_counter()
+            response = Client().get(url)
+            return response.status_code, time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(get, urls))
+        return self.summary(results, time.perf_counter() - started)
+
+    async def run_asgi(self, urls, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get(url):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await AsyncClient().get(url)
+                return response.status_code, time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(get(url) for url in urls))
+        return self.summary(results, time.perf_counter() - started)
+
+    def summary(self, results, elapsed):    # (запросов в секунду, 95-й перцентиль времени ответа в мс)
+        errors = sorted({status for status, _ in results if status != 200})
+        if errors:
+            self.stderr.write(f"Ответы с ошибкой: {errors}")
+        latencies = [seconds for _, seconds in results]
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        return len(results) / elapsed, p95 * 1000
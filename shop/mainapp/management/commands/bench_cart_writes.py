@@ -0,0 +1,108 @@
+import logging
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.db import OperationalError, connection, connections
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from mainapp.db import set_sqlite_journal_mode
+from mainapp.models import Customer
+
+from .bench_shop import BENCH_PASSWORD, bench_environment, seed_shop
+
+
+# настройки SQLite до профилей бд: журнал DELETE, транзакции DEFERRED, ожидание блокировки - 5 с по умолчанию sqlite3
+SQLITE_DEFAULT_JOURNAL_MODE = "DELETE"
+SQLITE_DEFAULT_PRAGMAS = {"synchronous": "FULL", "busy_timeout": 5000, "mmap_size": 0}
+
+
+@contextmanager
+def sqlite_profile(pragmas, transaction_mode, journal_mode):    # на время блока бд и новые соединения SQLite - с этими настройками
+    options = connection.settings_dict["OPTIONS"]
+    old_transaction_mode = options.get("transaction_mode")
+    options["transaction_mode"] = transaction_mode    # словарь настроек общий для соединений всех потоков
+    connections.close_all()
+    set_sqlite_journal_mode(connection, journal_mode)    # режим журнала - в файле временной бд
+    try:
+        with override_settings(SQLITE_PRAGMAS=pragmas):
+            yield
+    finally:
+        set_sqlite_journal_mode(connection)
+        connections.close_all()
+        options["transaction_mode"] = old_transaction_mode
+
+
+class Command(BaseCommand):
+    help = (
+        "Одновременная запись в корзины: несколько потоков добавляют, меняют и удаляют товары "
+        "в своих корзинах. Показывает пропускную способность и ошибки \"database is locked\" "
+        "для текущего профиля бд (SHOP_DB_PROFILE), а для SQLite - и для настроек по умолчанию"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=200, help="Количество товаров в каталоге")
+        parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16], help="Одновременных покупателей")
+        parser.add_argument("--requests", type=int, default=60, help="Запросов на каждого покупателя")
+
+    def handle(self, *args, **options):
+        with bench_environment(database_file=True):
+            products = seed_shop(options["size"])
+            profiles = [("текущий", None)]
+            if connection.vendor == "sqlite":
+                profiles.insert(0, ("sqlite по умолчанию", (SQLITE_DEFAULT_PRAGMAS, None, SQLITE_DEFAULT_JOURNAL_MODE)))
+            self.stdout.write(f"{'профиль':<22}{'потоков':>8}{'зап/с':>10}{'p95 мс':>10}{'locked':>8}")
+            for name, sqlite_settings in profiles:
+                for threads in options["threads"]:
+                    with sqlite_profile(*sqlite_settings) if sqlite_settings else override_settings():
+                        rate, p95, locked = self.run(products, threads, options["requests"])
+                    self.stdout.write(f"{name:<22}{threads:>8}{rate:>10.0f}{p95:>10.1f}{locked:>8}")
+
+    def run(self, products, threads, requests):    # (запросов в секунду, 95-й перцентиль в мс, ошибок блокировки)
+        usernames = list(Customer.objects.order_by("id").values_list("user__username", flat=True))
+        clients = []
+        for i in range(threads):    # у каждого потока свой покупатель, а значит своя корзина
+            client = Client()
+            client.login(username=usernames[i % len(usernames)], password=BENCH_PASSWORD)
+            clients.append(client)
+
+        def buyer(i):
+            client = clients[i]
+            results = []
+            try:
+                for n in range(requests):
+                    product = products[(i * requests + n // 3) % len(products)]
+                    method, url, data = (
+                        ("get", f"/add-to-cart/{product.slug}/", None),
+                        ("post", f"/change-qty/{product.slug}/", {"qty": 2}),
+                        ("get", f"/remove-from-cart/{product.slug}/", None),
+                    )[n % 3]
+                    started = time.perf_counter()
+                    try:
+                        getattr(client, method)(url, data)
+                        locked = False
+                    except OperationalError as error:    # представление упало на блокировке бд
+                        if "locked" not in str(error):
+                            raise
+                        locked = True
+                    except ObjectDoesNotExist:    # товар не попал в корзину из-за предыдущей ошибки - запрос не считается
+                        continue
+                    results.append((locked, time.perf_counter() - started))
+            finally:
+                connection.close()    # соединение этого потока
+            return results
+
+        logging.disable(logging.CRITICAL)    # ошибки блокировки считаются в таблице, трассировки в логе не нужны
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                results = [row for rows in executor.map(buyer, range(threads)) for row in rows]
+        finally:
+            logging.disable(logging.NOTSET)
+        elapsed = time.perf_counter() - started
+        latencies = [seconds for _, seconds in results]
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        return len(results) / elapsed, p95 * 1000, sum(locked for locked, _ in results)
@@ -0,0 +1,109 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, models
+from django.test import Client
+
+from mainapp.models import Product, Customer, Cart, CartProduct, OrderItem
+
+from .bench_shop import bench_environment, seed_shop
+
+
+User = get_user_model()
+
+CHECKOUT_FORM = {
+    "first_name": "Имя", "last_name": "Фамилия", "phone": "1234567890", "address": "",
+    "buying_type": "self", "order_date": "2030-01-01", "comment": "",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Распродажа одного товара: покупатели из нескольких потоков одновременно оформляют заказы "
+        "с товаром, остатка которого хватает не всем. Проверяет, что продано ровно столько, сколько "
+        "списано со склада, и остаток не ушел в минус, и показывает количество оформлений в секунду"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stock", type=int, default=100, help="Остаток товара перед распродажей")
+        parser.add_argument("--buyers", type=int, default=150, help="Покупателей в каждом прогоне")
+        parser.add_argument("--qty", type=int, default=1, help="Сколько штук товара в корзине каждого покупателя")
+        parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16], help="Одновременных покупателей")
+
+    def handle(self, *args, **options):
+        with bench_environment(database_file=True):
+            products = seed_shop(20)
+            hot, other = products[0], products[1]    # other - товар без учета остатка, в каждой корзине
+            self.stdout.write(f"{'потоков':>8}{'заказ/с':>10}{'продано':>9}{'нет на складе':>15}{'locked':>8}{'остаток':>9}")
+            problems = []
+            for run, threads in enumerate(options["threads"]):
+                Product.objects.filter(id=hot.id).update(stock=options["stock"])
+                clients = self.prepare_buyers(run, options["buyers"], hot, other, options["qty"])
+                rate, results = self.run(clients, threads)
+                sold = OrderItem.objects.filter(
+                    product=hot, order__customer__user__username__startswith=f"checkout-{run}-"
+                ).aggregate(qty=models.Sum("qty"))["qty"] or 0
+                left = Product.objects.get(id=hot.id).stock
+                self.stdout.write(
+                    f"{threads:>8}{rate:>10.0f}{sold:>9}{results.count('out_of_stock'):>15}{results.count('locked'):>8}{left:>9}"
+                )
+                problems.extend(self.verify(threads, options, sold, left, results))
+        if problems:
+            raise CommandError("\n".join(problems))
+
+    def prepare_buyers(self, run, buyers, hot, other, qty):    # покупатели с корзиной: qty горячего товара и один other
+        clients = []
+        for i in range(buyers):
+            user = User.objects.create(username=f"checkout-{run}-{i}")
+            customer = Customer.objects.create(user=user, phone="1234567890")
+            cart = Cart.objects.create(owner=customer)
+            cart.products.add(
+                CartProduct.objects.create(user=customer, cart=cart, product=hot, qty=qty),
+                CartProduct.objects.create(user=customer, cart=cart, product=other),
+            )
+            client = Client()
+            client.force_login(user)    # без хеширования паролей - время прогона уходит только на оформление
+            clients.append(client)
+        return clients
+
+    def run(self, clients, threads):    # (оформлений в секунду, результат каждого оформления)
+        def buyer(i):
+            results = []
+            try:
+                for client in clients[i::threads]:
+                    try:
+                        response = client.post("/make-order/", CHECKOUT_FORM)
+                    except OperationalError as error:    # представление упало на блокировке бд
+                        if "locked" not in str(error):
+                            raise
+                        results.append("locked")
+                        continue
+                    # успех - на главную, нехватка товара - обратно в корзину
+                    results.append("ordered" if response["Location"] == "/" else "out_of_stock")
+            finally:
+                connection.close()    # соединение этого потока
+            return results
+
+        logging.disable(logging.CRITICAL)
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                results = [result for rows in executor.map(buyer, range(threads)) for result in rows]
+        finally:
+            logging.disable(logging.NOTSET)
+        elapsed = time.perf_counter() - started
+        return results.count("ordered") / elapsed, results
+
+    def verify(self, threads, options, sold, left, results):
+        problems = []
+        if left < 0 or sold + left != options["stock"]:
+            problems.append(f"{threads} потоков: продано {sold}, остаток {left}, было {options['stock']}")
+        if sold != results.count("ordered") * options["qty"]:
+            problems.append(f"{threads} потоков: продано {sold} шт. в {results.count('ordered')} заказах")
+        expected = min(options["buyers"] - results.count("locked"), options["stock"] // options["qty"])
+        if results.count("ordered") != expected:    # отказ при достаточном остатке - тоже ошибка
+            problems.append(f"{threads} потоков: оформлено {results.count('ordered')} заказов вместо {expected}")
+        return problems
@@ -0,0 +1,237 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+from io import BytesIO, StringIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+
+from mainapp.db import set_sqlite_journal_mode
+from mainapp.exports import EXPORT_CHUNK_SIZE
+from mainapp.models import Category, Product, Customer, Cart, CartProduct, Order
+from mainapp.utils import save_order_with_items
+from specs.models import CategoryFeature, ProductFeatures
+
+
+User = get_user_model()
+
+BENCH_PASSWORD = "bench-password"
+# без кеша страниц каталога: иначе анонимные запросы к каталогу отдаются из кеша и представления не выполняются
+BENCH_MIDDLEWARE = [name for name in settings.MIDDLEWARE if name != "mainapp.middleware.CatalogPageCacheMiddleware"]
+# запросы выгрузок растут на пачку строк, а не на строку: (строк в пачке, запросов на пачку - строки и их характеристики/позиции)
+CHUNKED_PAGES = {"export:products": (EXPORT_CHUNK_SIZE, 2), "export:orders": (EXPORT_CHUNK_SIZE, 2)}
+FEATURES = (("Память", ("4", "8", "16", "32")), ("Экран", ("IPS", "TN", "OLED")), ("Цвет", ("черный", "серый")))
+
+
+def seed_shop(size, categories_count=5):
+    """
+    Наполнить пустую бд: size товаров в categories_count категориях, по значению каждой
+    характеристики на товар, size // 10 покупателей с корзиной и оформленным заказом.
+    Все строки создаются через bulk_create, поэтому сигналы не срабатывают -
+    таблица FeatureValueCount пересчитывается командой
+    """
+    buffer = BytesIO()
+    Image.new("RGB", (800, 600), "gray").save(buffer, "JPEG")
+    image_name = default_storage.save("mainapp/bench.jpg", ContentFile(buffer.getvalue()))
+
+    Category.objects.bulk_create(
+        [Category(name=f"Категория {i}", slug=f"category-{i}") for i in range(categories_count)]
+    )
+    categories = list(Category.objects.order_by("id"))    # на SQLite bulk_create не возвращает id
+    CategoryFeature.objects.bulk_create([
+        CategoryFeature(category=category, feature_name=name, feature_filter_name=name)
+        for category in categories for name, values in FEATURES
+    ])
+    features = {(feature.category_id, feature.feature_name): feature for feature in CategoryFeature.objects.all()}
+
+    Product.objects.bulk_create([
+        Product(
+            category=categories[i % categories_count], title=f"Товар {i}", slug=f"product-{i}", image=image_name,
+            description=f"Описание товара {i} " * 20, price=Decimal(100 + i % 900)
+        )
+        for i in range(size)
+    ], batch_size=500)
+    products = list(Product.objects.order_by("id").only("id", "category_id", "price"))
+    ProductFeatures.objects.bulk_create([
+        ProductFeatures(
+            product_id=product.id, feature=features[(product.category_id, name)], value=values[product.id % len(values)]
+        )
+        for product in products for name, values in FEATURES
+    ], batch_size=500)
+    call_command("rebuild_facet_counts", stdout=StringIO())
+
+    for i in range(max(1, size // 10)):
+        user = User.objects.create_user(username=f"bench-{i}", password=BENCH_PASSWORD)
+        customer = Customer.objects.create(user=user, phone="1234567890")
+        cart = Cart.objects.create(owner=customer, in_order=True)
+        for product in products[i % len(products):][:3]:
+            cart_product = CartProduct.objects.create(user=customer, cart=cart, product=product)
+            cart.products.add(cart_product)
+        order = Order(customer=customer, first_name="Имя", last_name="Фамилия", phone="1234567890")
+        save_order_with_items(order, cart)
+        customer.orders.add(order)
+    return products
+
+
+@contextmanager
+def bench_environment(database_file=False):    # отдельная временная бд, отдельный кеш и папка media - рабочие данные не затрагиваются
+    media_root = tempfile.mkdtemp()
+    old_name = connection.settings_dict["NAME"]
+    old_test_name = connection.settings_dict["TEST"]["NAME"]
+    if database_file and connection.vendor == "sqlite":    # временная SQLite в памяти не блокирует файл, как рабочая - для тестов записи нужен файл
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(media_root, "bench.sqlite3")
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    if database_file and connection.vendor == "sqlite":
+        set_sqlite_journal_mode(connection)    # как при развертывании (команда sqlite_journal_mode)
+    try:
+        with override_settings(
+            MEDIA_ROOT=media_root, ALLOWED_HOSTS=["testserver"], MIDDLEWARE=BENCH_MIDDLEWARE,
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "bench"}},
+        ):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        connection.settings_dict["TEST"]["NAME"] = old_test_name
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный тест страниц магазина: наполняет временную бд каталогами разного размера "
+        "и для каждой страницы из mainapp/urls.py и specs/urls.py измеряет количество SQL запросов, "
+        "время ответа и пиковую память"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="Количество товаров в каталоге")
+        parser.add_argument("--repeat", type=int, default=5, help="Сколько раз измерять каждую страницу")
+        parser.add_argument(
+            "--check", action="store_true",
+            help="Режим регрессии: ошибка, если количество запросов страницы растет вместе с каталогом"
+        )
+
+    def handle(self, *args, **options):
+        with bench_environment():
+            results = {size: self.bench_size(size, options["repeat"]) for size in options["sizes"]}
+        self.report(results)
+        if options["check"]:
+            self.check_regressions(results)
+
+    def bench_size(self, size, repeat):
+        call_command("flush", interactive=False, verbosity=0)
+        products = seed_shop(size)
+        product, other = products[0], products[-1]
+        category = Category.objects.order_by("id").first()
+        feature = CategoryFeature.objects.filter(category=category).order_by("id").first()
+
+        client = Client()
+        client.login(username="bench-0", password=BENCH_PASSWORD)
+        anonymous = Client()
+        staff = Client()
+        staff.force_login(User.objects.create_user(username="bench-staff", is_staff=True))    # выгрузки - только для персонала
+
+        def add_other():    # товар, который удаляется или меняется, должен быть в корзине
+            client.get(f"/add-to-cart/{other.slug}/")
+
+        def post_json(url, data):
+            return client.post(url, json.dumps(data), content_type="application/json")
+
+        order_data = {
+            "first_name": "Имя", "last_name": "Фамилия", "phone": "1234567890", "address": "",
+            "buying_type": Order.BUYING_TYPE_SELF, "order_date": "2030-01-01", "comment": "",
+        }
+        cases = (    # (имя, клиент, метод или функция запроса, url, данные, подготовка перед каждым измерением)
+            ("base (anonymous)", anonymous, "get", "/", None, None),
+            ("base", client, "get", "/", None, None),
+            ("product_detail", client, "get", f"/products/{product.slug}/", None, None),
+            ("category_detail", client, "get", f"/category/{category.slug}/", None, None),
+            ("category_detail (filter)", client, "get", f"/category/{category.slug}/?f{feature.id}=8", None, None),
+            ("search", client, "get", "/search/?q=товар", None, None),
+            ("add_to_cart", client, "get", f"/add-to-cart/{product.slug}/", None, None),
+            ("cart", client, "get", "/cart/", None, None),
+            ("change_qty", client, "post", f"/change-qty/{other.slug}/", {"qty": 2}, add_other),
+            ("cart_api", client, "get", "/api/cart/", None, None),
+            ("cart_api (post)", client, post_json, "/api/cart/", {"items": [{"slug": other.slug, "qty": 3}]}, add_other),
+            ("delete_from_cart", client, "get", f"/remove-from-cart/{other.slug}/", None, add_other),
+            ("checkout", client, "get", "/checkout/", None, None),
+            ("make_order", client, "post", "/make-order/", order_data, add_other),
+            ("profile", client, "get", "/profile/", None, None),
+            ("login", anonymous, "get", "/login/", None, None),
+            ("registration", anonymous, "get", "/registration/", None, None),
+            ("specs:base-spec", client, "get", "/product-specs/", None, None),
+            ("specs:new_category", client, "get", "/product-specs/new-category/", None, None),
+            ("specs:new_feature", client, "get", "/product-specs/new-feature/", None, None),
+            ("metrics", anonymous, "get", "/metrics", None, None),
+            ("export:products", staff, "get", "/export/products/", None, None),
+            ("export:orders", staff, "get", "/export/orders/?format=jsonl", None, None),
+            ("logout", Client(), "get", "/logout/", None, None),
+        )
+        results = {}
+        for name, view_client, method, url, data, prepare in cases:
+            def run(measure_memory=False):
+                if prepare:
+                    prepare()
+                if measure_memory:
+                    tracemalloc.start()
+                with CaptureQueriesContext(connection) as context:
+                    started = time.perf_counter()
+                    response = (method if callable(method) else getattr(view_client, method))(url, data)
+                    if response.streaming:    # запросы потоковой выгрузки выполняются при чтении ответа
+                        b"".join(response.streaming_content)
+                    elapsed = time.perf_counter() - started
+                peak = 0
+                if measure_memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                return response.status_code, len(context.captured_queries), elapsed, peak
+
+            run()    # прогрев: индексы в памяти, кеш, id корзины в сессии
+            runs = [run() for _ in range(repeat)]
+            peak = run(measure_memory=True)[3]    # tracemalloc замедляет запрос, поэтому память измеряется отдельно
+            results[name] = {
+                "queries": max(queries for status, queries, elapsed, _ in runs),
+                "ms": statistics.median(elapsed for status, queries, elapsed, _ in runs) * 1000,
+                "peak_kib": peak / 1024,
+                "errors": sorted({status for status, *_ in runs if status >= 400}),
+            }
+        return results
+
+    def report(self, results):
+        for size, views in results.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f"Товаров в каталоге: {size}"))
+            self.stdout.write(f"{'страница':<28}{'запросов':>10}{'мс':>10}{'пик КиБ':>10}")
+            for name, row in views.items():
+                line = f"{name:<28}{row['queries']:>10}{row['ms']:>10.1f}{row['peak_kib']:>10.0f}"
+                if row["errors"]:
+                    line += f"  ошибка {row['errors']}"
+                self.stdout.write(line)
+
+    def check_regressions(self, results):
+        sizes = sorted(results)
+        problems = []
+        for name in results[sizes[0]]:
+            counts = [results[size][name]["queries"] for size in sizes]
+            chunk_size, queries_per_chunk = CHUNKED_PAGES.get(name, (None, 0))
+            chunks = -(-sizes[-1] // chunk_size) if chunk_size else 1    # выгрузка читает бд пачками - допустимы только запросы лишних пачек
+            if counts[-1] > counts[0] + (chunks - 1) * queries_per_chunk:
+                problems.append(f"{name}: запросов {' -> '.join(map(str, counts))}")
+            errors = sorted({status for size in sizes for status in results[size][name]["errors"]})
+            if errors:
+                problems.append(f"{name}: ответ {errors}")
+        if problems:
+            raise CommandError("Количество запросов растет с размером каталога:\n" + "\n".join(problems))
+        self.stdout.write(self.style.SUCCESS("Количество запросов не зависит от размера каталога"))
@@ -0,0 +1,78 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from mainapp.models import Cart, CartProduct, Order, OrderItem, Product
+from specs.models import FeatureValueCount, ProductFeatures
+
+
+SQLITE_FULL_SCAN_RE = re.compile(r"\bSCAN (?:TABLE )?(\w+)\b(?! USING (?:COVERING )?INDEX)")    # SCAN без индекса
+POSTGRES_FULL_SCAN_RE = re.compile(r"Seq Scan on (\w+)")
+
+
+def hot_queries(using):
+    """
+    Запросы, которые выполняются на каждой странице или при каждом действии с корзиной, -
+    в том виде, в котором их строит код (значения параметров не важны для плана)
+    """
+    return [
+        ("корзина покупателя", Cart.objects.using(using).filter(owner_id=1, in_order=False)),
+        ("корзина гостя", Cart.objects.using(using).filter(id=1, for_anonymous_user=True, in_order=False)),
+        ("корзины гостей", Cart.objects.using(using).filter(for_anonymous_user=True)),
+        ("брошенные корзины", Cart.objects.using(using).filter(in_order=False, updated_at__lt=timezone.now())),
+        ("товар в корзине", CartProduct.objects.using(using).filter(user_id=1, cart_id=1, product_id=1)),
+        ("товары корзины", CartProduct.objects.using(using).filter(cart_id=1)),
+        ("история заказов", Order.objects.using(using).filter(customer_id=1).order_by("-created_date")),
+        ("заказы по статусу (админка)", Order.objects.using(using).filter(status=Order.STATUS_NEW).order_by("-id")),
+        ("позиции заказов", OrderItem.objects.using(using).filter(order_id__in=[1, 2])),
+        ("товары категории по цене", Product.objects.using(using).filter(
+            category_id=1, price__gte=10, price__lte=100
+        ).order_by("price", "id")),
+        ("товар по slug", Product.objects.using(using).filter(slug="slug")),
+        ("товары по значению характеристики", ProductFeatures.objects.using(using).filter(feature_id=1, value="value")),
+        ("характеристики товара", ProductFeatures.objects.using(using).filter(product_id=1)),
+        ("счетчики фильтров категории", FeatureValueCount.objects.using(using).filter(category_id=1)),
+    ]
+
+
+def full_scans(vendor, plan):    # таблицы, которые план читает целиком
+    pattern = POSTGRES_FULL_SCAN_RE if vendor == "postgresql" else SQLITE_FULL_SCAN_RE
+    return pattern.findall(plan)
+
+
+class Command(BaseCommand):
+    help = (
+        "Проверяет планы (EXPLAIN) частых запросов корзины, заказов и каталога: "
+        "ни один из них не должен читать таблицу целиком. Ошибка - если нужного индекса нет"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Псевдоним базы данных")
+        parser.add_argument("--verbose-plans", action="store_true", help="Показать планы всех запросов")
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        vendor = connections[using].vendor
+        queries = hot_queries(using)
+        failed = []
+        for name, queryset in queries:
+            plan = self.explain(vendor, using, queryset)
+            scans = full_scans(vendor, plan)
+            if options["verbose_plans"] or scans:
+                self.stdout.write(f"{name}:\n{plan}\n")
+            if scans:
+                failed.append(f"{name} ({', '.join(scans)})")
+        if failed:
+            raise CommandError(f"Полное чтение таблицы: {'; '.join(failed)}")
+        self.stdout.write(self.style.SUCCESS(f"Проверено запросов: {len(queries)}, все используют индексы"))
+
+    def explain(self, vendor, using, queryset):
+        if vendor != "postgresql":
+            return queryset.explain()
+        # на маленькой таблице PostgreSQL честно выбирает Seq Scan - запрещаем его,
+        # чтобы план показал, есть ли подходящий индекс вообще
+        with transaction.atomic(using=using), connections[using].cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            return queryset.explain()
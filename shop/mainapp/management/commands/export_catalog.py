@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.exports import EXPORTS, EXPORT_FORMATS, EXPORT_CHUNK_SIZE, render_export
+
+
+class Command(BaseCommand):
+    help = "Потоковая выгрузка товаров (с характеристиками) или заказов (с позициями) в CSV или JSONL"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(EXPORTS))
+        parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+        parser.add_argument("--output", help="Файл выгрузки (по умолчанию - стандартный вывод)")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="Строк за один запрос к бд")
+
+    def handle(self, *args, **options):
+        lines = render_export(options["name"], options["format"], options["chunk_size"])
+        if not options["output"]:
+            for line in lines:
+                self.stdout.write(line, ending="")
+            return
+        count = 0
+        with open(options["output"], "w", encoding="utf-8", newline="") as file:
+            for line in lines:
+                file.write(line)
+                count += 1
+        self.stdout.write(self.style.SUCCESS(f"Записано строк: {count}"))
@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+
+from mainapp.cache import bump_catalog_version
+from mainapp.images import generate_renditions, has_renditions, mark_renditions_ready
+from mainapp.models import Product
+
+
+def init_worker():    # дочерний процесс (при запуске через spawn) должен заново настроить Django
+    django.setup()
+
+
+def render_image(image_name, force):    # (изображение, созданы ли копии, есть ли копии) - в дочернем процессе
+    created = generate_renditions(image_name, force)
+    return image_name, created, created or has_renditions(image_name)
+
+
+class Command(BaseCommand):
+    help = "Создает уменьшенные копии (и WebP) для уже загруженных изображений товаров параллельно в нескольких процессах"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Количество процессов")
+        parser.add_argument("--force", action="store_true", help="Пересоздать существующие копии")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        names = Product.objects.exclude(image="").order_by().values_list("image", flat=True).distinct()
+        created = total = 0
+        ready = []
+        with ProcessPoolExecutor(max_workers=options["workers"], initializer=init_worker) as executor:
+            forces = iter(lambda: options["force"], None)    # бесконечная последовательность значения --force
+            for name, result, has_copies in executor.map(render_image, names.iterator(), forces, chunksize=16):
+                total += 1
+                created += result
+                if has_copies:
+                    ready.append(name)
+        marked = mark_renditions_ready(ready)    # флаг товаров пишет основной процесс - дочерние с бд не работают
+        if created or marked:    # в кешированных страницах каталога нужен srcset новых копий
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f"Изображений: {total}, обработано: {created}, за {time.monotonic() - started:.1f} с"
+        ))
@@ -0,0 +1,214 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mainapp.cache import bump_cache_version, bump_catalog_version
+from mainapp.images import generate_renditions
+from mainapp.models import Category, Product
+from mainapp.prices import refresh_price_histogram
+from mainapp.search import SEARCH_CACHE
+from specs.facets import drop_facet_index
+from specs.tables import invalidate_category_spec_tables
+from specs.models import CategoryFeature, ProductFeatures
+from specs.validation import find_invalid_values
+
+
+FEATURE_COLUMN_PREFIX = "feature:"    # в CSV характеристики - колонки вида feature:<имя характеристики>
+PRODUCT_UPDATE_FIELDS = ["category", "title", "price", "description"]
+PRICE_FIELD = Product._meta.get_field("price")    # цена проверяется по полю модели: конечное число, max_digits и decimal_places
+
+
+class RowError(Exception):    # ошибка в строке файла (строка пропускается, импорт продолжается)
+    pass
+
+
+def read_csv(file):
+    for row in csv.DictReader(file):
+        features = {
+            key[len(FEATURE_COLUMN_PREFIX):]: value
+            for key, value in row.items() if key.startswith(FEATURE_COLUMN_PREFIX) and value
+        }
+        yield dict(row, features=features)
+
+
+def read_jsonl(file):    # некорректная строка - RowError вместо записи (импорт остальных строк продолжается)
+    for line_number, line in enumerate(file, start=1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as error:    # JSONDecodeError и UnicodeDecodeError - наследники ValueError
+                yield RowError(f"строка {line_number} файла - некорректный JSON ({error})")
+
+
+class Command(BaseCommand):
+    help = (
+        "Потоковый импорт товаров с характеристиками из CSV или JSONL. "
+        "Строки пишутся пачками через bulk_create/bulk_update, изображения копируются в нескольких потоках"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Файл .csv или .jsonl")
+        parser.add_argument("--format", choices=("csv", "jsonl"), help="По умолчанию - по расширению файла")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Сколько товаров записывать за одну транзакцию")
+        parser.add_argument("--images-dir", default="", help="Папка, относительно которой указаны пути изображений")
+        parser.add_argument("--workers", type=int, default=4, help="Потоков для копирования и обработки изображений")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if file_format not in ("csv", "jsonl"):
+            raise CommandError("Неизвестный формат файла, укажите --format")
+        self.images_dir = options["images_dir"]
+        # справочники целиком в памяти - они маленькие по сравнению с каталогом
+        self.categories = dict(Category.objects.values_list("slug", "id"))
+        self.features = {
+            (category_id, name): feature_id
+            for feature_id, category_id, name in CategoryFeature.objects.values_list("id", "category_id", "feature_name")
+        }
+        self.feature_categories = {feature_id: category_id for (category_id, _), feature_id in self.features.items()}
+        self.feature_names = {feature_id: name for (_, name), feature_id in self.features.items()}
+        self.touched_categories = set()
+        self.stats = {"created": 0, "updated": 0, "errors": 0}
+
+        started = time.monotonic()
+        reader = read_csv if file_format == "csv" else read_jsonl
+        try:
+            with open(path, encoding="utf-8", newline="") as file, \
+                    ThreadPoolExecutor(max_workers=options["workers"]) as self.executor:
+                batch = []
+                for line_number, record in enumerate(reader(file), start=1):
+                    batch.append((line_number, record))
+                    if len(batch) >= options["batch_size"]:
+                        self.import_batch(batch)
+                        batch = []
+                if batch:
+                    self.import_batch(batch)
+        finally:    # пачки, записанные до ошибки, уже в бд - производные данные пересчитываются в любом случае
+            self.refresh_derived_data()
+
+        elapsed = time.monotonic() - started
+        total = self.stats["created"] + self.stats["updated"]
+        self.stdout.write(self.style.SUCCESS(
+            f"Создано: {self.stats['created']}, обновлено: {self.stats['updated']}, "
+            f"ошибок: {self.stats['errors']}, {total / elapsed if elapsed else total:.0f} товаров/с"
+        ))
+
+    def parse(self, record):    # разбор строки по справочникам без запросов в бд (значения характеристик проверяются пачкой)
+        if isinstance(record, RowError):    # строку не удалось прочитать
+            raise record
+        if not isinstance(record, dict):
+            raise RowError("строка - не объект JSON")
+        category_id = self.categories.get(record.get("category"))
+        if category_id is None:
+            raise RowError(f"неизвестная категория {record.get('category')!r}")
+        if not record.get("slug") or not record.get("title"):
+            raise RowError("не указан slug или title")
+        try:
+            price = PRICE_FIELD.clean(str(record.get("price")), None)
+        except ValidationError:
+            raise RowError(f"некорректная цена {record.get('price')!r}")
+        if not isinstance(record.get("features") or {}, dict):
+            raise RowError("features - не объект {характеристика: значение}")
+        features = {}
+        for name, value in (record.get("features") or {}).items():
+            feature_id = self.features.get((category_id, name))
+            if feature_id is None:
+                raise RowError(f"у категории нет характеристики {name!r}")
+            features[feature_id] = str(value)
+        return {
+            "slug": record["slug"], "category_id": category_id, "title": record["title"], "price": price,
+            "description": record.get("description") or None, "image": record.get("image") or "", "features": features,
+        }
+
+    def copy_image(self, source):    # копирование в media и создание уменьшенных копий (в потоке пула)
+        with open(os.path.join(self.images_dir, source), "rb") as file:
+            name = default_storage.save(f"mainapp/{os.path.basename(source)}", File(file))
+        return name, generate_renditions(name)    # (имя в хранилище, созданы ли копии)
+
+    def import_batch(self, batch):
+        rows = {}
+        for line_number, record in batch:
+            try:
+                row = self.parse(record)
+            except RowError as error:
+                self.stats["errors"] += 1
+                self.stderr.write(f"Строка {line_number}: {error}")
+                continue
+            rows[row["slug"]] = dict(row, line=line_number)    # повтор slug в пачке - побеждает последняя строка
+
+        invalid = find_invalid_values(    # значения по FeatureValidator - вся пачка сразу, без запросов в бд
+            ((slug, feature_id, value) for slug, row in rows.items() for feature_id, value in row["features"].items()),
+            self.feature_categories,
+        )
+        lines = {slug: row["line"] for slug, row in rows.items()}
+        for slug, feature_id, value, allowed in invalid:
+            if rows.pop(slug, None) is not None:    # строка с несколькими ошибками считается один раз
+                self.stats["errors"] += 1
+            self.stderr.write(
+                f"Строка {lines[slug]}: недопустимое значение {value!r} "
+                f"характеристики {self.feature_names[feature_id]!r} (допустимы: {', '.join(allowed)})"
+            )
+
+        images = {slug: self.executor.submit(self.copy_image, row["image"]) for slug, row in rows.items() if row["image"]}
+        for slug, future in images.items():
+            try:
+                rows[slug]["image"], rows[slug]["renditions_ready"] = future.result()
+            except OSError as error:
+                self.stats["errors"] += 1
+                self.stderr.write(f"Товар {slug}: не удалось скопировать изображение ({error})")
+                rows[slug]["image"] = None    # изображение товара не меняется
+
+        with transaction.atomic():
+            existing = dict(Product.objects.filter(slug__in=rows).values_list("slug", "id"))
+            to_create, to_update = [], []
+            for slug, row in rows.items():
+                product = Product(
+                    id=existing.get(slug), slug=slug, category_id=row["category_id"], title=row["title"],
+                    price=row["price"], description=row["description"], image=row["image"] or "",
+                    renditions_ready=row.get("renditions_ready", False)
+                )
+                (to_update if product.id else to_create).append(product)
+                self.touched_categories.add(row["category_id"])
+            Product.objects.bulk_create(to_create)
+            Product.objects.bulk_update([p for p in to_update if not rows[p.slug]["image"]], PRODUCT_UPDATE_FIELDS)
+            Product.objects.bulk_update(
+                [p for p in to_update if rows[p.slug]["image"]], PRODUCT_UPDATE_FIELDS + ["image", "renditions_ready"]
+            )
+            product_ids = dict(Product.objects.filter(slug__in=rows).values_list("slug", "id"))    # id новых товаров (SQLite их не возвращает)
+
+            existing_features = {
+                (product_id, feature_id): row_id
+                for row_id, product_id, feature_id in ProductFeatures.objects.filter(
+                    product_id__in=product_ids.values()
+                ).values_list("id", "product_id", "feature_id")
+            }
+            features_to_create, features_to_update = [], []
+            for slug, row in rows.items():
+                for feature_id, value in row["features"].items():
+                    key = (product_ids[slug], feature_id)
+                    feature_row = ProductFeatures(id=existing_features.get(key), product_id=key[0], feature_id=feature_id, value=value)
+                    (features_to_update if feature_row.id else features_to_create).append(feature_row)
+            ProductFeatures.objects.bulk_create(features_to_create)
+            ProductFeatures.objects.bulk_update(features_to_update, ["value"])
+        self.stats["created"] += len(to_create)
+        self.stats["updated"] += len(to_update)
+
+    def refresh_derived_data(self):    # bulk-операции не вызывают сигналов - пересчитываем производные данные вручную
+        slugs = {category_id: slug for slug, category_id in self.categories.items()}
+        for category_id in self.touched_categories:
+            call_command("rebuild_facet_counts", category=slugs[category_id], stdout=self.stdout)
+            drop_facet_index(category_id)
+            invalidate_category_spec_tables(category_id)
+            refresh_price_histogram(category_id)
+        if self.touched_categories:
+            bump_cache_version(SEARCH_CACHE)
+            bump_catalog_version()
@@ -0,0 +1,88 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from mainapp.models import Cart, CartProduct, Order
+
+
+MIN_BATCH_SIZE = 10
+
+
+def stale_carts(cutoff):    # корзины, которые не менялись с cutoff и не попали в заказ (Order.cart удалился бы каскадом)
+    return Cart.objects.filter(in_order=False, updated_at__lt=cutoff).filter(
+        ~models.Exists(Order.objects.filter(cart=models.OuterRef("pk")))
+    ).order_by("updated_at")
+
+
+def orphaned_cart_products(cutoff):    # товары, которых нет в Cart.products, в корзинах без изменений с cutoff
+    return CartProduct.objects.filter(related_cart=None, cart__updated_at__lt=cutoff).order_by("id")
+
+
+class Command(BaseCommand):
+    help = (
+        "Удаляет брошенные корзины (не в заказе и не менялись --days дней) вместе с их товарами, "
+        "а также товары корзин, не связанные ни с одной корзиной. Удаление идет короткими транзакциями: "
+        "размер пачки подстраивается так, чтобы каждая транзакция укладывалась в --batch-time"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30, help="Корзина брошена, если не менялась столько дней")
+        parser.add_argument("--batch-size", type=int, default=500, help="Наибольшее количество строк за одну транзакцию")
+        parser.add_argument("--batch-time", type=float, default=0.2, help="Желаемая длительность одной транзакции (секунды)")
+        parser.add_argument("--max-seconds", type=float, default=0, help="Остановиться через столько секунд (0 - без ограничения)")
+        parser.add_argument("--pause", type=float, default=0, help="Пауза между пачками (секунды), чтобы не мешать запросам сайта")
+        parser.add_argument("--dry-run", action="store_true", help="Только посчитать, ничего не удалять")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        if options["dry_run"]:
+            self.stdout.write(self.style.SUCCESS(
+                f"Брошенных корзин: {stale_carts(cutoff).count()}, "
+                f"несвязанных товаров корзин: {orphaned_cart_products(cutoff).count()}"
+            ))
+            return
+
+        self.options = options
+        started = time.monotonic()
+        self.deadline = started + options["max_seconds"] if options["max_seconds"] else None
+        removed = Counter()    # модель -> удалено строк (вместе с каскадом)
+        completed = self.purge(stale_carts(cutoff), removed) and self.purge(orphaned_cart_products(cutoff), removed)
+        elapsed = time.monotonic() - started
+
+        total = sum(removed.values())
+        self.stdout.write(self.style.SUCCESS(
+            f"Удалено корзин: {removed[Cart._meta.label]}, товаров корзин: {removed[CartProduct._meta.label]}, "
+            f"связей корзина-товар: {removed[Cart.products.through._meta.label]}; "
+            f"{total / elapsed if elapsed else total:.0f} строк/с"
+        ))
+        if not completed:
+            self.stdout.write("Остановлено по --max-seconds, остальное будет удалено при следующем запуске")
+
+    def purge(self, queryset, removed):    # False - время вышло раньше, чем закончились строки
+        batch_size = max_batch_size = self.options["batch_size"]
+        lock = {    # блокируются только строки удаляемой таблицы (в выборке несвязанных товаров есть LEFT JOIN)
+            "skip_locked": connection.features.has_select_for_update_skip_locked,
+            "of": ("self",) if connection.features.has_select_for_update_of else (),
+        }
+        while self.deadline is None or time.monotonic() < self.deadline:
+            batch_started = time.monotonic()
+            with transaction.atomic():
+                # выборка и удаление в одной транзакции: строка, которую сейчас меняет сайт, пропускается
+                # (PostgreSQL), а на SQLite транзакция IMMEDIATE сразу берет блокировку на запись
+                ids = list(queryset.select_for_update(**lock).values_list("id", flat=True)[:batch_size])
+                if not ids:
+                    return True
+                removed.update(queryset.model.objects.filter(id__in=ids).delete()[1])
+            # пачка дольше batch-time - уменьшаем, заметно быстрее - увеличиваем (до --batch-size)
+            batch_elapsed = time.monotonic() - batch_started
+            if batch_elapsed > self.options["batch_time"]:
+                batch_size = max(MIN_BATCH_SIZE, batch_size // 2)
+            elif batch_elapsed < self.options["batch_time"] / 2:
+                batch_size = min(max_batch_size, batch_size * 2)
+            if self.options["pause"]:
+                time.sleep(self.options["pause"])
+        return False
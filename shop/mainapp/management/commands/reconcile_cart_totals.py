@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
+
+from mainapp.models import Cart, CartProduct
+
+
+class Command(BaseCommand):
+    help = "Проверяет итоги корзин (final_price, total_product) по их товарам и исправляет расхождения порциями"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Сколько корзин проверять за один запрос")
+        parser.add_argument("--dry-run", action="store_true", help="Только показать расхождения, ничего не исправлять")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        last_id = 0    # keyset по id - каждая порция читается по индексу, без OFFSET
+        checked = broken = 0
+        while True:
+            carts = list(
+                Cart.objects.filter(id__gt=last_id).order_by("id").only("id", "final_price", "total_product").annotate(
+                    real_final_price=Coalesce(models.Sum("products__final_price"), 0, output_field=models.DecimalField()),
+                    real_total_product=models.Count("products"),
+                )[:chunk_size]
+            )
+            if not carts:
+                break
+            last_id = carts[-1].id
+            checked += len(carts)
+            broken_ids = [
+                cart.id for cart in carts
+                if cart.final_price != cart.real_final_price or cart.total_product != cart.real_total_product
+            ]
+            if not broken_ids:
+                continue
+            broken += len(broken_ids)
+            for cart_id in broken_ids:
+                self.stdout.write(f"Корзина {cart_id}: итоги не совпадают с товарами")
+            if not options["dry_run"]:
+                self.repair(broken_ids)
+        action = "найдено" if options["dry_run"] else "исправлено"
+        self.stdout.write(self.style.SUCCESS(f"Проверено корзин: {checked}, {action} расхождений: {broken}"))
+
+    def repair(self, cart_ids):    # пересчет одним UPDATE с подзапросами - не затирает изменения, сделанные между проверкой и исправлением
+        items = CartProduct.objects.filter(related_cart=models.OuterRef("pk")).order_by().values("related_cart")
+        with transaction.atomic():
+            Cart.objects.filter(id__in=cart_ids).update(
+                final_price=Coalesce(
+                    models.Subquery(items.annotate(total=models.Sum("final_price")).values("total")),
+                    0, output_field=models.DecimalField(),
+                ),
+                total_product=Coalesce(
+                    models.Subquery(items.annotate(total=models.Count("id")).values("total")),
+                    0,
+                ),
+            )
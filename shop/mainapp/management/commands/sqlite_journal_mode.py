@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from mainapp.db import set_sqlite_journal_mode
+
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+
+
+class Command(BaseCommand):
+    help = (
+        "Устанавливает режим журнала SQLite (по умолчанию settings.SQLITE_JOURNAL_MODE). "
+        "Режим сохраняется в файле бд, поэтому команда запускается один раз при развертывании, "
+        "а не при каждом соединении"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Псевдоним бд из settings.DATABASES")
+        parser.add_argument("--mode", choices=JOURNAL_MODES, default=settings.SQLITE_JOURNAL_MODE, help="Режим журнала")
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        if connection.vendor != "sqlite":
+            raise CommandError(f"Бд {options['database']} - не SQLite")
+        mode = set_sqlite_journal_mode(connection, options["mode"])
+        if mode.upper() != options["mode"]:    # например, бд в памяти остается в режиме memory
+            raise CommandError(f"Режим журнала не изменен: {mode}")
+        self.stdout.write(self.style.SUCCESS(f"Режим журнала: {mode}"))
@@ -0,0 +1,92 @@
+import threading
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)    # границы гистограммы времени ответа (секунды)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)    # границы гистограммы количества запросов за ответ
+
+# сборщик SQL запросов текущего запроса (middleware.QueryCollector) для async представлений: их запросы
+# выполняются в других потоках (mainapp.async_queries), а execute_wrapper действует только на соединение своего потока
+current_collector = ContextVar("current_collector", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # последний элемент - значения больше всех границ (+Inf)
+        self.total = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса в памяти: гистограммы времени ответа и количества SQL запросов
+    по имени url, счетчики времени запросов в бд и подозрений на N+1.
+    Запись - несколько операций со словарями под общей блокировкой, поэтому сбор
+    можно держать включенным в продакшене
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))    # (view, method, status) -> гистограмма
+        self.query_count = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))    # view -> гистограмма
+        self.query_seconds = Counter()    # view -> суммарное время запросов в бд
+        self.duplicate_queries = Counter()    # view -> ответы с повторяющимися запросами
+
+    def record(self, view, method, status, seconds, queries, query_seconds, has_duplicates):
+        with self.lock:
+            self.latency[(view, method, f"{status // 100}xx")].observe(seconds)
+            self.query_count[view].observe(queries)
+            self.query_seconds[view] += query_seconds
+            if has_duplicates:
+                self.duplicate_queries[view] += 1
+
+    def render(self):    # текстовый формат Prometheus
+        with self.lock:
+            lines = [
+                "# HELP shop_request_duration_seconds Время ответа по имени url",
+                "# TYPE shop_request_duration_seconds histogram",
+            ]
+            for (view, method, status), histogram in sorted(self.latency.items()):
+                lines += render_histogram(
+                    "shop_request_duration_seconds", f'view="{view}",method="{method}",status="{status}"', histogram
+                )
+            lines += [
+                "# HELP shop_db_queries_per_request SQL запросов за один ответ",
+                "# TYPE shop_db_queries_per_request histogram",
+            ]
+            for view, histogram in sorted(self.query_count.items()):
+                lines += render_histogram("shop_db_queries_per_request", f'view="{view}"', histogram)
+            lines += [
+                "# HELP shop_db_query_seconds_total Суммарное время SQL запросов",
+                "# TYPE shop_db_query_seconds_total counter",
+            ]
+            lines += [f'shop_db_query_seconds_total{{view="{view}"}} {value}' for view, value in sorted(self.query_seconds.items())]
+            lines += [
+                "# HELP shop_duplicate_queries_total Ответы, в которых один и тот же запрос повторялся (подозрение на N+1)",
+                "# TYPE shop_duplicate_queries_total counter",
+            ]
+            lines += [f'shop_duplicate_queries_total{{view="{view}"}} {value}' for view, value in sorted(self.duplicate_queries.items())]
+        return "\n".join(lines) + "\n"
+
+
+def render_histogram(name, labels, histogram):
+    lines, cumulative = [], 0
+    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+    lines.append(f"{name}_count{{{labels}}} {cumulative}")
+    return lines
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import connections
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.http import http_date, urlencode
+
+from .cache import CATALOG_CACHE, get_cache_version, get_catalog_modified, versioned_key
+from .metrics import registry, current_collector
+from .mixins import get_anonymous_cart
+from .utils import get_catalog_query
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCollector:
+    """
+    Обертка выполнения SQL (connection.execute_wrapper): считает запросы и их время.
+    Текст запроса приходит с плейсхолдерами вместо параметров, поэтому одинаковые
+    запросы с разными id (типичный N+1 в цикле шаблона) совпадают
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()    # async представление выполняет запросы одновременно в нескольких потоках
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self.lock:
+                self.seconds += time.perf_counter() - started
+                self.count += 1
+                self.statements[sql] += 1
+
+    def collect(self):    # контекст: запросы всех соединений текущего потока попадают в этот сборщик
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+        return stack
+
+    def duplicates(self, threshold):
+        return [(sql, count) for sql, count in self.statements.items() if count >= threshold]
+
+
+class MetricsMiddleware:
+    """
+    Время ответа и SQL запросы каждого запроса по имени url (отдаются на /metrics).
+    Если один и тот же запрос повторился METRICS_DUPLICATE_QUERY_THRESHOLD раз, пишет предупреждение в лог.
+    Под ASGI работает без перехода в синхронный поток; тогда считаются запросы, выполненные через mainapp.async_queries
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.duplicate_threshold = getattr(settings, "METRICS_DUPLICATE_QUERY_THRESHOLD", 5)
+        if asyncio.iscoroutinefunction(get_response):    # как в MiddlewareMixin: обработчик должен знать, что __call__ - корутина
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        collector = QueryCollector()
+        started = time.perf_counter()
+        with collector.collect():
+            response = self.get_response(request)
+        self.record(request, response, collector, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        collector = QueryCollector()
+        token = current_collector.set(collector)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_collector.reset(token)
+        self.record(request, response, collector, time.perf_counter() - started)
+        return response
+
+    def record(self, request, response, collector, elapsed):
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"    # неизвестные url не раздувают количество меток
+        duplicates = collector.duplicates(self.duplicate_threshold)
+        for sql, count in duplicates:
+            logger.warning("Возможный N+1 в %s: запрос выполнен %s раз: %s", view, count, sql[:200])
+        registry.record(
+            view, request.method, response.status_code, elapsed, collector.count, collector.seconds, bool(duplicates)
+        )
+
+
+CATALOG_PAGES = {"mainapp:base", "mainapp:category_detail", "mainapp:product_detail"}    # страницы, общие для всех анонимных посетителей
+PAGE_CACHE_TIMEOUT = 24 * 60 * 60    # устаревшие версии все равно не читаются - время жизни только ограничивает память
+CART_BADGE_RE = re.compile(r"(<span[^>]*\bdata-cart-badge\b[^>]*>)\d+(</span>)")
+CART_BADGE_PLACEHOLDER = "<!--cart-badge-->"
+
+
+class CatalogPageCacheMiddleware(MiddlewareMixin):
+    """
+    Страницы каталога для анонимных посетителей.
+    ETag и Last-Modified строятся по версии каталога (mainapp.cache.CATALOG_CACHE), поэтому
+    браузер и CDN получают 304 без рендера страницы. Готовый html кешируется по url и версии каталога;
+    количество товаров в корзине посетителя (шапка) в кеше заменено заглушкой и подставляется при отдаче.
+    Авторизованные пользователи и страницы с одноразовыми сообщениями не кешируются
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ("GET", "HEAD") or request.resolver_match.view_name not in CATALOG_PAGES:
+            return None
+        if request.user.is_authenticated or len(get_messages(request)):
+            return None
+        cart = get_anonymous_cart(request)
+        badge = cart.total_product if cart else 0
+        etag = f'"{get_cache_version(CATALOG_CACHE)}-{badge}"'    # корзина в ETag - после ее изменения 304 не отдается
+        # Last-Modified не знает о корзине - отдается только посетителям без товаров в корзине
+        last_modified = None if badge else get_catalog_modified()
+        page = f"{request.path}?{urlencode(get_catalog_query(request.GET))}"    # посторонние параметры - та же страница
+        key = versioned_key(CATALOG_CACHE, "page", hashlib.md5(page.encode()).hexdigest())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            html = cache.get(key)
+            if html is not None:
+                response = HttpResponse(html.replace(CART_BADGE_PLACEHOLDER, str(badge)))
+        if response is not None:
+            return self.set_validators(response, etag, last_modified)
+        request.catalog_page = (key, etag, last_modified)    # сохранить страницу после рендера
+        return None
+
+    def process_response(self, request, response):
+        page = getattr(request, "catalog_page", None)
+        if page is None or response.status_code != 200 or response.streaming:
+            return response
+        key, etag, last_modified = page
+        html = response.content.decode(response.charset)
+        cache.set(key, CART_BADGE_RE.sub(rf"\g<1>{CART_BADGE_PLACEHOLDER}\g<2>", html), PAGE_CACHE_TIMEOUT)
+        return self.set_validators(response, etag, last_modified)
+
+    def set_validators(self, response, etag, last_modified):
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, no_cache=True)    # хранить можно, но перед показом - проверка по ETag
+        return response
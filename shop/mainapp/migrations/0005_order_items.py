@@ -0,0 +1,58 @@
+# Generated by Django 3.1.4 on 2026-10-18 14:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_order_items(apps, schema_editor):    # позиции уже оформленных заказов - из товаров их корзин
+    Order = apps.get_model("mainapp", "Order")
+    OrderItem = apps.get_model("mainapp", "OrderItem")
+    CartProduct = apps.get_model("mainapp", "CartProduct")
+    for order in Order.objects.select_related("cart").iterator():
+        items = [
+            OrderItem(
+                order=order, product_id=row["product_id"], title=row["product__title"],
+                price=row["final_price"] / row["qty"] if row["qty"] else row["product__price"],    # цена, по которой заказано
+                qty=row["qty"], final_price=row["final_price"]
+            )
+            for row in CartProduct.objects.filter(cart_id=order.cart_id).values(
+                "product_id", "product__title", "product__price", "qty", "final_price"
+            )
+        ]
+        OrderItem.objects.bulk_create(items)
+        Order.objects.filter(id=order.id).update(
+            total_products=order.cart.total_product, final_price=order.cart.final_price
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0004_cartproduct_anonymous_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='final_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=9, verbose_name='Общая цена'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_products',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество товаров'),
+        ),
+        migrations.CreateModel(
+            name='OrderItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255, verbose_name='Наименование')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Цена')),
+                ('qty', models.PositiveIntegerField(default=1)),
+                ('final_price', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Общая цена')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='mainapp.order', verbose_name='Заказ')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='mainapp.product', verbose_name='Товар')),
+            ],
+        ),
+        migrations.RunPython(copy_order_items, migrations.RunPython.noop),
+    ]
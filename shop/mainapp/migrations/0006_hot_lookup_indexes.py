@@ -0,0 +1,61 @@
+# Generated by Django 3.1.4 on 2026-10-18 14:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def merge_duplicate_cart_products(apps, schema_editor):    # перед уникальностью (cart, product): повторы товара сливаются в одну строку
+    CartProduct = apps.get_model("mainapp", "CartProduct")
+    Cart = apps.get_model("mainapp", "Cart")
+    duplicates = CartProduct.objects.order_by().values("cart_id", "product_id").annotate(
+        rows=models.Count("id"), keep=models.Min("id")
+    ).filter(rows__gt=1)
+    for row in duplicates:
+        items = CartProduct.objects.filter(cart_id=row["cart_id"], product_id=row["product_id"])
+        CartProduct.objects.filter(id=row["keep"]).update(
+            **items.aggregate(qty=models.Sum("qty"), final_price=models.Sum("final_price"))
+        )
+        items.exclude(id=row["keep"]).delete()
+        Cart.objects.filter(id=row["cart_id"]).update(total_product=models.F("total_product") - (row["rows"] - 1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0005_order_items'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['owner', 'in_order'], name='cart_owner_in_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(for_anonymous_user=True), fields=['id'], name='cart_anonymous_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', '-created_date'], name='order_customer_created_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_cart_products, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartproduct',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='cartproduct_cart_product_uniq'),
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='owner',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='mainapp.customer', verbose_name='Владелец'),
+        ),
+        migrations.AlterField(
+            model_name='cartproduct',
+            name='cart',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='related_products', to='mainapp.cart', verbose_name='Корзина'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='customer',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='related_orders', to='mainapp.customer', verbose_name='Покупатель'),
+        ),
+    ]
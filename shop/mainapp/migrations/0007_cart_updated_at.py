@@ -0,0 +1,24 @@
+# Generated by Django 3.1.4 on 2026-10-18 16:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0006_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(    # существующие корзины считаются измененными в момент миграции - сразу ничего не удаляется
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Изменена'),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(in_order=False), fields=['updated_at'], name='cart_open_updated_idx'),
+        ),
+    ]
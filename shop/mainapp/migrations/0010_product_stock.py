@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0009_product_category_price_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, help_text='Пусто - остаток не учитывается и товар можно заказать в любом количестве', null=True, verbose_name='Остаток на складе'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.4 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+
+def mark_existing_renditions(apps, schema_editor):    # копии, созданные до появления флага, - по файлам в хранилище
+    from mainapp.images import has_renditions
+    Product = apps.get_model("mainapp", "Product")
+    names = Product.objects.exclude(image="").order_by().values_list("image", flat=True).distinct()
+    ready = [name for name in names.iterator() if has_renditions(name)]
+    for start in range(0, len(ready), 500):
+        Product.objects.filter(image__in=ready[start:start + 500]).update(renditions_ready=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0010_product_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='renditions_ready',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Уменьшенные копии изображения созданы'),
+        ),
+        migrations.RunPython(mark_existing_renditions, migrations.RunPython.noop),
+    ]
@@ -1,20 +1,145 @@
+import asyncio
+
+from django.utils.functional import cached_property
 from django.views.generic import View
 
+from .async_queries import run_sync
 from .models import Cart, Customer
+from .utils import merge_carts
+
+
+ANONYMOUS_CART_SESSION_KEY = "anonymous_cart_id"    # ключ сессии, в котором хранится id корзины анонимного пользователя
+CART_SESSION_KEY = "cart_id"    # id корзины авторизованного покупателя (None - корзины нет)
+CUSTOMER_SESSION_KEY = "customer_id"    # id покупателя авторизованного пользователя (None - покупателя нет)
+
+
+class CartResolver:
+    """
+    Корзина текущего запроса.
+    Id покупателя и корзины кешируются в сессии, корзина загружается из бд
+    только при первом обращении к ней, а новые строки (покупатель, корзина)
+    создаются только в get_or_create_cart - то есть при изменении корзины,
+    но никогда при простом просмотре страниц
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    @property
+    def session(self):
+        return self.request.session
+
+    @cached_property
+    def customer_id(self):
+        if not self.request.user.is_authenticated:
+            return None
+        if CUSTOMER_SESSION_KEY not in self.session:    # ищем покупателя один раз за сессию
+            self.session[CUSTOMER_SESSION_KEY] = Customer.objects.filter(
+                user=self.request.user
+            ).values_list("id", flat=True).first()
+        return self.session[CUSTOMER_SESSION_KEY]
+
+    @cached_property
+    def cart(self):
+        if not self.request.user.is_authenticated:
+            return get_anonymous_cart(self.request)
+        if CART_SESSION_KEY not in self.session:    # id корзины еще не известен - ищем по покупателю
+            cart = None
+            if self.customer_id is not None:
+                cart = Cart.objects.filter(owner_id=self.customer_id, in_order=False).first()
+            self.session[CART_SESSION_KEY] = cart.id if cart else None
+            return cart
+        cart_id = self.session[CART_SESSION_KEY]
+        if cart_id is None:    # известно, что корзины нет - запрос в бд не нужен
+            return None
+        cart = Cart.objects.filter(id=cart_id, in_order=False).first()
+        if not cart:    # корзина ушла в заказ или удалена - при следующем запросе ищем заново
+            del self.session[CART_SESSION_KEY]
+        return cart
+
+    def get_or_create_cart(self):    # корзина для изменения (создается в бд только здесь)
+        if self.cart is not None:
+            return self.cart
+        if self.request.user.is_authenticated:
+            customer_id = self.get_or_create_customer_id()
+            # корзина могла появиться в другой сессии этого же пользователя
+            cart = Cart.objects.filter(owner_id=customer_id, in_order=False).first()
+            if not cart:
+                cart = Cart.objects.create(owner_id=customer_id)
+            self.session[CART_SESSION_KEY] = cart.id
+        else:
+            cart = Cart.objects.create(for_anonymous_user=True)
+            self.session[ANONYMOUS_CART_SESSION_KEY] = cart.id
+        self.__dict__["cart"] = cart    # обновляем значение cached_property
+        return cart
+
+    def get_or_create_customer_id(self):
+        if self.customer_id is None:
+            customer = Customer.objects.filter(user=self.request.user).first()
+            if not customer:
+                customer = Customer.objects.create(user=self.request.user)
+            self.session[CUSTOMER_SESSION_KEY] = customer.id
+            self.__dict__["customer_id"] = customer.id
+        return self.customer_id
+
+    def forget_cart(self):    # после оформления заказа корзина больше не текущая
+        self.session.pop(CART_SESSION_KEY, None)
+        self.session.pop(ANONYMOUS_CART_SESSION_KEY, None)
+        self.__dict__.pop("cart", None)
 
 
 class CartMixin(View):
     def dispatch(self, request, *args, **kwargs):
-        if request.user.is_authenticated:    # если пользователь авторизован
-            customer = Customer.objects.filter(user=request.user).first()    # поиск пользователя
-            if not customer:    # если покупателя нет - создаем покупателя
-                customer = Customer.objects.create(user=request.user)
-            cart = Cart.objects.filter(owner=customer, in_order=False).first()    # поиск корзины которая относится к этому пользователю и не находится в заказе
-            if not cart:    # если корзина найдена - созается новую корзина этого пользователя
-                cart = Cart.objects.create(owner=customer)
-        else:    # если пользовательне авторизован
-            cart = Cart.objects.filter(for_anonymous_user=True).first()    # поиск корзины анонимного пользователя
-            if not cart:
-                cart = Cart.objects.create(for_anonymous_user=True)    # создание анонимной корзины
-        self.cart = cart
+        self.cart_resolver = CartResolver(request)    # сама корзина загрузится только при обращении к self.cart
         return super().dispatch(request, *args, **kwargs)
+
+    @property
+    def cart(self):
+        return self.cart_resolver.cart
+
+    def get_or_create_cart(self):
+        return self.cart_resolver.get_or_create_cart()
+
+
+class AsyncView(View):
+    """
+    Представление с async def обработчиками (get, post...).
+    В Django 3.1 View.as_view всегда синхронный, поэтому функция представления
+    помечается как корутина - так же, как это делает MiddlewareMixin для async цепочки
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view._is_coroutine = asyncio.coroutines._is_coroutine
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):    # http_method_not_allowed и options - синхронные
+            response = await response
+        return response
+
+
+class AsyncCartMixin(CartMixin):    # для AsyncView: self.cart синхронный, корзина получается через await self.get_cart()
+    async def get_cart(self):
+        return await run_sync(lambda: self.cart_resolver.cart)    # сессия и пользователь - в синхронном потоке запроса
+
+
+def get_anonymous_cart(request):    # у каждого посетителя своя корзина, привязанная к его сессии
+    cart_id = request.session.get(ANONYMOUS_CART_SESSION_KEY)
+    if cart_id is None:
+        return None
+    cart = Cart.objects.filter(id=cart_id, for_anonymous_user=True, in_order=False).first()
+    if not cart:    # корзина удалена или уже в заказе - забываем ее
+        del request.session[ANONYMOUS_CART_SESSION_KEY]
+    return cart
+
+
+def merge_anonymous_cart(request):    # вызывается сразу после login() - корзина посетителя переходит к покупателю
+    anonymous_cart = get_anonymous_cart(request)
+    if anonymous_cart is None:
+        return
+    cart = CartResolver(request).get_or_create_cart()
+    merge_carts(anonymous_cart, cart)
+    del request.session[ANONYMOUS_CART_SESSION_KEY]
@@ -21,9 +21,9 @@ class Category(models.Model):
         return ProductFeatures.objects.filter(
             category=self,
             use_in_filter=True,
-        ).prefetch_related("category").value(
+        ).values(
             "feature_key",
-            "feature_measure",
+            "filter_measure",
             "feature_name",
             "filter_type"
         )
@@ -38,6 +38,18 @@ class Product(models.Model):
     description = models.TextField(verbose_name="Описание", null=True)  # большой текст (null=True - может быть пустым)
     price = models.DecimalField(max_digits=9, decimal_places=2,
                                 verbose_name="Цена")  # 1-количество цифр 2-цифры после запятой
+    stock = models.PositiveIntegerField(
+        verbose_name="Остаток на складе", null=True, blank=True,
+        help_text="Пусто - остаток не учитывается и товар можно заказать в любом количестве"
+    )    # списывается при оформлении заказа (reserve_stock)
+    renditions_ready = models.BooleanField(
+        default=False, editable=False, verbose_name="Уменьшенные копии изображения созданы"
+    )    # ставится после создания копий (mainapp.images) - карточки не проверяют файлы в хранилище
+
+    class Meta:
+        indexes = [    # страница категории: фильтр по цене и сортировка по цене (id - для курсора постраничного вывода)
+            models.Index(fields=["category", "price", "id"], name="product_category_price_idx"),
+        ]
 
     def __str__(self):
         return self.title
@@ -112,14 +124,21 @@ class ProductFeatureValidators(models.Model):
 
 
 class CartProduct(models.Model):
-    user = models.ForeignKey("Customer", verbose_name="Покупатель", on_delete=models.CASCADE)    #? первый аргумент
+    user = models.ForeignKey(
+        "Customer", verbose_name="Покупатель", null=True, blank=True, on_delete=models.CASCADE
+    )    # null=True - товар анонимной корзины не привязан к покупателю
     cart = models.ForeignKey(
-        "Cart", verbose_name="Корзина", on_delete=models.CASCADE, related_name="related_products"
-    )    # related_name - название, используемое для обратной связи от связанной модели
+        "Cart", verbose_name="Корзина", on_delete=models.CASCADE, related_name="related_products", db_index=False
+    )    # related_name - название, используемое для обратной связи от связанной модели (индекс - уникальность (cart, product))
     product = models.ForeignKey(Product, verbose_name="Товар", on_delete=models.CASCADE)
     qty = models.PositiveIntegerField(default=1)    # челое число больше нуля
     final_price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name="Общая цена")
 
+    class Meta:
+        constraints = [    # один товар - одна строка в корзине (индекс заодно обслуживает поиск товара в корзине)
+            models.UniqueConstraint(fields=["cart", "product"], name="cartproduct_cart_product_uniq"),
+        ]
+
     def __str__(self):
         return f"Продукт {self.product.title} (для корзины)"
 
@@ -129,7 +148,9 @@ class CartProduct(models.Model):
 
 
 class Cart(models.Model):
-    owner = models.ForeignKey("Customer", null=True, verbose_name="Владелец", on_delete=models.CASCADE)
+    owner = models.ForeignKey(
+        "Customer", null=True, verbose_name="Владелец", on_delete=models.CASCADE, db_index=False
+    )    # индекс - составной (owner, in_order)
     products = models.ManyToManyField(CartProduct, blank=True, related_name="related_cart")    # связь с объектом CartProdukt (многие ко многим). blank=True - для проверки даных. поле может быть пустым
     total_product = models.PositiveIntegerField(default=0)
     final_price = models.DecimalField(
@@ -137,6 +158,18 @@ class Cart(models.Model):
     )
     in_order = models.BooleanField(default=False)    # для определения является корзина в заказе или нет (по умолчанию - нет)
     for_anonymous_user = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Изменена")    # последнее изменение (для удаления брошенных корзин)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "in_order"], name="cart_owner_in_order_idx"),    # текущая корзина покупателя
+            models.Index(
+                fields=["id"], name="cart_anonymous_idx", condition=models.Q(for_anonymous_user=True)
+            ),    # частичный индекс - только корзины анонимных посетителей
+            models.Index(
+                fields=["updated_at"], name="cart_open_updated_idx", condition=models.Q(in_order=False)
+            ),    # брошенные корзины (purge_stale_carts) - корзины заказов в индекс не попадают
+        ]
 
     def __str__(self):
         return str(self.id)
@@ -177,8 +210,8 @@ class Order(models.Model):
 
     customer = models.ForeignKey(
         Customer, verbose_name="Покупатель",
-        related_name="related_orders", on_delete=models.CASCADE
-    )
+        related_name="related_orders", on_delete=models.CASCADE, db_index=False
+    )    # индекс - составной (customer, -created_date)
     first_name = models.CharField(max_length=255, verbose_name="Имя")
     last_name = models.CharField(max_length=255, verbose_name="Фамилия")
     cart = models.ForeignKey(Cart, verbose_name="Корзина", on_delete=models.CASCADE)
@@ -196,6 +229,32 @@ class Order(models.Model):
     comment = models.TextField(verbose_name="Комментаний к заказу", null=True, blank=True)
     created_date = models.DateTimeField(verbose_name="Дата создания заказа", auto_now=True)    # не будет отображен в админке при заполнении формы
     order_date = models.DateField(verbose_name="Дата получения заказа", default=timezone.now)
+    total_products = models.PositiveIntegerField(verbose_name="Количество товаров", default=0)    # итоги корзины на момент оформления
+    final_price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name="Общая цена", default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["customer", "-created_date"], name="order_customer_created_idx"),    # история заказов
+            # фильтры и поиск списка заказов в админке (id в конце - сортировка списка без отдельного шага)
+            models.Index(fields=["status", "id"], name="order_status_idx"),
+            models.Index(fields=["buying_type", "id"], name="order_buying_type_idx"),
+            models.Index(fields=["order_date"], name="order_date_idx"),
+            models.Index(fields=["phone"], name="order_phone_idx"),
+        ]
 
     def __str__(self):
         return str(self.id)
+
+
+class OrderItem(models.Model):    # позиция заказа - неизменяемая копия товара корзины на момент оформления
+    order = models.ForeignKey(Order, verbose_name="Заказ", on_delete=models.CASCADE, related_name="items")
+    product = models.ForeignKey(
+        Product, verbose_name="Товар", null=True, blank=True, on_delete=models.SET_NULL
+    )    # товар могут удалить из каталога, позиция заказа при этом остается
+    title = models.CharField(max_length=255, verbose_name="Наименование")
+    price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name="Цена")
+    qty = models.PositiveIntegerField(default=1)
+    final_price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name="Общая цена")
+
+    def __str__(self):
+        return f"{self.title} x {self.qty} (заказ {self.order_id})"
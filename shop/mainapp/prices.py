@@ -0,0 +1,59 @@
+from django.core.cache import cache
+from django.db import models
+from django.db.models.functions import Floor
+
+from .models import Product
+
+
+PRICE_HISTOGRAM_CACHE = "price_histogram"
+PRICE_HISTOGRAM_BUCKETS = 10
+
+
+def price_histogram_key(category_id):
+    return f"{PRICE_HISTOGRAM_CACHE}:{category_id}"
+
+
+def build_price_histogram(category_id, buckets=PRICE_HISTOGRAM_BUCKETS):
+    """
+    Распределение цен товаров категории: buckets равных интервалов от минимальной до максимальной цены
+    с количеством товаров в каждом. Два запроса по индексу (category, price): MIN/MAX и GROUP BY номера интервала.
+    Пустая категория - пустой словарь
+    """
+    products = Product.objects.filter(category_id=category_id).order_by()
+    bounds = products.aggregate(low=models.Min("price"), high=models.Max("price"))
+    low, high = bounds["low"], bounds["high"]
+    if low is None:
+        return {}
+    width = (high - low) / buckets
+    counts = [0] * buckets
+    if width:
+        rows = products.annotate(bucket=Floor(
+            models.ExpressionWrapper((models.F("price") - low) / width, output_field=models.DecimalField()),
+            output_field=models.IntegerField(),
+        )).values("bucket").annotate(count=models.Count("id"))
+        for row in rows:
+            counts[min(int(row["bucket"]), buckets - 1)] += row["count"]    # максимальная цена - в последний интервал
+    else:    # у всех товаров одна цена
+        counts[0] = products.count()
+    tallest = max(counts)
+    return {
+        "min": low,
+        "max": high,
+        "buckets": [
+            {"low": low + width * i, "high": low + width * (i + 1), "count": count, "height": count * 100 // tallest}
+            for i, count in enumerate(counts)
+        ],
+    }
+
+
+def refresh_price_histogram(category_id):    # пересчитать заранее - страница категории только читает готовое из кеша
+    histogram = build_price_histogram(category_id)
+    cache.set(price_histogram_key(category_id), histogram, None)
+    return histogram
+
+
+def get_price_histogram(category_id):
+    histogram = cache.get(price_histogram_key(category_id))
+    if histogram is None:    # еще не считалась или вытеснена из кеша
+        histogram = refresh_price_histogram(category_id)
+    return histogram
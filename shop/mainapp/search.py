@@ -0,0 +1,130 @@
+import math
+import re
+import threading
+from collections import Counter
+
+from specs.models import ProductFeatures
+
+from .cache import get_cache_version, bump_cache_version
+from .models import Product
+
+
+TOKEN_RE = re.compile(r"\w+")    # слова (в том числе кириллица и цифры)
+FIELD_WEIGHTS = {"title": 3, "features": 2, "description": 1}    # слово из названия весит больше, чем слово из описания
+SEARCH_CACHE = "search"
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or "").lower())
+
+
+class SearchIndex:
+    """
+    Обратный индекс товаров в памяти: слово -> {id товара: вес слова в товаре}.
+    Документ товара - название, описание и значения его характеристик (specs.ProductFeatures).
+    Результаты ранжируются по BM25, а поиск проходит только по спискам товаров
+    для слов запроса, поэтому не зависит от общего размера каталога так, как icontains
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.postings = {}    # слово -> {id товара: частота слова с учетом веса поля}
+        self.doc_terms = {}    # id товара -> слова товара (для удаления и переиндексации)
+        self.doc_lengths = {}    # id товара -> длина документа
+        self.total_length = 0
+
+    @classmethod
+    def build(cls):    # два запроса: товары и все значения характеристик
+        features = {}
+        for product_id, value in ProductFeatures.objects.values_list("product_id", "value").iterator():
+            features.setdefault(product_id, []).append(value)
+        index = cls()
+        for product_id, title, description in Product.objects.values_list("id", "title", "description").iterator():
+            index.add(product_id, title, description, features.get(product_id, ()))
+        return index
+
+    def add(self, product_id, title, description, feature_values):
+        self.remove(product_id)
+        terms = Counter()
+        for field, text in (("title", title), ("description", description), ("features", " ".join(feature_values))):
+            for term in tokenize(text):
+                terms[term] += FIELD_WEIGHTS[field]
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[product_id] = frequency
+        self.doc_terms[product_id] = list(terms)
+        self.doc_lengths[product_id] = sum(terms.values())
+        self.total_length += self.doc_lengths[product_id]
+
+    def remove(self, product_id):
+        for term in self.doc_terms.pop(product_id, ()):
+            postings = self.postings[term]
+            del postings[product_id]
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(product_id, 0)
+
+    def search(self, query):    # id товаров в порядке убывания релевантности
+        documents_count = len(self.doc_lengths)
+        if not documents_count:
+            return []
+        average_length = self.total_length / documents_count or 1
+        scores = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (documents_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for product_id, frequency in postings.items():
+                length_norm = 1 - self.b + self.b * self.doc_lengths[product_id] / average_length
+                scores[product_id] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        return [product_id for product_id, score in sorted(scores.items(), key=lambda item: (-item[1], -item[0]))]
+
+
+_index = None    # (версия, индекс), построенный в этом процессе
+_lock = threading.Lock()
+
+
+def get_search_index():    # индекс строится один раз и дальше обновляется сигналами
+    global _index
+    version = get_cache_version(SEARCH_CACHE)
+    with _lock:
+        if _index and _index[0] == version:
+            return _index[1]
+    index = SearchIndex.build()
+    with _lock:
+        _index = (version, index)
+    return index
+
+
+def search_products(query):
+    index = get_search_index()
+    with _lock:    # сигналы меняют словари индекса на месте (apply_search_change) - читать под той же блокировкой
+        return index.search(query)
+
+
+def apply_search_change(change):    # изменить построенный индекс или пометить его устаревшим (как specs.facets.apply_facet_change)
+    global _index
+    with _lock:
+        cached, _index = _index, None
+        old_version = get_cache_version(SEARCH_CACHE)
+        new_version = bump_cache_version(SEARCH_CACHE)
+        if cached and cached[0] == old_version and new_version == old_version + 1:
+            change(cached[1])
+            _index = (new_version, cached[1])
+
+
+def reindex_product(product_id):    # переиндексировать товар (товар и его характеристики перечитываются из бд)
+    if _index is None:    # в этом процессе индекс не построен - достаточно сменить версию
+        bump_cache_version(SEARCH_CACHE)
+        return
+    product = Product.objects.filter(id=product_id).values_list("title", "description").first()
+    if product is None:
+        apply_search_change(lambda index: index.remove(product_id))
+        return
+    feature_values = list(ProductFeatures.objects.filter(product_id=product_id).values_list("value", flat=True))
+    apply_search_change(lambda index: index.add(product_id, product[0], product[1], feature_values))
+
+
+def unindex_product(product_id):
+    apply_search_change(lambda index: index.remove(product_id))
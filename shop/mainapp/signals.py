@@ -0,0 +1,69 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .cache import bump_cache_version, bump_catalog_version
+from .context_processors import CATEGORY_NAV_CACHE
+from .images import schedule_renditions
+from .models import Category, Product
+from .prices import refresh_price_histogram
+from .search import reindex_product, unindex_product
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_nav(sender, **kwargs):    # категории изменились - меню нужно перечитать
+    bump_cache_version(CATEGORY_NAV_CACHE)
+
+
+@receiver(post_save, sender=Product)
+def update_search_index(sender, instance, **kwargs):    # индекс в памяти - после фиксации (при откате он остался бы измененным)
+    transaction.on_commit(partial(reindex_product, instance.id))
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_search_index(sender, instance, **kwargs):
+    transaction.on_commit(partial(unindex_product, instance.id))
+
+
+@receiver(pre_save, sender=Product)
+def remember_old_price(sender, instance, **kwargs):    # старые категория и цена - чтобы пересчитывать гистограмму только при их изменении
+    instance._old_price = None
+    if instance.pk:
+        instance._old_price = Product.objects.filter(pk=instance.pk).values_list("category_id", "price").first()
+
+
+@receiver(post_save, sender=Product)
+def update_price_histogram(sender, instance, **kwargs):
+    old_price = getattr(instance, "_old_price", None)
+    if old_price == (instance.category_id, instance.price):
+        return
+    transaction.on_commit(partial(refresh_price_histogram, instance.category_id))    # до фиксации другие соединения видят старые цены
+    if old_price and old_price[0] != instance.category_id:    # товар перенесен из другой категории
+        transaction.on_commit(partial(refresh_price_histogram, old_price[0]))
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_price_histogram(sender, instance, **kwargs):
+    transaction.on_commit(partial(refresh_price_histogram, instance.category_id))
+
+
+@receiver(pre_save, sender=Product)
+def reset_renditions_ready(sender, instance, **kwargs):    # изображение заменено - копии прежнего не подходят
+    if instance.pk and instance.renditions_ready:
+        old_image = Product.objects.filter(pk=instance.pk).values_list("image", flat=True).first()
+        if old_image != instance.image.name:
+            instance.renditions_ready = False
+
+
+@receiver(post_save, sender=Product)
+def create_image_renditions(sender, instance, **kwargs):    # новое изображение - создаем уменьшенные копии в фоне
+    if instance.image and not instance.renditions_ready:
+        schedule_renditions(instance.image.name)
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_catalog_pages(sender, **kwargs):    # новая версия каталога - новые ETag и ключи кеша страниц
+    transaction.on_commit(bump_catalog_version)
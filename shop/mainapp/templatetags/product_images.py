@@ -0,0 +1,37 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html, format_html_join
+
+from ..images import RENDITION_FORMATS, RENDITION_WIDTHS, rendition_name
+
+
+register = template.Library()
+
+CARD_SIZES = "(min-width: 992px) 240px, (min-width: 768px) 330px, 100vw"    # ширина карточки товара в сетке bootstrap
+
+
+def build_srcset(image_name, extension):
+    return ", ".join(
+        f"{default_storage.url(rendition_name(image_name, width, extension))} {width}w" for width in RENDITION_WIDTHS
+    )
+
+
+@register.simple_tag
+def product_image(product, css_class="", sizes=CARD_SIZES):
+    """
+    Изображение товара с адаптивными копиями (<picture> с WebP и srcset/sizes) -
+    браузер сам выбирает копию подходящей ширины вместо оригинала.
+    Пока копии не созданы (Product.renditions_ready), выводится оригинал
+    """
+    name = product.image.name
+    if not name or not product.renditions_ready:
+        return format_html('<img class="{}" src="{}" alt="{}">', css_class, product.image.url if name else "", product.title)
+    sources = format_html_join(
+        "", '<source type="image/{}" srcset="{}" sizes="{}">',
+        ((extension, build_srcset(name, extension), sizes) for image_format, extension in RENDITION_FORMATS[1:])
+    )
+    return format_html(
+        '<picture>{}<img class="{}" src="{}" srcset="{}" sizes="{}" alt="{}" loading="lazy"></picture>',
+        sources, css_class, default_storage.url(rendition_name(name, RENDITION_WIDTHS[0], "jpg")),
+        build_srcset(name, "jpg"), sizes, product.title
+    )
@@ -1 +1,13 @@
 # Кастомный тег шаблона (фильтр)
+from django import template
+from django.utils.safestring import mark_safe
+
+from specs.tables import render_spec_table
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def product_spec(product):    # таблица характеристик товара (одна для всех категорий, из кеша)
+    return mark_safe(render_spec_table(product))
@@ -1,41 +1,80 @@
+import asyncio
+import json
+import shutil
+import sqlite3
+import tempfile
+from datetime import timedelta
 from decimal import Decimal
 from unittest import mock    # эмитирует что угодно (внешнее апи и т.д)
-from django.test import TestCase, RequestFactory, Client
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, RequestFactory, Client, AsyncClient, override_settings
 from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.messages.storage.fallback import FallbackStorage
+from io import BytesIO, StringIO
+from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from urllib.parse import quote
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+from PIL import Image
 
+from specs.models import CategoryFeature, FeatureValidator, FeatureValueCount, ProductFeatures
 
-from .models import Category, Notebook, CartProduct, Cart, Customer
-from .views import recalc_cart, AddToCartView, BaseView
+
+from .models import Category, Product, CartProduct, Cart, Customer, Order
+from .views import AddToCartView, BaseView
+from .utils import (
+    recalc_cart, update_cart_totals, save_order_with_items, reserve_stock, OutOfStock,
+    sorted_keyset_paginate, get_sorted_cursor, PRODUCT_SORTS,
+)
+from .mixins import ANONYMOUS_CART_SESSION_KEY
+from .middleware import QueryCollector
+from .images import generate_renditions, has_renditions, mark_renditions_ready, rendition_name, RENDITION_WIDTHS
+from .templatetags.product_images import product_image
+from .async_queries import run_query
+from .metrics import current_collector
+from .management.commands.bench_asgi import catalog_views
+from .management.commands.check_query_plans import full_scans
+from .db import close_unusable_connections, set_sqlite_journal_mode
+from .testing import capture_on_commit_callbacks
+from .prices import build_price_histogram, get_price_histogram
+from .backends.sqlite3.base import DatabaseWrapper as SqliteDatabaseWrapper
 
 
 User = get_user_model()
+TEMP_MEDIA_ROOT = tempfile.mkdtemp()    # загруженные в тестах изображения не попадают в media проекта
+
+
+def tearDownModule():
+    shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
 
 
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class ShopTestCases(TestCase):
     def setUp(self) -> None:    # метод для предварительных настроек тестирования (создаются объекты которые будут использоватся в тестах)
         self.user = User.objects.create(username="testuser", password="password")
         self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
         image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")    # создаем имитацию изображения
-        self.notebook = Notebook.objects.create(
+        self.notebook = Product.objects.create(
             category=self.category,
             title="test_noutbook",
             slug="test-slug",
             image=image,
             price=Decimal("50000.00"),
-            diagonal="17.3",
-            display_type="IPS",
-            processor_freq="3.4 GHz",
-            ram="6 Gb",
-            video="GeForce GTX",
-            time_without_charge="10 hours"
         )
         self.customer = Customer.objects.create(user=self.user, phone="1234567890", address="Address")
         self.cart = Cart.objects.create(owner=self.customer)
         self.cart_product = CartProduct.objects.create(
             user=self.customer,
             cart=self.cart,
-            content_object = self.notebook
+            product=self.notebook
         )
 
     def test_add_to_cart(self):    # каждому методу добавлять префикс <test> (тест 1 - добавление товара в корзину (топорно))
@@ -51,7 +90,9 @@ class ShopTestCases(TestCase):
         factory = RequestFactory()
         request = factory.get("")
         request.user = self.user
-        response = AddToCartView.as_view()(request, ct_model="notebook", slug="test-slug")
+        SessionMiddleware(lambda r: None).process_request(request)    # сессия и сообщения, которых у RequestFactory нет
+        request._messages = FallbackStorage(request)
+        response = AddToCartView.as_view()(request, slug="test-slug")
         self.assertEqual(response.status_code, 302)    # проверка - ответ от сервера статус-302
         self.assertEqual(response.url, "/cart/")    # проверка - url /cart/
 
@@ -64,3 +105,1016 @@ class ShopTestCases(TestCase):
             response = BaseView.as_view()(request)
             self.assertEqual(response.status_code, 444)    # проверка
             print("Вызван ",mock_data_.called)    # проверка - была ли вызвана mock_data_
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class AnonymousCartTestCases(TestCase):
+    def setUp(self) -> None:
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")
+        self.product = Product.objects.create(
+            category=category, title="test_noutbook", slug="test-slug", image=image, price=Decimal("100.00")
+        )
+
+    def test_cart_not_created_on_read(self):    # просмотр страниц не создает корзину
+        self.client.get("/cart/")
+        self.assertFalse(Cart.objects.exists())
+
+    def test_each_visitor_gets_own_cart(self):    # у разных посетителей разные корзины
+        first, second = Client(), Client()
+        first.get("/add-to-cart/test-slug/")
+        second.get("/add-to-cart/test-slug/")
+        first_cart_id = first.session[ANONYMOUS_CART_SESSION_KEY]
+        second_cart_id = second.session[ANONYMOUS_CART_SESSION_KEY]
+        self.assertNotEqual(first_cart_id, second_cart_id)
+        self.assertEqual(Cart.objects.get(id=first_cart_id).total_product, 1)
+        self.assertEqual(Cart.objects.get(id=second_cart_id).total_product, 1)
+
+    def test_cart_merged_on_login(self):    # при входе товары переходят в корзину покупателя
+        user = User.objects.create(username="buyer")
+        user.set_password("password")
+        user.save()
+        customer = Customer.objects.create(user=user)
+        cart = Cart.objects.create(owner=customer)
+        cart_product = CartProduct.objects.create(user=customer, cart=cart, product=self.product, qty=2)
+        cart.products.add(cart_product)
+
+        self.client.get("/add-to-cart/test-slug/")
+        anonymous_cart_id = self.client.session[ANONYMOUS_CART_SESSION_KEY]
+        self.client.post("/login/", {"username": "buyer", "password": "password"})
+
+        cart.refresh_from_db()
+        self.assertFalse(Cart.objects.filter(id=anonymous_cart_id).exists())
+        self.assertEqual(cart.products.get().qty, 3)
+        self.assertEqual(cart.final_price, Decimal("300.00"))
+        self.assertNotIn(ANONYMOUS_CART_SESSION_KEY, self.client.session)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CartResolverTestCases(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(username="buyer")
+        self.client.force_login(self.user)
+
+    def get_cart_queries(self, url):    # запросы к таблицам покупателей и корзин
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        return [q["sql"] for q in context.captured_queries if "mainapp_cart" in q["sql"] or "mainapp_customer" in q["sql"]]
+
+    def test_read_pages_do_not_create_rows(self):    # просмотр страниц не создает покупателя и корзину
+        self.client.get("/")
+        self.client.get("/cart/")
+        self.assertFalse(Customer.objects.exists())
+        self.assertFalse(Cart.objects.exists())
+
+    def test_no_cart_queries_after_first_request(self):    # id покупателя и корзины закешированы в сессии
+        self.assertTrue(self.get_cart_queries("/"))
+        self.assertEqual(self.get_cart_queries("/"), [])
+
+    def test_cart_created_on_first_mutation(self):
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")
+        Product.objects.create(category=category, title="test", slug="test-slug", image=image, price=Decimal("10.00"))
+        self.client.get("/")
+        self.client.get("/add-to-cart/test-slug/")
+        cart = Cart.objects.get(owner__user=self.user)
+        self.assertEqual(cart.total_product, 1)
+        self.assertEqual(len(self.get_cart_queries("/")), 1)    # только загрузка самой корзины
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CartTotalsTestCases(TestCase):
+    def setUp(self) -> None:
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")
+        Product.objects.create(category=category, title="first", slug="first", image=image, price=Decimal("10.00"))
+        Product.objects.create(category=category, title="second", slug="second", image=image, price=Decimal("25.00"))
+
+    def get_cart(self):
+        return Cart.objects.get(id=self.client.session[ANONYMOUS_CART_SESSION_KEY])
+
+    def test_totals_follow_cart_changes(self):    # итоги сдвигаются на разницу при каждом действии
+        self.client.get("/add-to-cart/first/")
+        self.client.get("/add-to-cart/second/")
+        self.client.get("/add-to-cart/second/")    # повторное добавление ничего не меняет
+        cart = self.get_cart()
+        self.assertEqual((cart.total_product, cart.final_price), (2, Decimal("35.00")))
+
+        self.client.post("/change-qty/first/", {"qty": 3})
+        cart = self.get_cart()
+        self.assertEqual((cart.total_product, cart.final_price), (2, Decimal("55.00")))
+
+        self.client.get("/remove-from-cart/second/")
+        cart = self.get_cart()
+        self.assertEqual((cart.total_product, cart.final_price), (1, Decimal("30.00")))
+
+    def test_change_qty_rejects_non_positive(self):    # нулевое или некорректное количество не меняет корзину
+        self.client.get("/add-to-cart/first/")
+        for qty in ("0", "-2", "abc"):
+            with self.subTest(qty=qty):
+                self.assertRedirects(self.client.post("/change-qty/first/", {"qty": qty}), "/cart/", fetch_redirect_response=False)
+                self.assertEqual(CartProduct.objects.get().qty, 1)
+        self.assertEqual(self.get_cart().final_price, Decimal("10.00"))
+
+    def test_reconcile_repairs_totals(self):
+        self.client.get("/add-to-cart/first/")
+        Cart.objects.update(final_price=Decimal("999.00"), total_product=7)    # итоги разошлись с товарами
+        empty_cart = Cart.objects.create(final_price=Decimal("5.00"), total_product=1)
+
+        out = StringIO()
+        call_command("reconcile_cart_totals", "--dry-run", stdout=out)
+        self.assertIn("найдено расхождений: 2", out.getvalue())
+        self.assertEqual(self.get_cart().final_price, Decimal("999.00"))
+
+        call_command("reconcile_cart_totals", "--chunk-size", "1", stdout=StringIO())
+        cart = self.get_cart()
+        self.assertEqual((cart.total_product, cart.final_price), (1, Decimal("10.00")))
+        empty_cart.refresh_from_db()
+        self.assertEqual((empty_cart.total_product, empty_cart.final_price), (0, Decimal("0.00")))
+
+
+class CategoryNavTestCases(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        Category.objects.create(name="Ноутбуки", slug="notebooks")
+
+    def get_category_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/cart/")
+        return response, [q["sql"] for q in context.captured_queries if "mainapp_category" in q["sql"]]
+
+    def test_category_nav_is_cached(self):
+        response, queries = self.get_category_queries()
+        self.assertContains(response, "Ноутбуки")
+        self.assertEqual(len(queries), 1)
+        response, queries = self.get_category_queries()
+        self.assertContains(response, "Ноутбуки")
+        self.assertEqual(queries, [])
+
+    def test_category_nav_invalidated_on_change(self):
+        self.get_category_queries()
+        Category.objects.create(name="Смартфоны", slug="smartphones")
+        response, queries = self.get_category_queries()
+        self.assertContains(response, "Смартфоны")
+        Category.objects.get(slug="notebooks").delete()
+        response, queries = self.get_category_queries()
+        self.assertNotContains(response, "Ноутбуки")
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class ProductListingTestCases(TestCase):
+    def setUp(self) -> None:
+        cache.clear()    # версия каталога в TestCase не меняется - страница могла остаться от другого теста
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")
+        for i in range(15):
+            Product.objects.create(
+                category=self.category, title=f"product-{i}", slug=f"product-{i}",
+                image=image, price=Decimal("10.00"), description="x" * 1000
+            )
+
+    def test_keyset_pages_cover_catalog(self):    # страницы идут по курсору без пропусков и повторов
+        response = self.client.get("/")
+        first_page = response.context["products"]
+        self.assertEqual(len(first_page), 12)
+        self.assertEqual(first_page[0].title, "product-14")
+        response = self.client.get(f"/?after={response.context['next_cursor']}")
+        titles = [product.title for product in response.context["products"]]
+        self.assertEqual(titles, ["product-2", "product-1", "product-0"])
+        self.assertIsNone(response.context["next_cursor"])
+
+    def test_category_listing_is_paginated(self):
+        response = self.client.get("/category/notebooks/")
+        self.assertEqual(len(response.context["category_products"]), 12)
+        self.assertIsNotNone(response.context["next_cursor"])
+
+    def test_listing_does_not_load_full_description(self):    # полное описание из бд не читается
+        with CaptureQueriesContext(connection) as context:
+            self.client.get("/")
+        product_queries = [q["sql"] for q in context.captured_queries if 'FROM "mainapp_product"' in q["sql"]]
+        self.assertEqual(len(product_queries), 1)
+        self.assertIn("SUBSTR", product_queries[0].upper())
+        self.assertNotIn('"mainapp_product"."description"', product_queries[0].split("SUBSTR")[0])
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class SearchTestCases(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")
+        self.lenovo = Product.objects.create(
+            category=self.category, title="Ноутбук Lenovo", slug="lenovo", image=image,
+            price=Decimal("10.00"), description="Легкий ноутбук"
+        )
+        self.asus = Product.objects.create(
+            category=self.category, title="Asus Vivobook", slug="asus", image=image,
+            price=Decimal("10.00"), description="Подходит как замена для Lenovo"
+        )
+
+    def search(self, query):
+        response = self.client.get("/search/", {"q": query})
+        return [product.slug for product in response.context["products"]]
+
+    def test_title_ranked_above_description(self):
+        self.assertEqual(self.search("lenovo"), ["lenovo", "asus"])
+        self.assertEqual(self.search("vivobook"), ["asus"])
+        self.assertEqual(self.search("macbook"), [])
+
+    def test_index_follows_changes(self):    # индекс обновляется сигналами
+        self.search("lenovo")    # индекс построен
+        self.asus.title = "Asus Zenbook"
+        with capture_on_commit_callbacks():
+            self.asus.save()
+        self.assertEqual(self.search("zenbook"), ["asus"])
+        self.assertEqual(self.search("vivobook"), [])
+        feature = CategoryFeature.objects.create(category=self.category, feature_name="Экран", feature_filter_name="Экран")
+        with capture_on_commit_callbacks():
+            ProductFeatures.objects.create(product=self.lenovo, feature=feature, value="OLED")
+        self.assertEqual(self.search("oled"), ["lenovo"])
+        with capture_on_commit_callbacks():
+            self.lenovo.delete()
+        self.assertEqual(self.search("lenovo"), ["asus"])
+
+    def test_rolled_back_change_not_indexed(self):
+        self.search("lenovo")
+        try:
+            with transaction.atomic():
+                self.asus.title = "Asus Zenbook"
+                self.asus.save()
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertEqual(self.search("zenbook"), [])
+        self.assertEqual(self.search("vivobook"), ["asus"])
+
+    def test_results_are_paginated(self):
+        image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")
+        for i in range(15):
+            Product.objects.create(category=self.category, title=f"Acer {i}", slug=f"acer-{i}", image=image, price=Decimal("1.00"))
+        response = self.client.get("/search/", {"q": "acer", "page": 2})
+        self.assertEqual(len(response.context["products"]), 3)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class ImageRenditionsTestCases(TestCase):
+    def setUp(self) -> None:
+        buffer = BytesIO()
+        Image.new("RGB", (1200, 800), "red").save(buffer, "JPEG")
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        image = SimpleUploadedFile("photo.jpg", content=buffer.getvalue(), content_type="image/jpeg")
+        self.product = Product.objects.create(category=category, title="test", slug="test", image=image, price=Decimal("1.00"))
+
+    def test_renditions_and_srcset(self):
+        self.assertNotIn("srcset", product_image(self.product))    # копий еще нет - выводится оригинал
+        self.assertTrue(generate_renditions(self.product.image.name))
+        self.assertFalse(generate_renditions(self.product.image.name))    # повторно не создаются
+        with default_storage.open(rendition_name(self.product.image.name, RENDITION_WIDTHS[0], "jpg")) as file:
+            self.assertEqual(Image.open(file).size, (320, 213))
+        self.assertNotIn("srcset", product_image(self.product))    # товар еще не отмечен
+        self.assertEqual(mark_renditions_ready([self.product.image.name]), 1)
+        self.product.refresh_from_db()
+        html = product_image(self.product, "card-img-top")
+        self.assertIn("_320.jpg 320w", html)
+        self.assertIn("_960.jpg 960w", html)
+        self.assertIn("sizes=", html)
+
+    def test_backfill_command(self):
+        out = StringIO()
+        call_command("generate_renditions", "--workers", "1", stdout=out)
+        self.assertTrue(has_renditions(self.product.image.name))
+        self.assertIn("обработано: 1", out.getvalue())
+        self.product.refresh_from_db()
+        self.assertTrue(self.product.renditions_ready)
+
+    def test_listing_does_not_check_storage(self):    # наличие копий - из флага товара, а не из файлов
+        generate_renditions(self.product.image.name)
+        mark_renditions_ready([self.product.image.name])
+        cache.clear()
+        with mock.patch("django.core.files.storage.FileSystemStorage.exists") as exists:
+            response = self.client.get("/")
+        self.assertContains(response, "_320.jpg 320w")
+        exists.assert_not_called()
+
+    def test_new_image_resets_flag(self):
+        mark_renditions_ready([self.product.image.name])
+        self.product.refresh_from_db()
+        self.product.image = SimpleUploadedFile("other.jpg", content=b"", content_type="image/jpeg")
+        with mock.patch("mainapp.signals.schedule_renditions") as schedule_renditions:
+            self.product.save()
+        self.assertFalse(Product.objects.get(id=self.product.id).renditions_ready)
+        schedule_renditions.assert_called_once_with(self.product.image.name)
+
+
+class MetricsTestCases(TestCase):
+    def test_metrics_endpoint(self):
+        self.client.get("/cart/")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('shop_request_duration_seconds_bucket{view="mainapp:cart",method="GET",status="2xx",le="+Inf"}', body)
+        self.assertIn('shop_db_queries_per_request_count{view="mainapp:cart"}', body)
+
+    def test_metrics_forbidden_outside_internal_ips(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.1").status_code, 403)
+
+    def test_duplicate_queries_detected(self):    # один и тот же запрос в цикле - подозрение на N+1
+        collector = QueryCollector()
+        with connection.execute_wrapper(collector):
+            for i in range(5):
+                list(Category.objects.filter(id=i))
+            list(Product.objects.all())
+        self.assertEqual(collector.count, 6)
+        self.assertEqual(len(collector.duplicates(5)), 1)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class ImportCatalogTestCases(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.ram = CategoryFeature.objects.create(category=self.category, feature_name="Память", feature_filter_name="Память")
+        FeatureValidator.objects.create(category=self.category, feature_key=self.ram, valid_feature_value="8")
+        FeatureValidator.objects.create(category=self.category, feature_key=self.ram, valid_feature_value="16")
+        self.source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source_dir, ignore_errors=True)
+
+    def write(self, name, content):
+        path = f"{self.source_dir}/{name}"
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(content)
+        return path
+
+    def run_import(self, path, *args):
+        out, err = StringIO(), StringIO()
+        call_command("import_catalog", path, "--batch-size", "2", *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_import_creates_and_updates(self):
+        Image.new("RGB", (400, 300), "blue").save(f"{self.source_dir}/a.jpg", "JPEG")
+        path = self.write("catalog.csv", (
+            "category,slug,title,price,description,image,feature:Память\n"
+            "notebooks,a,Ноутбук A,10.50,Описание,a.jpg,8\n"
+            "notebooks,b,Ноутбук B,20,,,16\n"
+            "notebooks,c,Ноутбук C,30,,,12\n"    # недопустимое значение характеристики
+            "phones,d,Телефон,40,,,\n"    # неизвестная категория
+        ))
+        out, err = self.run_import(path, "--images-dir", self.source_dir)
+        self.assertIn("Создано: 2, обновлено: 0, ошибок: 2", out)
+        self.assertIn("Строка 3", err)
+        self.assertIn("Строка 4", err)
+        a = Product.objects.get(slug="a")
+        self.assertEqual(a.price, Decimal("10.50"))
+        self.assertTrue(default_storage.exists(a.image.name))
+        self.assertTrue(has_renditions(a.image.name))
+        self.assertTrue(a.renditions_ready)
+        self.assertEqual(FeatureValueCount.objects.get(feature=self.ram, value="8").product_count, 1)
+
+        path = self.write("update.csv", "category,slug,title,price,description,image,feature:Память\nnotebooks,b,Ноутбук B2,25,,,8\n")
+        out, err = self.run_import(path)
+        self.assertIn("Создано: 0, обновлено: 1", out)
+        b = Product.objects.get(slug="b")
+        self.assertEqual(b.title, "Ноутбук B2")
+        self.assertEqual(ProductFeatures.objects.get(product=b).value, "8")
+        self.assertEqual(FeatureValueCount.objects.get(feature=self.ram, value="8").product_count, 2)
+        self.assertFalse(FeatureValueCount.objects.filter(feature=self.ram, value="16").exists())
+
+    def test_jsonl_import_refreshes_search(self):
+        self.client.get("/search/", {"q": "zenbook"})    # индекс построен до импорта
+        path = self.write("catalog.jsonl", "\n".join([
+            '{"category": "notebooks", "slug": "z1", "title": "Asus Zenbook", "price": "10", "features": {"Память": "8"}}',
+            '{"category": "notebooks", "slug": "z2", "title": "Asus Zenbook Pro", "price": "20"}',
+            '{"category": "notebooks", "slug": "z3", "title": "Asus Zenbook Duo", "price": "30"}',
+        ]))
+        out, err = self.run_import(path)
+        self.assertIn("Создано: 3", out)
+        response = self.client.get("/search/", {"q": "zenbook"})
+        self.assertEqual(len(response.context["products"]), 3)
+
+    def test_bad_jsonl_lines_are_row_errors(self):    # остальные строки импортируются, производные данные пересчитаны
+        path = self.write("catalog.jsonl", "\n".join([
+            '{"category": "notebooks", "slug": "ok", "title": "Asus Zenbook", "price": "10", "features": {"Память": "8"}}',
+            '{"category": "notebooks", "slug": "broken", ',
+            '["not", "an", "object"]',
+            '{"category": "notebooks", "slug": "f", "title": "F", "price": "10", "features": ["8"]}',
+            '{"category": "notebooks", "slug": "nan", "title": "NaN", "price": "NaN"}',
+            '{"category": "notebooks", "slug": "big", "title": "Big", "price": "123456789"}',
+            '{"category": "notebooks", "slug": "ok2", "title": "Asus Zenbook Pro", "price": "20"}',
+        ]))
+        out, err = self.run_import(path)
+        self.assertIn("Создано: 2, обновлено: 0, ошибок: 5", out)
+        self.assertIn("строка 2 файла - некорректный JSON", err)
+        self.assertEqual(set(Product.objects.values_list("slug", flat=True)), {"ok", "ok2"})
+        self.assertEqual(FeatureValueCount.objects.get(feature=self.ram, value="8").product_count, 1)
+
+
+class ExportTestCases(TestCase):
+    def setUp(self) -> None:
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        ram = CategoryFeature.objects.create(category=category, feature_name="Память", feature_filter_name="Память")
+        self.products = [
+            Product.objects.create(category=category, title=f"Ноутбук {i}", slug=f"n{i}", image="", price=Decimal("10.00"))
+            for i in range(5)
+        ]
+        ProductFeatures.objects.create(product=self.products[0], feature=ram, value="8")
+        self.staff = User.objects.create_user(username="staff", password="password", is_staff=True)
+        customer = Customer.objects.create(user=self.staff, phone="1234567890")
+        cart = Cart.objects.create(owner=customer, in_order=True)
+        for product in self.products[:2]:
+            CartProduct.objects.create(user=customer, cart=cart, product=product, qty=2)
+        save_order_with_items(Order(customer=customer, first_name="Имя", last_name="Фамилия", phone="1234567890"), cart)
+
+    def test_products_command_in_chunks(self):
+        out = StringIO()
+        with CaptureQueriesContext(connection) as context:
+            call_command("export_catalog", "products", "--format", "jsonl", "--chunk-size", "2", stdout=out)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([record["slug"] for record in records], [f"n{i}" for i in range(5)])
+        self.assertEqual(records[0]["category"], "notebooks")
+        self.assertEqual(records[0]["features"], {"Память": "8"})
+        self.assertEqual(len(context.captured_queries), 7)    # 3 пачки товаров + их характеристики + пустая пачка
+
+    def test_orders_endpoint_streams_csv(self):
+        self.assertEqual(self.client.get("/export/orders/").status_code, 403)
+        self.client.login(username="staff", password="password")
+        response = self.client.get("/export/orders/")
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)    # заголовок и две позиции заказа
+        self.assertIn("n0,Ноутбук 0,10.00,2,20.00", lines[1])
+        self.assertEqual(self.client.get("/export/users/").status_code, 404)
+
+
+class OrderHistoryTestCases(TestCase):
+    def setUp(self) -> None:
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.products = [
+            Product.objects.create(category=self.category, title=f"Ноутбук {i}", slug=f"n{i}", image="", price=Decimal("10.00"))
+            for i in range(3)
+        ]
+        self.user = User.objects.create_user(username="buyer", password="password")
+        Customer.objects.create(user=self.user, phone="1234567890")
+        self.client.login(username="buyer", password="password")
+
+    def make_order(self, qty=1):
+        for product in self.products:
+            self.client.get(f"/add-to-cart/{product.slug}/")
+        self.client.post(f"/change-qty/{self.products[0].slug}/", {"qty": qty})
+        return self.checkout()
+
+    def checkout(self):
+        return self.client.post("/make-order/", {
+            "first_name": "Имя", "last_name": "Фамилия", "phone": "1234567890", "address": "",
+            "buying_type": "self", "order_date": "2030-01-01", "comment": "",
+        })
+
+    def test_checkout_snapshots_items(self):
+        self.make_order(qty=2)
+        order = Order.objects.get()
+        self.assertEqual(order.total_products, 3)
+        self.assertEqual(order.final_price, Decimal("40.00"))
+        item = order.items.get(product=self.products[0])
+        self.assertEqual((item.title, item.price, item.qty, item.final_price), ("Ноутбук 0", Decimal("10.00"), 2, Decimal("20.00")))
+        Product.objects.filter(id=self.products[0].id).update(title="Переименован", price=Decimal("99.00"))
+        self.products[1].delete()
+        response = self.client.get("/profile/")
+        self.assertContains(response, "Ноутбук 0 x 2")    # в истории - цены и названия на момент заказа
+        self.assertContains(response, "Ноутбук 1 x 1")
+        self.assertContains(response, "40,00 грн.")    # USE_L10N, ru
+
+    def test_checkout_keeps_cart_prices(self):    # цена изменилась после добавления в корзину - в заказе цена из корзины
+        for product in self.products:
+            self.client.get(f"/add-to-cart/{product.slug}/")
+        self.client.post(f"/change-qty/{self.products[0].slug}/", {"qty": 2})
+        Product.objects.filter(id=self.products[0].id).update(price=Decimal("15.00"))
+        self.checkout()
+        item = Order.objects.get().items.get(product=self.products[0])
+        self.assertEqual((item.price, item.qty, item.final_price), (Decimal("10.00"), 2, Decimal("20.00")))
+
+    def test_profile_queries_do_not_grow_with_orders(self):
+        def profile_queries():
+            self.client.get("/profile/")    # прогрев: кеш навигации по категориям, сессия после оформления заказа
+            with CaptureQueriesContext(connection) as context:
+                self.client.get("/profile/")
+            return len(context.captured_queries)
+
+        self.make_order()
+        queries = profile_queries()
+        for _ in range(3):
+            self.make_order()
+        self.assertEqual(profile_queries(), queries)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class AsyncCatalogViewsTestCases(TransactionTestCase):    # выборки async представлений идут из других потоков - нужны зафиксированные данные
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        feature = CategoryFeature.objects.create(category=self.category, feature_name="Память", feature_filter_name="Память")
+        for i in range(3):
+            product = Product.objects.create(
+                category=self.category, title=f"Ноутбук {i}", slug=f"n{i}", image=f"mainapp/n{i}.jpg", price=Decimal("10.00")
+            )
+            ProductFeatures.objects.create(product=product, feature=feature, value=str(i))
+        call_command("rebuild_facet_counts", stdout=StringIO())
+        self.feature = feature
+
+    async def test_async_views_render_catalog(self):
+        client = AsyncClient()
+        with catalog_views(True):
+            match = await sync_to_async(resolve)("/")
+            self.assertTrue(asyncio.iscoroutinefunction(match.func))
+            response = await client.get("/")
+            self.assertContains(response, "Ноутбук 2")
+            self.assertContains(response, "Ноутбуки")    # меню категорий
+            response = await client.get("/products/n1/")
+            self.assertContains(response, "Ноутбук 1")
+            response = await client.get(f"/category/notebooks/?f{self.feature.id}=1")    # AsyncClient в 3.1 не передает data в GET
+            self.assertEqual([p.slug for p in response.context["category_products"]], ["n1"])
+            self.assertEqual((await client.get("/products/missing/")).status_code, 404)
+        self.assertFalse(asyncio.iscoroutinefunction(resolve("/").func))    # маршруты вернулись к синхронным
+
+    async def test_queries_from_worker_threads_are_collected(self):
+        collector = QueryCollector()
+        token = current_collector.set(collector)
+        try:
+            await asyncio.gather(run_query(lambda: list(Category.objects.all())), run_query(lambda: list(Product.objects.all())))
+        finally:
+            current_collector.reset(token)
+        self.assertEqual(collector.count, 2)
+
+    async def test_worker_connection_not_closed_after_query(self):
+        with mock.patch("mainapp.async_queries.close_old_connections") as close_old_connections:
+            await run_query(lambda: list(Category.objects.all()))
+        self.assertEqual(close_old_connections.call_count, 1)    # только проверка перед выборкой
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CatalogPageCacheTestCases(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.product = Product.objects.create(
+            category=self.category, title="Ноутбук Lenovo", slug="lenovo", image="mainapp/lenovo.jpg", price=Decimal("10.00")
+        )
+
+    def test_not_modified_until_catalog_changes(self):
+        response = self.client.get("/")
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+        self.assertEqual(self.client.get("/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.product.title = "Ноутбук Asus"
+        with capture_on_commit_callbacks():
+            self.product.save()
+        response = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_page_served_from_cache(self):
+        self.client.get(f"/products/{self.product.slug}/")
+        Product.objects.filter(id=self.product.id).update(title="Без сигнала")    # версия каталога не меняется
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"/products/{self.product.slug}/")
+        self.assertContains(response, "Ноутбук Lenovo")
+        self.assertEqual(len(context.captured_queries), 0)    # без сессии - ни одного запроса
+        self.product.refresh_from_db()
+        with capture_on_commit_callbacks():
+            self.product.save()
+        self.assertContains(self.client.get(f"/products/{self.product.slug}/"), "Без сигнала")
+
+    def test_unrelated_params_share_cached_page(self):    # utm метки и т.п. не создают отдельных записей кеша
+        response = self.client.get("/category/notebooks/?utm_source=mail&sort=price")
+        self.assertEqual(response.context["filter_query"], "sort=price")
+        with CaptureQueriesContext(connection) as context:
+            self.client.get("/category/notebooks/?sort=price&fbclid=1")
+        self.assertEqual(len(context.captured_queries), 0)
+        with CaptureQueriesContext(connection) as context:
+            self.client.get("/category/notebooks/?sort=title")
+        self.assertTrue(context.captured_queries)    # другая сортировка - другая страница
+
+    def test_cart_badge_is_filled_per_visitor(self):
+        self.client.get("/")    # страница в кеше с пустой корзиной
+        buyer = Client()
+        buyer.get(f"/add-to-cart/{self.product.slug}/")
+        response = buyer.get("/")
+        self.assertContains(response, "data-cart-badge>1</span>")
+        self.assertFalse(response.has_header("Last-Modified"))
+        self.assertContains(self.client.get("/"), "data-cart-badge>0</span>")
+
+    def test_authenticated_pages_not_cached(self):
+        User.objects.create_user(username="buyer", password="password")
+        self.client.login(username="buyer", password="password")
+        self.assertFalse(self.client.get("/").has_header("ETag"))
+
+
+class QueryPlansTestCases(TestCase):
+
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command("check_query_plans", stdout=out)
+        self.assertIn("все используют индексы", out.getvalue())
+
+    def test_full_scan_detected(self):
+        self.assertEqual(full_scans("sqlite", "2 0 0 SCAN mainapp_cart"), ["mainapp_cart"])
+        self.assertEqual(full_scans("sqlite", "3 0 0 SCAN mainapp_cart USING INDEX cart_anonymous_idx"), [])
+        self.assertEqual(full_scans("postgresql", "Seq Scan on mainapp_order  (cost=0.00..1.01)"), ["mainapp_order"])
+
+    def test_duplicate_cart_product_rejected(self):
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        product = Product.objects.create(category=category, title="Ноутбук", slug="notebook", price=Decimal("10.00"))
+        customer = Customer.objects.create(user=User.objects.create_user(username="buyer"))
+        cart = Cart.objects.create(owner=customer)
+        CartProduct.objects.create(user=customer, cart=cart, product=product, final_price=product.price)
+        with self.assertRaises(IntegrityError):
+            CartProduct.objects.create(user=customer, cart=cart, product=product, final_price=product.price)
+
+
+class DatabaseProfileTestCases(TestCase):
+
+    def test_sqlite_pragmas_applied(self):
+        connection.ensure_connection()
+        self.assertEqual(connection.connection.execute("PRAGMA synchronous").fetchone()[0], 1)    # NORMAL
+        self.assertEqual(
+            connection.connection.execute("PRAGMA busy_timeout").fetchone()[0], settings.SQLITE_PRAGMAS["busy_timeout"]
+        )
+
+    def test_journal_mode_set_only_by_command(self):    # режим журнала хранится в файле - соединение его не меняет
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        wrapper = SqliteDatabaseWrapper(dict(connection.settings_dict, NAME=f"{directory}/db.sqlite3", OPTIONS={}))
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()    # connection_created - PRAGMA соединения
+        self.assertEqual(wrapper.connection.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        self.assertEqual(set_sqlite_journal_mode(wrapper), "wal")
+        with self.assertRaisesMessage(CommandError, "memory"):    # тестовая бд в памяти - режим не меняется
+            call_command("sqlite_journal_mode", stdout=StringIO())
+
+    def test_immediate_transaction_takes_write_lock(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = f"{directory}/db.sqlite3"
+        wrapper = SqliteDatabaseWrapper(dict(connection.settings_dict, NAME=path, OPTIONS={"transaction_mode": "IMMEDIATE"}))
+        wrapper.ensure_connection()
+        self.addCleanup(wrapper.close)
+        wrapper._start_transaction_under_autocommit()    # как в начале transaction.atomic
+        other = sqlite3.connect(path, timeout=0, isolation_level=None)
+        self.addCleanup(other.close)
+        with self.assertRaisesMessage(sqlite3.OperationalError, "locked"):
+            other.execute("BEGIN IMMEDIATE")    # вторая запись не начнется, пока первая транзакция не завершится
+
+    def test_unusable_persistent_connection_closed(self):
+        broken = mock.Mock(settings_dict={"CONN_HEALTH_CHECKS": True}, connection=object(), in_atomic_block=False)
+        broken.is_usable.return_value = False
+        alive = mock.Mock(settings_dict={"CONN_HEALTH_CHECKS": True}, connection=object(), in_atomic_block=False)
+        alive.is_usable.return_value = True
+        with mock.patch("mainapp.db.connections") as connections:
+            connections.all.return_value = [broken, alive]
+            close_unusable_connections()
+        broken.close.assert_called_once()
+        alive.close.assert_not_called()
+
+
+class PurgeStaleCartsTestCases(TestCase):
+    def setUp(self) -> None:
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.product = Product.objects.create(category=category, title="Ноутбук", slug="notebook", image="", price=Decimal("10.00"))
+        self.customer = Customer.objects.create(user=User.objects.create_user(username="buyer"))
+        self.long_ago = timezone.now() - timedelta(days=60)
+
+    def make_cart(self, age=None, **kwargs):
+        cart = Cart.objects.create(**kwargs)
+        cart_product = CartProduct.objects.create(cart=cart, product=self.product)
+        cart.products.add(cart_product)
+        if age:
+            Cart.objects.filter(id=cart.id).update(updated_at=age)
+        return cart
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command("purge_stale_carts", *args, stdout=out)
+        return out.getvalue()
+
+    def test_abandoned_carts_removed_with_items(self):
+        abandoned = self.make_cart(age=self.long_ago, for_anonymous_user=True)
+        active = self.make_cart(owner=self.customer)
+        output = self.purge("--batch-size", "1")
+        self.assertIn("Удалено корзин: 1, товаров корзин: 1, связей корзина-товар: 1", output)
+        self.assertFalse(Cart.objects.filter(id=abandoned.id).exists())
+        self.assertEqual(list(CartProduct.objects.values_list("cart_id", flat=True)), [active.id])
+        self.assertEqual(Cart.products.through.objects.count(), 1)
+
+    def test_ordered_carts_kept(self):
+        ordered = self.make_cart(age=self.long_ago, owner=self.customer, in_order=True)
+        not_closed = self.make_cart(age=self.long_ago, owner=self.customer)    # заказ есть, но корзина не помечена
+        for cart in (ordered, not_closed):
+            Order.objects.create(customer=self.customer, first_name="Имя", last_name="Фамилия", phone="1", cart=cart)
+        self.purge()
+        self.assertEqual(Cart.objects.count(), 2)
+        self.assertEqual(CartProduct.objects.count(), 2)
+
+    def test_orphaned_cart_products_removed(self):
+        ordered = self.make_cart(owner=self.customer, in_order=True)
+        orphan = CartProduct.objects.create(cart=ordered, product=Product.objects.create(
+            category=self.product.category, title="Другой", slug="other", image="", price=Decimal("5.00")
+        ))    # не добавлен в Cart.products
+        self.purge()
+        self.assertTrue(CartProduct.objects.filter(id=orphan.id).exists())    # корзина менялась недавно
+        Cart.objects.filter(id=ordered.id).update(updated_at=self.long_ago)
+        self.assertIn("товаров корзин: 1", self.purge())
+        self.assertFalse(CartProduct.objects.filter(id=orphan.id).exists())
+        self.assertTrue(Cart.objects.filter(id=ordered.id).exists())
+
+    def test_dry_run_and_cart_activity(self):
+        cart = self.make_cart(age=self.long_ago, for_anonymous_user=True)
+        self.assertIn("Брошенных корзин: 1", self.purge("--dry-run"))
+        update_cart_totals(cart, Decimal("10.00"), 1)    # изменение корзины продлевает ей жизнь
+        self.assertIn("Брошенных корзин: 0", self.purge("--dry-run"))
+        self.assertTrue(Cart.objects.filter(id=cart.id).exists())
+
+
+class OrderAdminTestCases(TestCase):
+    def setUp(self) -> None:
+        self.admin = User.objects.create_superuser(username="admin", password="password")
+        self.client.login(username="admin", password="password")
+
+    def make_orders(self, count, status=Order.STATUS_NEW):
+        orders = []
+        for i in range(count):
+            customer = Customer.objects.create(user=User.objects.create_user(username=f"buyer-{status}-{i}"), phone=f"+7{i}")
+            cart = Cart.objects.create(owner=customer, in_order=True)
+            orders.append(Order.objects.create(
+                customer=customer, cart=cart, first_name="Имя", last_name="Фамилия", phone=f"+7{i}", status=status
+            ))
+        return orders
+
+    def changelist_queries(self, url="/admin/mainapp/order/"):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_changelist_queries_do_not_grow(self):
+        self.make_orders(2)
+        queries = self.changelist_queries()
+        self.make_orders(10, status=Order.STATUS_READY)
+        self.assertEqual(self.changelist_queries(), queries)
+        self.assertEqual(self.changelist_queries("/admin/mainapp/order/?status__exact=is_ready"), queries)
+
+    def test_change_form_without_full_selects(self):
+        order = self.make_orders(3)[0]
+        response = self.client.get(f"/admin/mainapp/order/{order.id}/change/")
+        self.assertNotContains(response, '<select name="cart"')    # id корзины, а не список всех корзин
+        self.assertContains(response, 'name="cart"')
+        self.assertNotContains(response, "buyer-new-2")    # покупатели подгружаются autocomplete
+
+    def test_search_by_id_and_phone(self):
+        orders = self.make_orders(3)
+        response = self.client.get("/admin/mainapp/order/", {"q": orders[1].phone})
+        self.assertEqual(list(response.context["cl"].result_list), [orders[1]])
+        response = self.client.get("/admin/mainapp/order/", {"q": str(orders[2].id)})
+        self.assertEqual(list(response.context["cl"].result_list), [orders[2]])
+
+    def test_status_transition_action(self):
+        new, other_new = self.make_orders(2)
+        ready = self.make_orders(1, status=Order.STATUS_READY)[0]
+        with CaptureQueriesContext(connection) as context:
+            self.client.post("/admin/mainapp/order/", {
+                "action": "mark_in_progress", "_selected_action": [new.id, other_new.id, ready.id],
+            })
+        updates = [query for query in context.captured_queries if query["sql"].startswith('UPDATE "mainapp_order"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            dict(Order.objects.values_list("id", "status")),
+            {new.id: Order.STATUS_IN_PROGRESS, other_new.id: Order.STATUS_IN_PROGRESS, ready.id: Order.STATUS_READY},
+        )
+
+    def test_other_changelists(self):
+        self.make_orders(2)
+        for model in ("cart", "cartproduct", "customer", "product"):
+            self.assertEqual(self.client.get(f"/admin/mainapp/{model}/").status_code, 200)
+            self.assertEqual(self.client.get(f"/admin/mainapp/{model}/add/").status_code, 200)
+
+
+class PriceListingTestCases(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.products = [
+            Product.objects.create(
+                category=self.category, title=f"Ноутбук {i:02}", slug=f"n{i}", image="", price=Decimal(10 + (i % 7) * 5)
+            )
+            for i in range(30)    # цены повторяются - курсор должен различать товары с одной ценой
+        ]
+
+    def walk(self, query):    # все страницы категории по ссылкам "Следующая страница"
+        seen = []
+        url = f"/category/notebooks/?{query}"
+        while True:
+            response = self.client.get(url)
+            seen.extend(response.context["category_products"])
+            cursor = response.context["next_cursor"]
+            if cursor is None:
+                return seen
+            url = f"/category/notebooks/?{query}&after={quote(str(cursor))}"
+
+    def test_sorted_pages_cover_category(self):
+        for sort, key in (
+            ("price", lambda p: (p.price, p.id)),
+            ("-price", lambda p: (-p.price, -p.id)),
+            ("title", lambda p: (p.title, p.id)),
+            ("new", lambda p: -p.id),
+        ):
+            with self.subTest(sort=sort):
+                seen = self.walk(f"sort={quote(sort)}")
+                self.assertEqual([p.id for p in seen], [p.id for p in sorted(self.products, key=key)])
+
+    def test_price_range_filter(self):
+        seen = self.walk("sort=price&price_min=20&price_max=30")
+        self.assertEqual({p.price for p in seen}, {Decimal(20), Decimal(25), Decimal(30)})
+        self.assertEqual(len(seen), sum(1 for p in self.products if 20 <= p.price <= 30))
+        response = self.client.get("/category/notebooks/?price_min=abc&after=zzz")    # некорректные значения - без фильтра
+        self.assertEqual(len(response.context["category_products"]), 12)
+
+    def test_keep_pages_match_id_filter(self):    # отбор страницы по множеству id в памяти - те же страницы, что и id__in
+        def pages(queryset, sort, **kwargs):
+            result, after = [], None
+            while True:
+                page, after = sorted_keyset_paginate(queryset, sort, after, per_page=4, **kwargs)
+                result.append([p.id for p in page])
+                if after is None:
+                    return result
+                after = get_sorted_cursor(RequestFactory().get("/", {"after": str(after)}), sort)
+
+        keep = {p.id for p in self.products if p.id % 3}
+        products = Product.objects.filter(category=self.category)
+        for sort in PRODUCT_SORTS:
+            with self.subTest(sort=sort), mock.patch("mainapp.utils.KEYSET_SCAN_CHUNK", 5):
+                self.assertEqual(pages(products, sort, keep=keep), pages(products.filter(id__in=keep), sort))
+
+    def test_price_histogram(self):
+        histogram = get_price_histogram(self.category.id)
+        self.assertEqual((histogram["min"], histogram["max"]), (Decimal(10), Decimal(40)))
+        self.assertEqual(sum(bucket["count"] for bucket in histogram["buckets"]), 30)
+        self.assertEqual(histogram["buckets"][-1]["count"], 4)    # максимальная цена попадает в последний интервал
+        self.assertEqual(build_price_histogram(Category.objects.create(name="Пусто", slug="empty").id), {})
+
+    def test_histogram_refreshed_on_price_change(self):
+        self.client.get("/category/notebooks/")
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/category/notebooks/")
+        self.assertFalse([q for q in context.captured_queries if "MAX(" in q["sql"]])    # гистограмма - из кеша
+        self.assertContains(response, "data-price-histogram")
+        product = self.products[0]
+        product.price = Decimal("100.00")
+        with capture_on_commit_callbacks():
+            product.save()
+        self.assertEqual(get_price_histogram(self.category.id)["max"], Decimal(100))
+        product.category = Category.objects.create(name="Планшеты", slug="tablets")
+        with capture_on_commit_callbacks():
+            product.save()    # гистограммы обеих категорий пересчитаны
+        self.assertEqual(get_price_histogram(self.category.id)["max"], Decimal(40))
+        self.assertEqual(get_price_histogram(product.category_id)["min"], Decimal(100))
+
+
+class CartAPITestCases(TestCase):
+    def setUp(self) -> None:
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.products = [
+            Product.objects.create(
+                category=category, title=f"Ноутбук {i}", slug=f"n{i}", image=f"mainapp/n{i}.jpg", price=Decimal(10 * (i + 1))
+            )
+            for i in range(6)
+        ]
+
+    def post(self, items, client=None, **extra):
+        return (client or self.client).post("/api/cart/", json.dumps({"items": items}), content_type="application/json", **extra)
+
+    def test_batch_applied_with_totals(self):
+        response = self.post([{"slug": "n0", "qty": 2}, {"slug": "n1", "qty": 1}])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([(line["slug"], line["qty"], line["final_price"]) for line in data["lines"]], [("n0", 2, "20.00"), ("n1", 1, "20.00")])
+        self.assertEqual(data["summary"], {"total_product": 2, "final_price": "40.00"})
+
+        data = self.post([{"slug": "n0", "qty": 0}, {"slug": "n1", "qty": 3}, {"slug": "n2", "qty": 1}]).json()
+        self.assertEqual([(line["slug"], line["qty"]) for line in data["lines"]], [("n1", 3), ("n2", 1)])
+        self.assertEqual(data["summary"], {"total_product": 2, "final_price": "90.00"})
+        cart = Cart.objects.get()
+        self.assertEqual(sorted(cart.products.values_list("product__slug", flat=True)), ["n1", "n2"])
+        recalc_cart(cart)    # итоги совпадают с полным пересчетом
+        self.assertEqual((cart.total_product, cart.final_price), (2, Decimal("90.00")))
+        self.assertEqual(self.client.get("/api/cart/").json(), data)
+
+    def test_queries_do_not_depend_on_batch_size(self):
+        self.post([{"slug": f"n{i}", "qty": 1} for i in range(4)])
+
+        def queries(items):
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.post(items).status_code, 200)
+            return len(context.captured_queries)
+
+        # добавление, изменение и удаление в одной пачке - по одному запросу на вид изменения
+        small = queries([{"slug": "n0", "qty": 3}, {"slug": "n1", "qty": 0}, {"slug": "n4", "qty": 1}])
+        large = queries([
+            {"slug": "n2", "qty": 2}, {"slug": "n3", "qty": 2}, {"slug": "n0", "qty": 0},
+            {"slug": "n4", "qty": 0}, {"slug": "n1", "qty": 1}, {"slug": "n5", "qty": 1},
+        ])
+        self.assertEqual(small, large)
+
+    def test_invalid_batch_not_applied(self):
+        self.post([{"slug": "n0", "qty": 1}])
+        response = self.post([{"slug": "n0", "qty": 5}, {"slug": "missing", "qty": 1}, {"slug": "n1", "qty": -1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()["errors"]), {"missing", "n1"})
+        self.assertEqual(CartProduct.objects.get().qty, 1)
+        self.assertEqual(self.client.post("/api/cart/", "not json", content_type="application/json").status_code, 400)
+
+    def test_empty_batch_does_not_create_cart(self):
+        self.assertEqual(self.post([{"slug": "n0", "qty": 0}]).json()["summary"]["total_product"], 0)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_csrf_header_required(self):
+        client = Client(enforce_csrf_checks=True)
+        client.get("/add-to-cart/n0/")
+        client.get("/cart/")    # форма количества на странице - csrf cookie
+        self.assertEqual(self.post([{"slug": "n0", "qty": 1}], client=client).status_code, 403)
+        token = client.cookies["csrftoken"].value
+        self.assertEqual(self.post([{"slug": "n0", "qty": 1}], client=client, HTTP_X_CSRFTOKEN=token).status_code, 200)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class StockReservationTestCases(TestCase):
+    def setUp(self) -> None:
+        category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.products = [
+            Product.objects.create(
+                category=category, title=f"Ноутбук {i}", slug=f"n{i}", image=f"mainapp/n{i}.jpg", price=Decimal("10.00"), stock=stock
+            )
+            for i, stock in enumerate((5, 1, None))    # последний - без учета остатка
+        ]
+        for username in ("buyer", "other"):
+            Customer.objects.create(user=User.objects.create_user(username=username, password="password"), phone="1234567890")
+
+    def checkout(self, client, quantities):
+        for product, qty in zip(self.products, quantities):
+            if qty:
+                client.get(f"/add-to-cart/{product.slug}/")
+                client.post(f"/change-qty/{product.slug}/", {"qty": qty})
+        return client.post("/make-order/", {
+            "first_name": "Имя", "last_name": "Фамилия", "phone": "1234567890", "address": "",
+            "buying_type": "self", "order_date": "2030-01-01", "comment": "",
+        })
+
+    def stock(self):
+        return list(Product.objects.order_by("id").values_list("stock", flat=True))
+
+    def test_checkout_reserves_stock(self):
+        self.client.login(username="buyer", password="password")
+        self.assertRedirects(self.checkout(self.client, (2, 1, 7)), "/", fetch_redirect_response=False)
+        self.assertEqual(self.stock(), [3, 0, None])
+        self.assertEqual(Order.objects.get().items.count(), 3)
+
+    def test_checkout_keeps_concurrent_totals(self):    # итоги, сдвинутые после загрузки корзины, не затираются
+        def concurrent_change(cart):
+            update_cart_totals(cart, Decimal("5.00"))
+
+        self.client.login(username="buyer", password="password")
+        with mock.patch("mainapp.views.reserve_stock", side_effect=concurrent_change):
+            self.checkout(self.client, (1, 0, 0))
+        cart = Cart.objects.get()
+        self.assertTrue(cart.in_order)
+        self.assertEqual(cart.final_price, Decimal("15.00"))
+
+    def test_shortage_reported_per_line_and_rolled_back(self):
+        self.client.login(username="buyer", password="password")
+        self.assertRedirects(self.checkout(self.client, (6, 2, 1)), "/cart/", fetch_redirect_response=False)
+        response = self.client.get("/cart/")
+        self.assertContains(response, "Ноутбук 0: в корзине 6 шт., на складе 5 шт.")
+        self.assertContains(response, "Ноутбук 1: в корзине 2 шт., на складе 1 шт.")
+        self.assertNotContains(response, "Ноутбук 2: в корзине")
+        self.assertEqual(self.stock(), [5, 1, None])
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Cart.objects.get().in_order)    # корзина осталась - можно уменьшить количество и оформить снова
+
+    def test_last_item_goes_to_first_buyer(self):
+        other = Client()
+        self.client.login(username="buyer", password="password")
+        other.login(username="other", password="password")
+        for client in (self.client, other):    # обе корзины собраны, пока товар еще есть
+            client.get(f"/add-to-cart/{self.products[1].slug}/")
+        self.assertRedirects(self.checkout(self.client, ()), "/", fetch_redirect_response=False)
+        self.checkout(other, ())
+        response = other.get("/cart/")
+        self.assertContains(response, "Ноутбук 1: в корзине 1 шт., на складе 0 шт.")
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.stock(), [5, 0, None])
+
+    def test_reserve_stock_raises_with_all_shortages(self):
+        customer = Customer.objects.get(user__username="buyer")
+        cart = Cart.objects.create(owner=customer)
+        for product, qty in zip(self.products, (9, 1, 100)):
+            cart.products.add(CartProduct.objects.create(user=customer, cart=cart, product=product, qty=qty))
+        with self.assertRaises(OutOfStock) as raised:
+            reserve_stock(cart)
+        self.assertEqual(raised.exception.lines, [{"title": "Ноутбук 0", "requested": 9, "available": 5}])
+        self.assertEqual(self.stock(), [5, 1, None])    # при нехватке ничего не списывается
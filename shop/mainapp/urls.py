@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from django.contrib.auth.views import LogoutView    # для разлогинивания
 
@@ -6,19 +7,30 @@ from . import views
 
 app_name = "mainapp"    # имя приложения
 
+if settings.ASYNC_CATALOG_VIEWS:    # под ASGI страницы каталога обслуживаются без блокировки потока
+    base_view, product_detail_view, category_detail_view = (
+        views.AsyncBaseView, views.AsyncProductDetailView, views.AsyncCategoryDetailView
+    )
+else:
+    base_view, product_detail_view, category_detail_view = views.BaseView, views.ProductDetailView, views.CategoryDetailView
+
 
 urlpatterns = [
-    path("", views.BaseView.as_view(), name="base"),
-    path("products/<str:slug>/", views.ProductDetailView.as_view(), name="product_detail"),
-    path("category/<str:slug>/", views.CategoryDetailView.as_view(), name="category_detail"),
+    path("", base_view.as_view(), name="base"),
+    path("products/<str:slug>/", product_detail_view.as_view(), name="product_detail"),
+    path("category/<str:slug>/", category_detail_view.as_view(), name="category_detail"),
+    path("search/", views.SearchView.as_view(), name="search"),
     path("cart/", views.CartView.as_view(), name="cart"),
     path("add-to-cart/<str:slug>/", views.AddToCartView.as_view(), name="add_to_cart"),
     path("remove-from-cart/<str:slug>/", views.DeleteFromCartView.as_view(), name="delete_from_cart"),
     path("change-qty/<str:slug>/", views.ChangeQTYView.as_view(), name="change_qty"),
+    path("api/cart/", views.CartAPIView.as_view(), name="cart_api"),    # пачка изменений корзины в JSON (страница корзины)
     path("checkout/", views.CheckoutView.as_view(), name="checkout"),
     path("make-order/", views.MakeOrderView.as_view(), name="make_order"),
     path("login/", views.LoginView.as_view(), name="login"),
     path("logout/", LogoutView.as_view(next_page="/"), name="logout"),    # выйди с учетной записи с переходом на главную страницу
     path("registration/", views.RegistrationView.as_view(), name="registration"),
-    path("profile/", views.ProfileView.as_view(), name="profile")
+    path("profile/", views.ProfileView.as_view(), name="profile"),
+    path("export/<str:name>/", views.ExportView.as_view(), name="export"),
+    path("metrics", views.MetricsView.as_view(), name="metrics"),    # без слеша - путь по умолчанию для Prometheus
 ]
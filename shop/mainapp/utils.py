@@ -1,4 +1,19 @@
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
 from django.db import models    # функции для агригации
+from django.db.models.functions import Substr
+from django.utils import timezone
+
+from specs.facets import FACET_PARAM_RE
+
+from .models import Cart, CartProduct, Product, OrderItem
+
+
+PRODUCTS_PER_PAGE = 12    # количество карточек товаров на странице
+ORDERS_PER_PAGE = 10    # заказов на странице истории заказов
+ID_LIST_LIMIT = 500    # больше id в IN (...) не передается (SQLite до 3.32 принимает не больше 999 параметров)
+KEYSET_SCAN_CHUNK = 500    # строк (поле сортировки, id) за один запрос при отборе страницы по множеству id
 
 
 def recalc_cart(cart):    # пересчитать корзину (какая сумма товаров и какое количество товара в корзине)
@@ -10,3 +25,266 @@ def recalc_cart(cart):    # пересчитать корзину (какая с
         cart.final_price = 0
     cart.total_product = cart_data["id__count"]    # определение количества товаров в корзине
     cart.save()    # сохранение корзины
+
+
+def update_cart_totals(cart, price_delta, count_delta=0):    # сдвинуть итоги корзины на разницу (вызывать в той же транзакции, что и изменение CartProduct)
+    # F() - изменение считается в самой бд одним UPDATE, без агрегации по всем товарам корзины и без полного cart.save()
+    Cart.objects.filter(id=cart.id).update(
+        final_price=models.F("final_price") + price_delta,
+        total_product=models.F("total_product") + count_delta,
+        updated_at=timezone.now(),    # update() не заполняет auto_now
+    )
+
+
+def set_cart_quantities(cart, quantities):    # вызывать в транзакции
+    """
+    Пачка изменений корзины: quantities - {id товара: (цена товара, количество)}, количество 0 - удалить товар.
+    Строки корзины пишутся bulk-операциями (INSERT, UPDATE и DELETE - по одному на пачку),
+    итоги корзины сдвигаются одним update_cart_totals
+    """
+    existing = {
+        item.product_id: item
+        for item in CartProduct.objects.select_for_update().filter(cart=cart, product_id__in=quantities)
+    }
+    to_create, to_update, to_delete = [], [], []
+    price_delta, count_delta = Decimal(0), 0
+    for product_id, (price, qty) in quantities.items():
+        item = existing.get(product_id)
+        if item is None:
+            if qty:
+                to_create.append(CartProduct(user_id=cart.owner_id, cart=cart, product_id=product_id, qty=qty, final_price=price * qty))
+                price_delta += price * qty
+                count_delta += 1
+        elif not qty:
+            to_delete.append(item.id)
+            price_delta -= item.final_price
+            count_delta -= 1
+        elif qty != item.qty:    # цена - текущая цена товара, как в CartProduct.save
+            price_delta += price * qty - item.final_price
+            item.qty, item.final_price = qty, price * qty
+            to_update.append(item)
+    if to_delete:
+        CartProduct.objects.filter(id__in=to_delete).delete()    # связи Cart.products удаляются каскадом
+    CartProduct.objects.bulk_update(to_update, ["qty", "final_price"])
+    if to_create:
+        CartProduct.objects.bulk_create(to_create)
+        cart.products.add(*CartProduct.objects.filter(    # id новых строк (SQLite не возвращает их из bulk_create)
+            cart=cart, product_id__in=[item.product_id for item in to_create]
+        ).values_list("id", flat=True))
+    if price_delta or count_delta:
+        update_cart_totals(cart, price_delta, count_delta)
+
+
+def get_cart_state(cart):    # строки и итоги корзины для JSON API (цены - строками, как их отдает DjangoJSONEncoder)
+    lines, summary = [], {"total_product": 0, "final_price": Decimal(0)}
+    if cart is not None:
+        lines = list(CartProduct.objects.filter(cart=cart).order_by("id").values(
+            "qty", "final_price",
+            slug=models.F("product__slug"), title=models.F("product__title"), price=models.F("product__price"),
+        ))
+        summary = Cart.objects.filter(id=cart.id).values("total_product", "final_price").first() or summary
+    return {"lines": lines, "summary": summary}
+
+
+def save_order_with_items(order, cart):    # сохранить заказ с копией товаров корзины (вызывать в транзакции оформления)
+    rows = list(CartProduct.objects.filter(cart=cart).order_by("id").values(
+        "product_id", "product__title", "product__price", "qty", "final_price"
+    ))
+    order.cart = cart
+    order.total_products = len(rows)
+    order.final_price = sum((row["final_price"] for row in rows), Decimal(0))
+    order.save()
+    OrderItem.objects.bulk_create([    # одним INSERT, цены - те, по которым товар был в корзине
+        OrderItem(
+            order=order, product_id=row["product_id"], title=row["product__title"],
+            price=row["final_price"] / row["qty"] if row["qty"] else row["product__price"],    # qty=0 - строка без суммы
+            qty=row["qty"], final_price=row["final_price"]
+        )
+        for row in rows
+    ])
+
+
+class OutOfStock(Exception):    # товаров корзины не хватает на складе, lines - по строке на каждый такой товар
+    def __init__(self, lines):
+        super().__init__(lines)
+        self.lines = lines    # [{"title": ..., "requested": в корзине, "available": на складе}]
+
+
+def reserve_stock(cart):    # вызывать в транзакции оформления - при OutOfStock транзакцию нужно откатить
+    """
+    Списать со склада товары корзины. Строки товаров блокируются в порядке id (два заказа с одними товарами
+    не ждут друг друга по кругу), затем у каждого товара с учетом остатка одно условное списание
+    UPDATE ... SET stock = stock - qty WHERE stock >= qty. Товары без учета остатка (stock пустой) не списываются.
+    Если чего-то не хватает - OutOfStock со всеми такими строками корзины
+    """
+    lines = dict(CartProduct.objects.filter(cart=cart).values_list("product_id", "qty"))
+    tracked = list(
+        Product.objects.select_for_update().filter(id__in=lines, stock__isnull=False)
+        .order_by("id").values_list("id", "title", "stock")
+    )
+    shortages = [
+        {"title": title, "requested": lines[product_id], "available": stock}
+        for product_id, title, stock in tracked if lines[product_id] > stock
+    ]
+    if not shortages:
+        for product_id, title, stock in tracked:
+            qty = lines[product_id]
+            # условие в самом UPDATE: остаток не уйдет в минус, даже если бд не поддерживает SELECT ... FOR UPDATE
+            if not Product.objects.filter(id=product_id, stock__gte=qty).update(stock=models.F("stock") - qty):
+                shortages.append({"title": title, "requested": qty, "available": Product.objects.get(id=product_id).stock})
+    if shortages:
+        raise OutOfStock(shortages)
+
+
+def merge_carts(anonymous_cart, cart):    # перенести товары анонимной корзины в корзину покупателя (при входе на сайт)
+    existing = {item.product_id: item for item in cart.products.select_related("product")}    # товары, которые уже есть в корзине покупателя
+    for item in anonymous_cart.products.select_related("product"):
+        cart_product = existing.get(item.product_id)
+        if cart_product:    # такой товар уже есть - складываем количество
+            cart_product.qty += item.qty
+            cart_product.save()
+            item.delete()
+        else:    # переносим товар в корзину покупателя
+            item.user_id = cart.owner_id
+            item.cart = cart
+            item.save()
+            cart.products.add(item)
+    anonymous_cart.delete()
+    recalc_cart(cart)
+
+
+def get_product_cards():    # товары для карточек - только поля, которые выводит карточка
+    return Product.objects.only("id", "title", "slug", "image", "renditions_ready", "price").annotate(
+        short_description=Substr("description", 1, 51)    # в шаблоне выводится только начало описания (truncatechars:50)
+    )
+
+
+def get_cursor(request, name="after"):    # курсор из GET параметра (некорректное значение - первая страница)
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def keyset_paginate(queryset, after=None, per_page=PRODUCTS_PER_PAGE):
+    """
+    Постраничный вывод по курсору (keyset): страница - это товары с id меньше,
+    чем у последнего товара предыдущей страницы. В отличие от OFFSET бд читает
+    по индексу только нужные строки, поэтому любая страница выбирается за одинаковое время
+    """
+    if after is not None:
+        queryset = queryset.filter(id__lt=after)
+    items = list(queryset.order_by("-id")[:per_page + 1])    # одна лишняя запись - признак наличия следующей страницы
+    next_cursor = items[per_page - 1].id if len(items) > per_page else None
+    return items[:per_page], next_cursor
+
+
+PRODUCT_SORTS = {    # значение GET параметра sort -> (поле товара, по убыванию); первое - по умолчанию
+    "new": ("id", True),
+    "price": ("price", False),
+    "-price": ("price", True),
+    "title": ("title", False),
+}
+
+
+def get_sort(request):
+    sort = request.GET.get("sort")
+    return sort if sort in PRODUCT_SORTS else next(iter(PRODUCT_SORTS))
+
+
+def get_price_range(request):    # (от, до) из GET параметров price_min и price_max (некорректное значение - без ограничения)
+    bounds = []
+    for name in ("price_min", "price_max"):
+        try:
+            bounds.append(Decimal(request.GET[name]))
+        except (KeyError, ArithmeticError):    # InvalidOperation - наследник ArithmeticError
+            bounds.append(None)
+    return tuple(bound if bound is not None and bound.is_finite() else None for bound in bounds)
+
+
+CATALOG_QUERY_PARAMS = {"sort", "price_min", "price_max", "after"}    # GET параметры страниц каталога, кроме фильтров f<id>
+
+
+def get_catalog_query(query_dict):
+    """
+    GET параметры, которые читают страницы каталога, в постоянном порядке. Остальные (utm метки и т.п.)
+    страницу не меняют - не попадают ни в ключ кеша страницы, ни в ссылки на другие страницы
+    """
+    return sorted(
+        (key, value) for key, values in query_dict.lists()
+        if key in CATALOG_QUERY_PARAMS or FACET_PARAM_RE.match(key) for value in values
+    )
+
+
+def get_sorted_cursor(request, sort, name="after"):
+    """
+    Курсор для сортировки sort: для "new" - id (как у keyset_paginate),
+    для остальных - "значение поля|id" последнего товара страницы (некорректное значение - первая страница)
+    """
+    field, _ = PRODUCT_SORTS[sort]
+    if field == "id":
+        return get_cursor(request, name)
+    value, _, last_id = request.GET.get(name, "").rpartition("|")
+    try:
+        return Product._meta.get_field(field).to_python(value), int(last_id)
+    except (ValidationError, ValueError):
+        return None
+
+
+def filter_after(queryset, field, descending, after):    # товары "после" курсора в порядке (field, id)
+    if after is None:
+        return queryset
+    lookup = "lt" if descending else "gt"
+    if field == "id":
+        return queryset.filter(**{f"id__{lookup}": after})
+    value, last_id = after
+    return queryset.filter(
+        models.Q(**{f"{field}__{lookup}": value}) | models.Q(**{field: value, f"id__{lookup}": last_id})
+    )
+
+
+def keyset_order(field, descending):
+    if field == "id":
+        return ("-id",) if descending else ("id",)
+    return (f"-{field}", "-id") if descending else (field, "id")
+
+
+def scan_keyset_ids(queryset, sort, after, limit, keep):
+    """
+    Первые limit id из множества keep в порядке сортировки sort после курсора after.
+    Бд отдает только (поле, id) пачками по KEYSET_SCAN_CHUNK по тому же условию курсора,
+    принадлежность к keep проверяется в памяти - без списка всех id в запросе
+    """
+    field, descending = PRODUCT_SORTS[sort]
+    rows = queryset.order_by(*keyset_order(field, descending)).values_list(field, "id")
+    found = []
+    while True:
+        chunk = list(filter_after(rows, field, descending, after)[:KEYSET_SCAN_CHUNK])
+        found.extend(product_id for _, product_id in chunk if product_id in keep)
+        if len(found) >= limit or len(chunk) < KEYSET_SCAN_CHUNK:
+            return found[:limit]
+        value, last_id = chunk[-1]
+        after = last_id if field == "id" else (value, last_id)
+
+
+def sorted_keyset_paginate(queryset, sort, after=None, per_page=PRODUCTS_PER_PAGE, keep=None):
+    """
+    keyset_paginate с сортировкой по полю товара. id продолжает сортировку для товаров
+    с одинаковым значением поля, поэтому курсор - пара (значение, id), а следующая страница -
+    товары "после" этой пары: (поле > значение) или (поле = значение и id > id курсора).
+    Для цены такое условие и порядок читаются по индексу (category, price, id).
+    keep - множество id, слишком большое для id__in: сначала отбираются id страницы (scan_keyset_ids)
+    """
+    field, descending = PRODUCT_SORTS[sort]
+    if keep is not None:
+        queryset = queryset.filter(id__in=scan_keyset_ids(queryset, sort, after, per_page + 1, keep))
+        after = None    # курсор уже учтен при отборе
+    if field == "id":
+        return keyset_paginate(queryset, after, per_page)
+    queryset = filter_after(queryset, field, descending, after)
+    items = list(queryset.order_by(*keyset_order(field, descending))[:per_page + 1])
+    next_cursor = None
+    if len(items) > per_page:
+        last = items[per_page - 1]
+        next_cursor = f"{getattr(last, field)}|{last.id}"
+    return items[:per_page], next_cursor
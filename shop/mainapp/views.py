@@ -1,30 +1,50 @@
-from django.db import transaction
-from django.shortcuts import render
+import asyncio
+import json
+
+from django.db import IntegrityError, transaction
+from django.shortcuts import render, get_object_or_404
 from django.contrib import messages    # выводит информацию о каких либо осуществленных действиях
-from django.http import HttpResponseRedirect    # для перенаправления
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, HttpResponseForbidden, StreamingHttpResponse, Http404    # для перенаправления
+from django.core.paginator import Paginator
+from django.db.models import Prefetch
 from django.views.generic import DetailView, View
 from django.contrib.auth import authenticate, login
+from django.utils.http import urlencode
+
+from specs.facets import filter_facets, get_facet_counts, has_facet_selection
 
-from .models import Product, Category, Customer, Order, CartProduct
-from .mixins import CartMixin     # должет первый по порядку наследоватся
+from .models import Product, Category, Customer, Cart, Order, OrderItem, CartProduct
+from .mixins import CartMixin, AsyncCartMixin, AsyncView, merge_anonymous_cart     # должет первый по порядку наследоватся
 from .forms import OrderForm, LoginForm, RegistrationForm
-from .utils import recalc_cart
+from .utils import (
+    update_cart_totals, set_cart_quantities, get_cart_state, save_order_with_items, get_product_cards, get_cursor, keyset_paginate,
+    reserve_stock, OutOfStock,
+    get_sort, get_sorted_cursor, get_price_range, get_catalog_query, sorted_keyset_paginate, PRODUCTS_PER_PAGE, ORDERS_PER_PAGE, ID_LIST_LIMIT,
+)
+from .prices import get_price_histogram
+from .search import search_products
+from .metrics import registry
+from .exports import EXPORTS, EXPORT_FORMATS, render_export
+from .async_queries import run_query, run_sync
+from .context_processors import get_category_nav
 
 
 class BaseView(CartMixin, View):
     def get(self, request, *args, **kwargs):    # метод - аналог функции test_base (гет запрос)
-        categories = Category.objects.all()   # для истользования объекта в шаблоне
-        products = Product.objects.all()   # для вывода продуктов на главной странице
+        products, next_cursor = keyset_paginate(get_product_cards(), get_cursor(request))   # для вывода продуктов на главной странице (постранично)
 
         context = {
-            "categories": categories,
             "products": products,
+            "next_cursor": next_cursor,
             "cart": self.cart,
         }
         return render(request, "base/base.html", context)
 
 
 class ProductDetailView(CartMixin, DetailView):
+    model = Product
+    queryset = Product.objects.select_related("category")    # категория выводится в навигации страницы
     context_object_name = "product"
     template_name = "mainapp/product_detail.html"
     slug_url_kwarg = "slug"
@@ -44,71 +64,215 @@ class CategoryDetailView(CartMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context.update(get_category_listing(self.object, self.request))
         context["cart"] = self.cart
         return context
 
 
+def get_category_listing(category, request):    # товары страницы категории с учетом фильтров, цены и сортировки
+    query = request.GET
+    products = get_product_cards().filter(category=category)
+    keep = None
+    price_min, price_max = get_price_range(request)
+    if price_min is not None:
+        products = products.filter(price__gte=price_min)
+    if price_max is not None:
+        products = products.filter(price__lte=price_max)
+    price_filtered = price_min is not None or price_max is not None
+    if has_facet_selection(query) or price_filtered:    # выбраны фильтры или цена - товары и количества из индекса в памяти
+        # количества - только по товарам в диапазоне цен (id читаются по индексу (category, price, id))
+        within_ids = list(products.values_list("id", flat=True)) if price_filtered else None
+        product_ids, facets = filter_facets(category.id, query, within_ids)
+        if product_ids is not None and len(product_ids) <= ID_LIST_LIMIT:
+            products = products.filter(id__in=product_ids)
+        elif product_ids is not None:    # широкий выбор - страница отбирается по множеству id в памяти
+            keep = set(product_ids)
+    else:    # без фильтров количества читаются одним запросом из FeatureValueCount
+        facets = get_facet_counts(category.id)
+    sort = get_sort(request)
+    category_products, next_cursor = sorted_keyset_paginate(products, sort, get_sorted_cursor(request, sort), keep=keep)
+    return {
+        "facets": facets,
+        "sort": sort,
+        "price_min": price_min,
+        "price_max": price_max,
+        "price_histogram": get_price_histogram(category.id),    # готовая гистограмма из кеша (пересчитывается сигналами)
+        "category_products": category_products,
+        "next_cursor": next_cursor,
+        "filter_query": urlencode(    # выбранные фильтры сохраняются при переходе по страницам
+            [(key, value) for key, value in get_catalog_query(query) if key != "after"]
+        ),
+    }
+
+
+class AsyncBaseView(AsyncCartMixin, AsyncView):    # варианты страниц каталога для ASGI (settings.ASYNC_CATALOG_VIEWS)
+    async def get(self, request, *args, **kwargs):
+        # товары, меню категорий и корзина не зависят друг от друга - запрашиваются одновременно
+        (products, next_cursor), categories, cart = await asyncio.gather(
+            run_query(keyset_paginate, get_product_cards(), get_cursor(request)),
+            run_query(get_category_nav),
+            self.get_cart(),
+        )
+        context = {"products": products, "next_cursor": next_cursor, "categories": categories, "cart": cart}
+        return await run_sync(render, request, "base/base.html", context)
+
+
+class AsyncProductDetailView(AsyncCartMixin, AsyncView):
+    async def get(self, request, *args, **kwargs):
+        product, categories, cart = await asyncio.gather(
+            run_query(get_object_or_404, ProductDetailView.queryset, slug=kwargs["slug"]),
+            run_query(get_category_nav),
+            self.get_cart(),
+        )
+        context = {"product": product, "categories": categories, "cart": cart}
+        return await run_sync(render, request, ProductDetailView.template_name, context)
+
+
+class AsyncCategoryDetailView(AsyncCartMixin, AsyncView):
+    async def get(self, request, *args, **kwargs):
+        category, categories, cart = await asyncio.gather(
+            run_query(get_object_or_404, Category, slug=kwargs["slug"]),
+            run_query(get_category_nav),
+            self.get_cart(),
+        )
+        listing = await run_query(get_category_listing, category, request)    # фильтры зависят от категории
+        context = {"category": category, "categories": categories, "cart": cart, **listing}
+        return await run_sync(render, request, CategoryDetailView.template_name, context)
+
+
+class SearchView(CartMixin, View):
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get("q", "").strip()
+        page = Paginator(search_products(query) if query else [], PRODUCTS_PER_PAGE).get_page(request.GET.get("page"))    # ранжированный список id товаров (индекс в памяти)
+        products = get_product_cards().in_bulk(page.object_list)    # из бд читаются только товары текущей страницы
+        context = {
+            "query": query,
+            "page": page,
+            "products": [products[product_id] for product_id in page.object_list if product_id in products],
+            "cart": self.cart,
+        }
+        return render(request, "mainapp/search.html", context)
+
+
 class AddToCartView(CartMixin, View):
     def get(self, request, *args, **kwargs):
         # логика добавление в корзину
         product_slug = kwargs.get("slug")    # слаг товара
         product = Product.objects.get(slug=product_slug)    # получение продукта через модель, находя продукт по слагу товара
-        cart_product, created = CartProduct.objects.get_or_create(    # создание нового карт-продукт объекта с необходимым набором аргументов (get_or_create - для проверки наличия товара в корзине (возвращает кортеж)
-            user=self.cart.owner, cart=self.cart, product=product
-        )
-        if created:    # проверяет был ли создан новый объект (чтобы не добавлять один и тот же товар в корзину)
-            self.cart.products.add(cart_product)    # добавление в корзину (add - это добавление в многих ко многим)
-        recalc_cart(self.cart)    # сохранить информацию в корзину
+        self.get_or_create_cart()    # анонимная корзина создается только сейчас, при первом добавлении товара
+        with transaction.atomic():    # товар и итоги корзины меняются вместе
+            cart_product, created = CartProduct.objects.get_or_create(    # создание нового карт-продукт объекта с необходимым набором аргументов (get_or_create - для проверки наличия товара в корзине (возвращает кортеж)
+                user_id=self.cart.owner_id, cart=self.cart, product=product
+            )
+            if created:    # проверяет был ли создан новый объект (чтобы не добавлять один и тот же товар в корзину)
+                self.cart.products.add(cart_product)    # добавление в корзину (add - это добавление в многих ко многим)
+                update_cart_totals(self.cart, cart_product.final_price, 1)    # сохранить информацию в корзину
         messages.add_message(request, messages.INFO, "Товар успешно добавлен")    # вывод информации о действии (при тестировании - хакоментировать)
         return HttpResponseRedirect("/cart/")    # перенаправить сразу в корзину
 
 
 class DeleteFromCartView(CartMixin, View):
     def get(self, request, *args, **kwargs):
+        if self.cart is None:    # корзины еще нет - менять нечего
+            return HttpResponseRedirect("/cart/")
         product_slug = kwargs.get("slug")  # слаг товара
         product = Product.objects.get(slug=product_slug)  # получение продукта через модель, находя продукт по слагу товара
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, product=product
-        )
-        self.cart.products.remove(cart_product)  # удаление из корзины (remove - это удаление в многих ко многим)
-        cart_product.delete()    # удаление товара из базы данных
-        recalc_cart(self.cart)    # сохранить информацию в корзину
+        with transaction.atomic():
+            cart_product = CartProduct.objects.select_for_update().get(
+                user_id=self.cart.owner_id, cart=self.cart, product=product
+            )
+            self.cart.products.remove(cart_product)  # удаление из корзины (remove - это удаление в многих ко многим)
+            cart_product.delete()    # удаление товара из базы данных
+            update_cart_totals(self.cart, -cart_product.final_price, -1)    # сохранить информацию в корзину
         messages.add_message(request, messages.INFO, "Товар успешно удален")  # вывод информации о действии
         return HttpResponseRedirect("/cart/")  # перенаправить сразу в корзину
 
 
 class ChangeQTYView(CartMixin, View):
     def post(self, request, *args, **kwargs):    # пост запрос
+        if self.cart is None:    # корзины еще нет - менять нечего
+            return HttpResponseRedirect("/cart/")
         product_slug = kwargs.get("slug")  # слаг товара
         product = Product.objects.get(slug=product_slug)  # получение продукта через модель, находя продукт по слагу товара
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, product=product
-        )
-        qty = int(request.POST.get("qty"))
-        cart_product.qty = qty
-        cart_product.save()    # посчитать наличие корзины
-        recalc_cart(self.cart)    # сохранить информацию в корзину
+        try:
+            qty = int(request.POST.get("qty"))
+        except (TypeError, ValueError):
+            qty = 0
+        if qty < 1:    # удаление - отдельной кнопкой; строка с нулевым количеством сломала бы цену в заказе
+            messages.add_message(request, messages.ERROR, "Количество должно быть больше нуля")
+            return HttpResponseRedirect("/cart/")
+        with transaction.atomic():
+            cart_product = CartProduct.objects.select_for_update().get(
+                user_id=self.cart.owner_id, cart=self.cart, product=product
+            )
+            old_final_price = cart_product.final_price
+            cart_product.qty = qty
+            cart_product.save()    # посчитать наличие корзины
+            update_cart_totals(self.cart, cart_product.final_price - old_final_price)    # сохранить информацию в корзину
         messages.add_message(request, messages.INFO, "Количество успешно изменено")  # вывод информации о действии
         return HttpResponseRedirect("/cart/")
 
 
+CART_API_MAX_ITEMS = 100    # изменений в одном запросе
+
+
+class CartAPIView(CartMixin, View):
+    """
+    JSON API корзины. GET - строки и итоги корзины; POST {"items": [{"slug": ..., "qty": ...}, ...]} -
+    установить количество товаров (0 - удалить) одной транзакцией и вернуть новое состояние корзины.
+    Пачка применяется целиком или не применяется совсем
+    """
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(get_cart_state(self.cart))
+
+    def post(self, request, *args, **kwargs):
+        try:
+            items = json.loads(request.body)["items"]
+            quantities = {item["slug"]: item["qty"] for item in items}    # повтор товара - действует последний
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({"error": 'Ожидается {"items": [{"slug": ..., "qty": ...}]}'}, status=400)
+        if len(quantities) > CART_API_MAX_ITEMS:
+            return JsonResponse({"error": f"Не больше {CART_API_MAX_ITEMS} товаров за запрос"}, status=400)
+        products = {
+            slug: (product_id, price)
+            for slug, product_id, price in Product.objects.filter(slug__in=quantities).values_list("slug", "id", "price")
+        }
+        errors = {}
+        for slug, qty in quantities.items():
+            if slug not in products:
+                errors[slug] = "Товар не найден"
+            elif not isinstance(qty, int) or isinstance(qty, bool) or qty < 0:
+                errors[slug] = "Количество - целое число от 0"
+        if errors:
+            return JsonResponse({"errors": errors}, status=400)
+
+        if self.cart is None and not any(quantities.values()):    # удалять нечего - корзину не создаем
+            return JsonResponse(get_cart_state(None))
+        cart = self.get_or_create_cart()
+        try:
+            with transaction.atomic():
+                set_cart_quantities(cart, {
+                    product_id: (price, quantities[slug]) for slug, (product_id, price) in products.items()
+                })
+        except IntegrityError:    # тот же товар одновременно добавлен другим запросом
+            return JsonResponse({"error": "Корзина изменилась, повторите запрос"}, status=409)
+        return JsonResponse(get_cart_state(cart))
+
+
 class CartView(CartMixin, View):
     def get(self, request, *args, **kwargs):
-        categories = Category.objects.all()
         context = {
             "cart": self.cart,
-            "categories": categories,
         }
         return render(request, "mainapp/cart.html", context)
 
 
 class CheckoutView(CartMixin, View):
     def get(self, request, *args, **kwargs):
-        categories = Category.objects.all()
         form = OrderForm(request.POST or None)    # пост запрос или ничего (инстансирование формы)
         context = {
             "cart": self.cart,
-            "categories": categories,
             "form": form,
         }
         return render(request, "mainapp/checkout.html", context)
@@ -117,6 +281,8 @@ class CheckoutView(CartMixin, View):
 class MakeOrderView(CartMixin, View):
     @transaction.atomic    # для коректной работы метода post (в случае некоректной работы все откатится)
     def post(self, request, *args, **kwargs):
+        if self.cart is None:    # оформлять нечего
+            return HttpResponseRedirect("/cart/")
         form = OrderForm(request.POST or None)
         customer = Customer.objects.get(user=request.user)
         if form.is_valid():    #для работы с формой ее нужно поволидировать
@@ -129,11 +295,26 @@ class MakeOrderView(CartMixin, View):
             new_order.buying_type = form.cleaned_data["buying_type"]
             new_order.order_date = form.cleaned_data["order_date"]
             new_order.comment = form.cleaned_data["comment"]
-            self.cart.in_order = True
-            self.cart.save()    # сохранить корзины в статусе True
-            new_order.cart = self.cart
-            new_order.save()    # сохранить заказ в бд
-            customer.orders.add(new_order)    # записать пользователю его заказ в историю заказов
+            cart = self.cart
+            # блокировка корзины: повторная отправка формы ждет конца этой транзакции и видит корзину уже в заказе
+            if not Cart.objects.select_for_update().filter(id=cart.id, in_order=False).exists():
+                return HttpResponseRedirect("/cart/")
+            try:
+                with transaction.atomic():    # точка сохранения: при нехватке товара откатывается и частичное списание
+                    reserve_stock(cart)
+                    cart.in_order = True
+                    # только статус: итоги, загруженные до блокировки, не затирают сдвиги update_cart_totals
+                    cart.save(update_fields=["in_order", "updated_at"])
+                    save_order_with_items(new_order, cart)    # сохранить заказ в бд вместе с позициями
+                    customer.orders.add(new_order)    # записать пользователю его заказ в историю заказов
+            except OutOfStock as error:    # заказ не оформлен, корзина остается как была
+                for line in error.lines:
+                    messages.add_message(
+                        request, messages.ERROR,
+                        f"{line['title']}: в корзине {line['requested']} шт., на складе {line['available']} шт."
+                    )
+                return HttpResponseRedirect("/cart/")
+            self.cart_resolver.forget_cart()    # следующая корзина будет новой
             messages.add_message(request, messages.INFO, "Спасибо за заказ. Менеджер с Вами свяжется.")
             return HttpResponseRedirect("/")
         return HttpResponseRedirect("/checkout/")
@@ -142,10 +323,8 @@ class MakeOrderView(CartMixin, View):
 class LoginView(CartMixin, View):
     def get(self, request, *args, **kwargs):    #get - для отрисовки формы
         form = LoginForm(request.POST or None)
-        categories = Category.objects.all()
         context = {
             "form": form,
-            "categories": categories,
             "cart": self.cart
         }
         return render(request, "mainapp/login.html", context)
@@ -158,6 +337,7 @@ class LoginView(CartMixin, View):
             user = authenticate(username=username, password=password)    # авторизация
             if user:
                 login(request, user)    # залогинитmься
+                merge_anonymous_cart(request)    # товары, добавленные до входа, переходят в корзину покупателя
                 return HttpResponseRedirect("/")
         context = {"form": form, "cart": self.cart}
         return render(request, "mainapp/login.html", context)
@@ -166,10 +346,8 @@ class LoginView(CartMixin, View):
 class RegistrationView(CartMixin, View):
     def get(self, request, *args, **kwargs):
         form = RegistrationForm(request.POST or None)
-        categories = Category.objects.all()
         context = {
             "form": form,
-            "categories": categories,
             "cart": self.cart
         }
         return render(request, "mainapp/registration.html", context)
@@ -192,19 +370,39 @@ class RegistrationView(CartMixin, View):
             )
             user = authenticate(username=form.cleaned_data["username"], password=form.cleaned_data["password"])
             login(request, user)
+            merge_anonymous_cart(request)
             return HttpResponseRedirect("/")
         context = {"form": form, "cart": self.cart}
         return render(request, "mainapp/registration.html", context)
 
 class ProfileView(CartMixin, View):
     def get(self, request, *args, **kwargs):
-        customer = Customer.objects.get(user=request.user)
-        orders = Order.objects.filter(customer=customer).order_by("-created_date")    # сортировка в убывающем порядке
-        categories = Category.objects.all()
+        orders = Order.objects.filter(customer__user=request.user).order_by("-created_date").prefetch_related(
+            Prefetch("items", queryset=OrderItem.objects.select_related("product").order_by("id"))
+        )    # сортировка в убывающем порядке, позиции всех заказов страницы - одним запросом
+        page = Paginator(orders, ORDERS_PER_PAGE).get_page(request.GET.get("page"))
         context = {
-            "orders": orders,
-            "categories": categories,
+            "orders": page.object_list,
+            "page": page,
             "cart": self.cart
         }
         return render(request, "mainapp/profile.html", context)
 
+
+class MetricsView(View):
+    def get(self, request, *args, **kwargs):    # метрики процесса в формате Prometheus (только для адресов из INTERNAL_IPS)
+        if request.META.get("REMOTE_ADDR") not in settings.INTERNAL_IPS:
+            return HttpResponseForbidden()
+        return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class ExportView(View):
+    def get(self, request, *args, **kwargs):    # выгрузка каталога или заказов потоком (только для персонала)
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+        name, export_format = kwargs["name"], request.GET.get("format", "csv")
+        if name not in EXPORTS or export_format not in EXPORT_FORMATS:
+            raise Http404
+        response = StreamingHttpResponse(render_export(name, export_format), content_type=EXPORT_FORMATS[export_format])
+        response["Content-Disposition"] = f'attachment; filename="{name}.{export_format}"'
+        return response
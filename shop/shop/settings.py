@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -27,6 +28,8 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
+INTERNAL_IPS = ["127.0.0.1"]    # адреса, с которых доступны метрики (/metrics)
+
 
 # Application definition
 
@@ -43,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "mainapp.middleware.MetricsMiddleware",    # время ответа и SQL запросы по каждому url (первым - чтобы учитывать всю обработку)
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,6 +54,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    "mainapp.middleware.CatalogPageCacheMiddleware",    # 304 и кеш страниц каталога для анонимных посетителей (после сессии, auth и messages)
 ]
 
 ROOT_URLCONF = 'shop.urls'
@@ -66,6 +71,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                "mainapp.context_processors.categories",    # категории для меню на каждой странице
             ],
         },
     },
@@ -77,25 +83,70 @@ WSGI_APPLICATION = 'shop.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
+# профиль бд выбирается переменной окружения SHOP_DB_PROFILE: sqlite (по умолчанию) или postgres
+DATABASE_PROFILE = os.environ.get("SHOP_DB_PROFILE", "sqlite")
+
+DATABASE_PROFILES = {
     # подключение базы данных SqLite
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    "sqlite": {
+        "ENGINE": "mainapp.backends.sqlite3",    # SQLite с OPTIONS["transaction_mode"]
+        "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {
+            "transaction_mode": "IMMEDIATE",    # блокировка на запись в начале atomic - одновременные записи ждут, а не падают
+        },
+    },
 
     # подключение базы данных PostgreSQL
-    # "default": {
-    #     "ENGINE": "django.db.backends.postgresql_psycopg2",    # бэкенд (подключение базы данных)
-    #     "NAME": "internet_shop_db",    # имя базы данных
-    #     "USER": "is_user",    # имя суперпользователя
-    #     "PASSWORD": "devpass",    # пароль суперпользователя
-    #     "HOST": "127.0.0.1",    # расположение базы данных
-    #     "PORT": 5432
-    # }
+    "postgres": {
+        "ENGINE": "django.db.backends.postgresql_psycopg2",    # бэкенд (подключение базы данных)
+        "NAME": os.environ.get("SHOP_DB_NAME", "internet_shop_db"),    # имя базы данных
+        "USER": os.environ.get("SHOP_DB_USER", "is_user"),    # имя суперпользователя
+        "PASSWORD": os.environ.get("SHOP_DB_PASSWORD", "devpass"),    # пароль суперпользователя
+        "HOST": os.environ.get("SHOP_DB_HOST", "127.0.0.1"),    # расположение базы данных
+        "PORT": os.environ.get("SHOP_DB_PORT", "5432"),
+        "CONN_MAX_AGE": int(os.environ.get("SHOP_DB_CONN_MAX_AGE", "600")),    # соединение живет между запросами (секунды)
+        "CONN_HEALTH_CHECKS": True,    # проверка постоянного соединения в начале запроса (mainapp/db.py)
+        "OPTIONS": {
+            "connect_timeout": 5,
+            # keepalive TCP - оборванное соединение (перезапуск сервера, сеть) обнаруживается, а не висит
+            "keepalives": 1,
+            "keepalives_idle": 60,
+            "keepalives_interval": 10,
+            "keepalives_count": 3,
+        },
+    },
+}
+
+DATABASES = {
+    "default": DATABASE_PROFILES[DATABASE_PROFILE],
+}
+
+# режим журнала SQLite хранится в самом файле бд - задается один раз командой sqlite_journal_mode (при развертывании),
+# а не при каждом соединении: иначе любая команда manage.py переписывала бы заголовок файла бд
+SQLITE_JOURNAL_MODE = "WAL"    # чтение не блокирует запись и наоборот
+
+# PRAGMA для каждого нового соединения SQLite (mainapp/db.py)
+SQLITE_PRAGMAS = {
+    "synchronous": "NORMAL",    # в режиме WAL безопасно: при сбое питания теряется только последняя транзакция
+    "busy_timeout": 10000,    # мс ожидания блокировки вместо мгновенной ошибки "database is locked"
+    "mmap_size": 64 * 1024 * 1024,    # чтение файла бд через отображение в память
+    "cache_size": -16000,    # кеш страниц ~16 МиБ на соединение
+}
 
+
+# Кеш (меню категорий, версии каталога, страницы каталога, гистограммы цен и другие версионированные данные).
+# Кеш общий для всех процессов: версии, которые меняют команды (import_catalog и др.), видны процессам сайта.
+# Файловый кеш - для одного сервера; при нескольких серверах - Memcached или Redis (у них к тому же атомарный incr)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.environ.get("SHOP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "shop_cache")),
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
 }
 
+TEST_RUNNER = "shop.test_runner.TestRunner"    # тесты - со своим пустым кешем, общий кеш сайта не затрагивается
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -145,3 +196,8 @@ MEDIA_ROOT = os.path.join(BASE_DIR, "media")    # подключение пап
 
 
 CRISPY_TEMPLATE_PACK = "bootstrap4"    # указать с каким фреймфорком работаем
+
+METRICS_DUPLICATE_QUERY_THRESHOLD = 5    # сколько одинаковых SQL запросов за ответ считать подозрением на N+1
+
+# async варианты главной, категории и товара (asgi.py включает их через переменную окружения)
+ASYNC_CATALOG_VIEWS = os.environ.get("SHOP_ASYNC_VIEWS") == "1"
@@ -1,8 +1,32 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-from .models import CategoryFeature, ProductFeatures, FeatureValidator
+from .forms import ProductFeaturesAdminForm
+from .models import CategoryFeature, ProductFeatures, FeatureValidator, FeatureValueCount
+from .validation import find_invalid_values
 
 
 admin.site.register(CategoryFeature)
-admin.site.register(ProductFeatures)
 admin.site.register(FeatureValidator)
+admin.site.register(FeatureValueCount)
+
+
+@admin.register(ProductFeatures)
+class ProductFeaturesAdmin(admin.ModelAdmin):
+    form = ProductFeaturesAdminForm
+    actions = ("check_values",)
+
+    def check_values(self, request, queryset):    # проверить выбранные значения одним запросом
+        rows = list(queryset.values_list("product__title", "feature_id", "feature__feature_name", "value", "feature__category_id"))
+        invalid = find_invalid_values(
+            ((title, feature_id, value) for title, feature_id, _, value, _ in rows),
+            {feature_id: category_id for _, feature_id, _, _, category_id in rows},
+        )
+        if not invalid:
+            self.message_user(request, f"Все значения допустимы ({len(rows)})")
+            return
+        names = {feature_id: name for _, feature_id, name, _, _ in rows}
+        for product, feature_id, value, allowed in invalid:
+            self.message_user(
+                request, f"{product}: {names[feature_id]} = {value!r}, допустимы: {', '.join(allowed)}", messages.WARNING
+            )
+    check_values.short_description = "Проверить значения по валидаторам"
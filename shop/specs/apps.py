@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class SpecsConfig(AppConfig):
     name = 'specs'
+
+    def ready(self):
+        from . import signals    # подключение обработчиков сигналов
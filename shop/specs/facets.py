@@ -0,0 +1,215 @@
+import re
+import threading
+
+from django.db import IntegrityError, models, transaction
+
+from mainapp.cache import get_cache_version, bump_cache_version
+
+from .models import CategoryFeature, ProductFeatures, FeatureValueCount
+
+
+FACET_PARAM_RE = re.compile(r"^f\d+$")    # GET параметр фильтра: f<id характеристики>
+
+
+def popcount(bits):    # количество установленных битов (количество товаров в наборе)
+    return bin(bits).count("1")
+
+
+class CategoryFacetIndex:
+    """
+    Обратный индекс характеристик одной категории:
+    (характеристика, значение) -> набор товаров в виде битовой маски (int),
+    где каждому товару категории соответствует свой бит.
+    Фильтрация - это побитовые операции над масками: ИЛИ внутри одной
+    характеристики, И между разными характеристиками
+    """
+
+    def __init__(self, category_id, features):
+        self.category_id = category_id
+        self.features = list(features)    # характеристики категории в порядке вывода
+        self.positions = {}    # id товара -> номер бита
+        self.product_ids = []    # номер бита -> id товара
+        self.bits = {feature.id: {} for feature in self.features}    # id характеристики -> {значение: маска}
+        self.rows = {}    # id строки ProductFeatures -> (id товара, id характеристики, значение)
+
+    @classmethod
+    def build(cls, category_id):    # два запроса: характеристики категории и все их значения
+        features = CategoryFeature.objects.filter(category_id=category_id).order_by("id")
+        index = cls(category_id, features)
+        rows = ProductFeatures.objects.filter(feature__category_id=category_id).values_list(
+            "id", "product_id", "feature_id", "value"
+        )
+        for row_id, product_id, feature_id, value in rows.iterator():
+            index.add_row(row_id, product_id, feature_id, value)
+        return index
+
+    def add_row(self, row_id, product_id, feature_id, value):
+        if feature_id not in self.bits:    # характеристика другой категории
+            return
+        if row_id in self.rows:    # значение строки изменилось - сначала убираем старое
+            self.remove_row(row_id)
+        position = self.positions.get(product_id)
+        if position is None:
+            position = self.positions[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+        values = self.bits[feature_id]
+        values[value] = values.get(value, 0) | (1 << position)
+        self.rows[row_id] = (product_id, feature_id, value)
+
+    def remove_row(self, row_id):
+        row = self.rows.pop(row_id, None)
+        if row is None:
+            return
+        product_id, feature_id, value = row
+        values = self.bits[feature_id]
+        bits = values.get(value, 0) & ~(1 << self.positions[product_id])
+        if bits:
+            values[value] = bits
+        else:
+            values.pop(value, None)
+
+    def parse_selection(self, query_dict):    # выбранные значения из GET параметров вида f<id характеристики>=значение
+        selected = {}
+        for feature in self.features:
+            values = set(query_dict.getlist(f"f{feature.id}")) & self.bits[feature.id].keys()
+            if values:
+                selected[feature.id] = values
+        return selected
+
+    def match(self, selected, exclude=None):    # маска товаров, подходящих под выбор (None - подходят все)
+        mask = None
+        for feature_id, values in selected.items():
+            if feature_id == exclude:
+                continue
+            feature_bits = 0
+            for value in values:    # ИЛИ внутри характеристики
+                feature_bits |= self.bits[feature_id].get(value, 0)
+            mask = feature_bits if mask is None else mask & feature_bits    # И между характеристиками
+        return mask
+
+    def filter(self, selected):    # id товаров, подходящих под выбор
+        mask = self.match(selected)
+        if mask is None:
+            return list(self.product_ids)
+        return [product_id for position, product_id in enumerate(self.product_ids) if mask >> position & 1]
+
+    def mask_of(self, product_ids):    # маска из id товаров (товары без характеристик в индексе не участвуют)
+        mask = 0
+        for product_id in product_ids:
+            position = self.positions.get(product_id)
+            if position is not None:
+                mask |= 1 << position
+        return mask
+
+    def facets(self, selected, within=None):
+        """
+        Характеристики со значениями и количеством товаров для каждого значения.
+        Количество считается с учетом выбора по остальным характеристикам -
+        то есть сколько товаров будет найдено, если дополнительно выбрать это значение.
+        within - маска товаров, которые вообще учитываются (например, в диапазоне цен)
+        """
+        result = []
+        for feature in self.features:
+            mask = self.match(selected, exclude=feature.id)
+            if within is not None:
+                mask = within if mask is None else mask & within
+            checked = selected.get(feature.id, set())
+            values = []
+            for value, bits in sorted(self.bits[feature.id].items()):
+                count = popcount(bits if mask is None else bits & mask)
+                values.append({"value": value, "count": count, "checked": value in checked})
+            if values:
+                result.append({"feature": feature, "param": f"f{feature.id}", "values": values})
+        return result
+
+
+_indexes = {}    # id категории -> (версия, индекс) - индексы, построенные в этом процессе
+_lock = threading.Lock()
+
+
+def facet_version_name(category_id):
+    return f"facets:{category_id}"
+
+
+def get_facet_index(category_id):
+    """
+    Индекс категории. Строится один раз и дальше обновляется сигналами;
+    версия в общем кеше показывает, не изменили ли характеристики в другом процессе
+    """
+    version = get_cache_version(facet_version_name(category_id))
+    with _lock:
+        cached = _indexes.get(category_id)
+        if cached and cached[0] == version:
+            return cached[1]
+    index = CategoryFacetIndex.build(category_id)
+    with _lock:
+        _indexes[category_id] = (version, index)
+    return index
+
+
+def apply_facet_change(category_id, change):
+    """
+    Применить изменение к уже построенному индексу (change - функция, принимающая индекс).
+    Если индекс этого процесса устарел, он просто будет перестроен при следующем обращении
+    """
+    name = facet_version_name(category_id)
+    with _lock:
+        cached = _indexes.pop(category_id, None)
+        old_version = get_cache_version(name)
+        new_version = bump_cache_version(name)
+        if cached and cached[0] == old_version and new_version == old_version + 1:
+            change(cached[1])
+            _indexes[category_id] = (new_version, cached[1])
+
+
+def filter_facets(category_id, query_dict, within_ids=None):
+    """
+    Фильтры из GET параметров по индексу категории: (id подходящих товаров или None, если ничего
+    не выбрано; характеристики с количествами). within_ids - id товаров, остальные в количествах не считаются.
+    Сигналы меняют словари индекса на месте (apply_facet_change), поэтому индекс читается под той же блокировкой
+    """
+    index = get_facet_index(category_id)
+    with _lock:
+        selected = index.parse_selection(query_dict)
+        within = None if within_ids is None else index.mask_of(within_ids)
+        return (index.filter(selected) if selected else None), index.facets(selected, within)
+
+
+def drop_facet_index(category_id):    # изменился состав характеристик - индекс перестраивается целиком
+    with _lock:
+        _indexes.pop(category_id, None)
+    bump_cache_version(facet_version_name(category_id))
+
+
+def has_facet_selection(query_dict):    # выбраны ли фильтры (без построения индекса)
+    return any(FACET_PARAM_RE.match(key) and any(values) for key, values in query_dict.lists())
+
+
+def get_facet_counts(category_id):
+    """
+    Значения характеристик категории с количеством товаров из материализованной
+    таблицы FeatureValueCount - один запрос по индексу (category, feature, value).
+    Используется, пока фильтры не выбраны; структура та же, что у CategoryFacetIndex.facets
+    """
+    rows = FeatureValueCount.objects.filter(category_id=category_id, product_count__gt=0).select_related(
+        "feature"
+    ).order_by("feature_id", "value")
+    result = []
+    for row in rows:
+        if not result or result[-1]["feature"].id != row.feature_id:
+            result.append({"feature": row.feature, "param": f"f{row.feature_id}", "values": []})
+        result[-1]["values"].append({"value": row.value, "count": row.product_count, "checked": False})
+    return result
+
+
+def change_feature_value_count(category_id, feature_id, value, delta):    # атомарно изменить количество товаров для значения
+    counts = FeatureValueCount.objects.filter(category_id=category_id, feature_id=feature_id, value=value)
+    if counts.update(product_count=models.F("product_count") + delta) or delta < 0:
+        return
+    try:
+        with transaction.atomic():    # строки еще нет
+            FeatureValueCount.objects.create(
+                category_id=category_id, feature_id=feature_id, value=value, product_count=delta
+            )
+    except IntegrityError:    # строку успел создать параллельный запрос
+        counts.update(product_count=models.F("product_count") + delta)
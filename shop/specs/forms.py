@@ -1,7 +1,8 @@
 from django import forms
 
 from mainapp.models import Category
-from .models import CategoryFeature
+from .models import CategoryFeature, ProductFeatures
+from .validation import get_validator_index
 
 
 class NewCategoryForm(forms.ModelForm):
@@ -15,4 +16,20 @@ class NewCategoryFeatureKeyForm(forms.ModelForm):
 
     class Meta:
         model = CategoryFeature
-        fields = "__all__"
\ No newline at end of file
+        fields = "__all__"
+
+
+class ProductFeaturesAdminForm(forms.ModelForm):    # значение проверяется по FeatureValidator (индекс в памяти, без запроса на значение)
+
+    class Meta:
+        model = ProductFeatures
+        fields = "__all__"
+
+    def clean(self):
+        cleaned_data = super().clean()
+        feature, value = cleaned_data.get("feature"), cleaned_data.get("value")
+        if feature is not None and value is not None:
+            index = get_validator_index(feature.category_id)
+            if not index.is_valid(feature.id, value):
+                self.add_error("value", f"Допустимые значения: {', '.join(sorted(index.allowed_values(feature.id)))}")
+        return cleaned_data
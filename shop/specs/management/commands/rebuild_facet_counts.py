@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from specs.models import CategoryFeature, FeatureValueCount, ProductFeatures
+
+
+class Command(BaseCommand):
+    help = "Полностью пересчитывает таблицу FeatureValueCount (количество товаров для значений характеристик)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Размер пачки при записи счетчиков")
+        parser.add_argument("--category", help="Слаг категории (по умолчанию - все категории)")
+
+    def handle(self, *args, **options):
+        features = CategoryFeature.objects.order_by("id")
+        if options["category"]:
+            features = features.filter(category__slug=options["category"])
+        total = 0
+        # каждая характеристика пересчитывается в своей короткой транзакции - блокировки не держатся на весь пересчет
+        for feature in features.only("id", "category_id").iterator():
+            counts = ProductFeatures.objects.filter(feature=feature).order_by().values("value").annotate(
+                product_count=models.Count("id")
+            )
+            rows = [
+                FeatureValueCount(
+                    category_id=feature.category_id, feature_id=feature.id,
+                    value=row["value"], product_count=row["product_count"]
+                )
+                for row in counts
+            ]
+            with transaction.atomic():
+                FeatureValueCount.objects.filter(feature=feature).delete()
+                FeatureValueCount.objects.bulk_create(rows, batch_size=options["chunk_size"])
+            total += len(rows)
+        self.stdout.write(self.style.SUCCESS(f"Пересчитано значений характеристик: {total}"))
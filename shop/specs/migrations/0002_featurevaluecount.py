@@ -0,0 +1,28 @@
+# Generated by Django 3.1.4 on 2026-10-18 14:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0004_cartproduct_anonymous_user'),
+        ('specs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureValueCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(max_length=255, verbose_name='Значение')),
+                ('product_count', models.PositiveIntegerField(default=0, verbose_name='Количество товаров')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.category', verbose_name='Категория')),
+                ('feature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='specs.categoryfeature', verbose_name='Характеристика')),
+            ],
+            options={
+                'unique_together': {('category', 'feature', 'value')},
+            },
+        ),
+    ]
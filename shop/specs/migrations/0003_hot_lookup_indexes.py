@@ -0,0 +1,54 @@
+# Generated by Django 3.1.4 on 2026-10-18 14:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remove_duplicate_values(apps, schema_editor):    # перед уникальностью (product, feature): остается последнее значение
+    ProductFeatures = apps.get_model("specs", "ProductFeatures")
+    CategoryFeature = apps.get_model("specs", "CategoryFeature")
+    FeatureValueCount = apps.get_model("specs", "FeatureValueCount")
+    duplicates = ProductFeatures.objects.order_by().values("product_id", "feature_id").annotate(
+        rows=models.Count("id"), keep=models.Max("id")
+    ).filter(rows__gt=1)
+    features = set()
+    for row in duplicates:
+        ProductFeatures.objects.filter(
+            product_id=row["product_id"], feature_id=row["feature_id"]
+        ).exclude(id=row["keep"]).delete()
+        features.add(row["feature_id"])
+    for feature in CategoryFeature.objects.filter(id__in=features):    # счетчики значений - как в rebuild_facet_counts
+        FeatureValueCount.objects.filter(feature=feature).delete()
+        FeatureValueCount.objects.bulk_create([
+            FeatureValueCount(category_id=feature.category_id, feature=feature, value=row["value"], product_count=row["count"])
+            for row in ProductFeatures.objects.filter(feature=feature).order_by().values("value").annotate(count=models.Count("id"))
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specs', '0002_featurevaluecount'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='productfeatures',
+            index=models.Index(fields=['feature', 'value'], name='productfeatures_value_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_values, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='productfeatures',
+            constraint=models.UniqueConstraint(fields=('product', 'feature'), name='productfeatures_product_feature_uniq'),
+        ),
+        migrations.AlterField(
+            model_name='productfeatures',
+            name='feature',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='specs.categoryfeature', verbose_name='Характеристика'),
+        ),
+        migrations.AlterField(
+            model_name='productfeatures',
+            name='product',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mainapp.product', verbose_name='Товар'),
+        ),
+    ]
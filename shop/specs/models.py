@@ -41,13 +41,45 @@ class ProductFeatures(models.Model):
     """
     Характеристики товара
     """
-    product = models.ForeignKey("mainapp.Product", verbose_name="Товар", on_delete=models.CASCADE)
-    feature = models.ForeignKey(CategoryFeature, verbose_name="Характеристика", on_delete=models.CASCADE)
+    # отдельные индексы внешних ключей не нужны - их покрывают составные индексы из Meta
+    product = models.ForeignKey("mainapp.Product", verbose_name="Товар", on_delete=models.CASCADE, db_index=False)
+    feature = models.ForeignKey(CategoryFeature, verbose_name="Характеристика", on_delete=models.CASCADE, db_index=False)
     value = models.CharField(max_length=255, verbose_name="Значение")
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["feature", "value"], name="productfeatures_value_idx"),    # товары со значением характеристики
+        ]
+        constraints = [    # одно значение характеристики у товара
+            models.UniqueConstraint(fields=["product", "feature"], name="productfeatures_product_feature_uniq"),
+        ]
+
     def __str__(self):
         return f"Товар - {self.product.title} | " \
                f"Характеристика - {self.feature.feature_name} | " \
                f"Значение - {self.value}"
 
 
+class FeatureValueCount(models.Model):
+    """
+    Количество товаров с конкретным значением характеристики.
+    Материализованная таблица для фильтров категории: обновляется сигналами
+    при изменении характеристик товаров, полностью пересчитывается
+    командой rebuild_facet_counts
+    """
+    category = models.ForeignKey("mainapp.Category", verbose_name="Категория", on_delete=models.CASCADE)
+    feature = models.ForeignKey(CategoryFeature, verbose_name="Характеристика", on_delete=models.CASCADE)
+    value = models.CharField(max_length=255, verbose_name="Значение")
+    product_count = models.PositiveIntegerField(default=0, verbose_name="Количество товаров")
+
+    class Meta:
+        unique_together = (    # уникальность и индекс для чтения всех значений категории одним запросом
+            "category",
+            "feature",
+            "value"
+        )
+
+    def __str__(self):
+        return f"Категория - {self.category.name} | " \
+               f"Характеристика - {self.feature.feature_name} | " \
+               f"Значение - {self.value} | Товаров - {self.product_count}"
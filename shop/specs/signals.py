@@ -0,0 +1,65 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from mainapp.cache import bump_catalog_version
+from mainapp.search import reindex_product
+
+from .facets import apply_facet_change, drop_facet_index, change_feature_value_count
+from .tables import invalidate_product_spec_table, invalidate_category_spec_tables
+from .validation import drop_validator_index
+from .models import CategoryFeature, FeatureValidator, ProductFeatures
+
+
+@receiver(pre_save, sender=ProductFeatures)
+def remember_old_value(sender, instance, **kwargs):    # старое значение нужно, чтобы уменьшить его счетчик
+    instance._old_feature_value = None
+    if instance.pk:
+        instance._old_feature_value = ProductFeatures.objects.filter(pk=instance.pk).values_list(
+            "feature__category_id", "feature_id", "value"
+        ).first()
+
+
+@receiver(post_save, sender=ProductFeatures)
+def update_facets_on_save(sender, instance, **kwargs):    # значение характеристики товара добавлено или изменено
+    category_id = instance.feature.category_id
+    new_value = (category_id, instance.feature_id, instance.value)
+    old_value = getattr(instance, "_old_feature_value", None)
+    if old_value != new_value:
+        if old_value:
+            change_feature_value_count(*old_value, -1)
+        change_feature_value_count(*new_value, 1)
+    # индекс в памяти - только после фиксации: при откате транзакции он остался бы измененным
+    row = (instance.id, instance.product_id, instance.feature_id, instance.value)
+    transaction.on_commit(partial(apply_facet_change, category_id, lambda index: index.add_row(*row)))
+    transaction.on_commit(partial(reindex_product, instance.product_id))    # значения характеристик участвуют в поиске
+    invalidate_product_spec_table(instance.product_id)
+
+
+@receiver(post_delete, sender=ProductFeatures)
+def update_facets_on_delete(sender, instance, **kwargs):
+    category_id = instance.feature.category_id
+    change_feature_value_count(category_id, instance.feature_id, instance.value, -1)
+    row_id = instance.id
+    transaction.on_commit(partial(apply_facet_change, category_id, lambda index: index.remove_row(row_id)))
+    transaction.on_commit(partial(reindex_product, instance.product_id))
+    invalidate_product_spec_table(instance.product_id)
+
+
+@receiver([post_save, post_delete], sender=CategoryFeature)
+def rebuild_facets(sender, instance, **kwargs):    # изменился набор характеристик категории
+    transaction.on_commit(partial(drop_facet_index, instance.category_id))
+    invalidate_category_spec_tables(instance.category_id)
+
+
+@receiver([post_save, post_delete], sender=ProductFeatures)
+@receiver([post_save, post_delete], sender=CategoryFeature)
+def invalidate_catalog_pages(sender, **kwargs):    # характеристики выводятся на страницах каталога
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver([post_save, post_delete], sender=FeatureValidator)
+def rebuild_validators(sender, instance, **kwargs):    # допустимые значения категории изменились
+    drop_validator_index(instance.category_id)
@@ -0,0 +1,43 @@
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+from mainapp.cache import get_cache_version, bump_cache_version
+
+from .models import ProductFeatures
+
+
+SPEC_TABLE_CACHE = "spec_table"
+SPEC_TABLE_TIMEOUT = 24 * 60 * 60    # устаревшие версии не читаются - время жизни только ограничивает память
+
+
+def spec_table_key(product):
+    # две версии: значения характеристик товара и характеристики категории (название, единица измерения)
+    return ":".join(map(str, (
+        SPEC_TABLE_CACHE, product.id,
+        get_cache_version(f"{SPEC_TABLE_CACHE}:product:{product.id}"),
+        get_cache_version(f"{SPEC_TABLE_CACHE}:category:{product.category_id}"),
+    )))
+
+
+def render_spec_table(product):
+    """
+    Таблица характеристик товара (html) из specs.ProductFeatures и specs.CategoryFeature -
+    один запрос при первом выводе, дальше из кеша до изменения характеристик товара или категории
+    """
+    key = spec_table_key(product)
+    html = cache.get(key)
+    if html is None:
+        rows = ProductFeatures.objects.filter(product_id=product.id).order_by("feature_id").values_list(
+            "feature__feature_name", "value", "feature__unit"
+        )
+        html = render_to_string("mainapp/include/specification.html", {"rows": list(rows)}) if rows else ""
+        cache.set(key, html, SPEC_TABLE_TIMEOUT)
+    return html
+
+
+def invalidate_product_spec_table(product_id):
+    bump_cache_version(f"{SPEC_TABLE_CACHE}:product:{product_id}")
+
+
+def invalidate_category_spec_tables(category_id):    # изменились сами характеристики - таблицы всех товаров категории
+    bump_cache_version(f"{SPEC_TABLE_CACHE}:category:{category_id}")
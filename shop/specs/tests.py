@@ -1,2 +1,199 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from io import StringIO
+from decimal import Decimal
 
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
+
+from mainapp.models import Category, Product
+from mainapp.testing import capture_on_commit_callbacks
+from .facets import get_facet_index
+from .forms import ProductFeaturesAdminForm
+from .tables import render_spec_table
+from .validation import find_invalid_values, get_validator_index
+from .models import CategoryFeature, ProductFeatures, FeatureValueCount, FeatureValidator
+
+
+TEMP_MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class SpecsTestCase(TestCase):    # каталог ноутбуков с характеристиками "Память" и "Экран"
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name="Ноутбуки", slug="notebooks")
+        self.ram = CategoryFeature.objects.create(category=self.category, feature_name="Память", feature_filter_name="Память", unit="Гб")
+        self.screen = CategoryFeature.objects.create(category=self.category, feature_name="Экран", feature_filter_name="Экран")
+        image = SimpleUploadedFile("notebook_img.jpg", content=b"", content_type="imega/jpg")
+        self.products = {}
+        for slug, ram, screen in (("a", "8", "IPS"), ("b", "8", "TN"), ("c", "16", "IPS"), ("d", "32", "OLED")):
+            product = Product.objects.create(
+                category=self.category, title=slug, slug=slug, image=image, price=Decimal("10.00")
+            )
+            ProductFeatures.objects.create(product=product, feature=self.ram, value=ram)
+            ProductFeatures.objects.create(product=product, feature=self.screen, value=screen)
+            self.products[slug] = product
+
+
+class FacetIndexTestCases(SpecsTestCase):
+    def get_counts(self, selected):
+        return {
+            (facet["feature"].id, item["value"]): item["count"]
+            for facet in get_facet_index(self.category.id).facets(selected) for item in facet["values"]
+        }
+
+    def test_or_within_and_across_features(self):
+        index = get_facet_index(self.category.id)
+        p = self.products
+        self.assertEqual(set(index.filter({self.ram.id: {"8", "16"}})), {p["a"].id, p["b"].id, p["c"].id})
+        self.assertEqual(set(index.filter({self.ram.id: {"8", "16"}, self.screen.id: {"IPS"}})), {p["a"].id, p["c"].id})
+
+    def test_counts_respect_other_features(self):    # количество для значения учитывает выбор по другим характеристикам
+        counts = self.get_counts({self.screen.id: {"IPS"}})
+        self.assertEqual(counts[(self.ram.id, "8")], 1)
+        self.assertEqual(counts[(self.ram.id, "32")], 0)
+        self.assertEqual(counts[(self.screen.id, "TN")], 1)    # выбор внутри своей характеристики не сужает ее значения
+
+    def test_index_updated_incrementally(self):
+        index = get_facet_index(self.category.id)
+        row = ProductFeatures.objects.get(product=self.products["d"], feature=self.ram)
+        row.value = "8"
+        with capture_on_commit_callbacks():    # индекс меняется после фиксации транзакции
+            row.save()
+        self.assertIs(get_facet_index(self.category.id), index)    # индекс не перестраивался
+        self.assertEqual(self.get_counts({})[(self.ram.id, "8")], 3)
+        self.assertNotIn((self.ram.id, "32"), self.get_counts({}))
+        with capture_on_commit_callbacks():
+            row.delete()
+        self.assertEqual(self.get_counts({})[(self.ram.id, "8")], 2)
+
+    def test_rolled_back_change_not_applied(self):    # откат транзакции не оставляет изменений в индексе
+        get_facet_index(self.category.id)
+        row = ProductFeatures.objects.get(product=self.products["d"], feature=self.ram)
+        row.value = "8"
+        with capture_on_commit_callbacks(), self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                row.save()
+                raise RuntimeError
+        self.assertEqual(self.get_counts({})[(self.ram.id, "8")], 2)
+        self.assertEqual(self.get_counts({})[(self.ram.id, "32")], 1)
+
+    def test_category_page_filters_products(self):
+        response = self.client.get("/category/notebooks/", {f"f{self.ram.id}": ["8", "32"], f"f{self.screen.id}": "IPS"})
+        self.assertEqual([product.slug for product in response.context["category_products"]], ["a"])
+        self.assertContains(response, 'name="f%s" value="TN"' % self.screen.id)
+
+    def test_counts_respect_price_range(self):    # товары вне диапазона цен не попадают в количества
+        Product.objects.filter(slug__in=("c", "d")).update(price=Decimal("50.00"))
+
+        def counts(query):
+            response = self.client.get("/category/notebooks/", query)
+            return {(facet["feature"].id, item["value"]): item["count"] for facet in response.context["facets"] for item in facet["values"]}
+
+        self.assertEqual(counts({"price_max": "20"}), {
+            (self.ram.id, "8"): 2, (self.ram.id, "16"): 0, (self.ram.id, "32"): 0,
+            (self.screen.id, "IPS"): 1, (self.screen.id, "OLED"): 0, (self.screen.id, "TN"): 1,
+        })
+        selected = counts({"price_min": "20", f"f{self.screen.id}": "IPS"})
+        self.assertEqual((selected[(self.ram.id, "8")], selected[(self.ram.id, "16")]), (0, 1))
+
+
+class FeatureValueCountTestCases(SpecsTestCase):
+    def get_counts(self):
+        return dict(FeatureValueCount.objects.filter(product_count__gt=0).values_list("value", "product_count"))
+
+    def test_counts_maintained_by_signals(self):
+        self.assertEqual(self.get_counts(), {"8": 2, "16": 1, "32": 1, "IPS": 2, "TN": 1, "OLED": 1})
+        row = ProductFeatures.objects.get(product=self.products["d"], feature=self.ram)
+        row.value = "16"
+        row.save()
+        self.assertEqual(self.get_counts()["16"], 2)
+        self.assertNotIn("32", self.get_counts())
+        self.products["a"].delete()    # вместе с товаром удаляются его характеристики
+        self.assertEqual(self.get_counts()["8"], 1)
+        self.assertEqual(self.get_counts()["IPS"], 1)
+
+    def test_rebuild_command(self):
+        expected = self.get_counts()
+        FeatureValueCount.objects.all().delete()
+        call_command("rebuild_facet_counts", "--chunk-size", "2", stdout=StringIO())
+        self.assertEqual(self.get_counts(), expected)
+
+    def test_category_page_reads_counts_in_one_query(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/category/notebooks/")
+        queries = [q["sql"] for q in context.captured_queries if "specs_" in q["sql"]]
+        self.assertEqual(len(queries), 1)
+        self.assertIn("specs_featurevaluecount", queries[0])
+        self.assertContains(response, "OLED <span class=\"text-muted\">(1)</span>")
+
+
+class SpecTableTestCases(SpecsTestCase):
+    def test_rendered_once_and_cached(self):
+        product = self.products["a"]
+        with CaptureQueriesContext(connection) as context:
+            html = render_spec_table(product)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertIn("8 Гб", html)
+        self.assertIn("IPS", html)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(render_spec_table(product), html)
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_invalidated_by_feature_changes(self):
+        product = self.products["a"]
+        render_spec_table(product)
+        row = ProductFeatures.objects.get(product=product, feature=self.ram)
+        row.value = "64"
+        row.save()
+        self.assertIn("64 Гб", render_spec_table(product))
+        self.ram.unit = "GB"
+        self.ram.save()
+        self.assertIn("64 GB", render_spec_table(product))
+        self.assertIn("16 GB", render_spec_table(self.products["c"]))    # характеристика категории - у всех товаров
+
+    def test_product_page(self):
+        response = self.client.get("/products/d/")
+        self.assertContains(response, "<td>32 Гб</td>", html=True)
+        self.assertContains(response, "OLED")
+
+
+class FeatureValidatorIndexTestCases(SpecsTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        for value in ("8", "16", "32"):
+            FeatureValidator.objects.create(category=self.category, feature_key=self.ram, valid_feature_value=value)
+
+    def test_bulk_validation_without_per_value_queries(self):
+        rows = [(i, self.ram.id, ("8", "64")[i % 2]) for i in range(1000)] + [("any", self.screen.id, "что угодно")]
+        find_invalid_values(rows[:1])    # индекс построен
+        with CaptureQueriesContext(connection) as context:
+            invalid = find_invalid_values(rows)
+        self.assertEqual(len(context.captured_queries), 1)    # только категории характеристик
+        self.assertEqual(len(invalid), 500)
+        self.assertEqual(invalid[0], (1, self.ram.id, "64", ["16", "32", "8"]))
+
+    def test_index_follows_validator_changes(self):
+        self.assertFalse(get_validator_index(self.category.id).is_valid(self.ram.id, "64"))
+        FeatureValidator.objects.create(category=self.category, feature_key=self.ram, valid_feature_value="64")
+        self.assertTrue(get_validator_index(self.category.id).is_valid(self.ram.id, "64"))
+        FeatureValidator.objects.filter(feature_key=self.ram).delete()    # QuerySet.delete отправляет post_delete
+        self.assertTrue(get_validator_index(self.category.id).is_valid(self.ram.id, "1"))
+
+    def test_admin_form(self):
+        row = ProductFeatures.objects.get(product=self.products["a"], feature=self.ram)
+        data = {"product": row.product_id, "feature": row.feature_id, "value": "64"}
+        form = ProductFeaturesAdminForm(data, instance=row)
+        self.assertFalse(form.is_valid())
+        self.assertIn("16, 32, 8", form.errors["value"][0])
+        self.assertTrue(ProductFeaturesAdminForm(dict(data, value="16"), instance=row).is_valid())
+        self.assertFalse(ProductFeaturesAdminForm(dict(data, value="16")).is_valid())    # второе значение той же характеристики
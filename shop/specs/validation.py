@@ -0,0 +1,92 @@
+import threading
+from collections import namedtuple
+
+from mainapp.cache import get_cache_version, bump_cache_version
+
+from .models import CategoryFeature, FeatureValidator
+
+
+InvalidFeatureValue = namedtuple("InvalidFeatureValue", "product feature value allowed")    # значение, не прошедшее проверку
+
+
+class CategoryValidatorIndex:
+    """
+    Допустимые значения характеристик одной категории (из FeatureValidator):
+    id характеристики -> множество значений. Проверка значения - поиск в множестве.
+    Характеристика без валидаторов принимает любое значение
+    """
+
+    def __init__(self, category_id, allowed):
+        self.category_id = category_id
+        self.allowed = allowed
+
+    @classmethod
+    def build(cls, category_id):    # один запрос на категорию
+        allowed = {}
+        for feature_id, value in FeatureValidator.objects.filter(category_id=category_id).values_list(
+            "feature_key_id", "valid_feature_value"
+        ):
+            allowed.setdefault(feature_id, set()).add(value)
+        return cls(category_id, {feature_id: frozenset(values) for feature_id, values in allowed.items()})
+
+    def is_valid(self, feature_id, value):
+        allowed = self.allowed.get(feature_id)
+        return allowed is None or str(value) in allowed
+
+    def allowed_values(self, feature_id):    # None - ограничений нет
+        return self.allowed.get(feature_id)
+
+
+_indexes = {}    # id категории -> (версия, индекс) - индексы, построенные в этом процессе
+_lock = threading.Lock()
+
+
+def validator_version_name(category_id):
+    return f"feature_validators:{category_id}"
+
+
+def get_validator_index(category_id):
+    """
+    Индекс допустимых значений категории. Валидаторы меняются редко, поэтому
+    при любом их изменении индекс просто перестраивается (версия в общем кеше)
+    """
+    version = get_cache_version(validator_version_name(category_id))
+    with _lock:
+        cached = _indexes.get(category_id)
+        if cached and cached[0] == version:
+            return cached[1]
+    index = CategoryValidatorIndex.build(category_id)
+    with _lock:
+        _indexes[category_id] = (version, index)
+    return index
+
+
+def drop_validator_index(category_id):
+    with _lock:
+        _indexes.pop(category_id, None)
+    bump_cache_version(validator_version_name(category_id))
+
+
+def find_invalid_values(rows, feature_categories=None):
+    """
+    Проверить пачку значений (товар, id характеристики, значение) - товар может быть чем угодно,
+    он только возвращается в отчете. Категории характеристик читаются одним запросом
+    (или передаются готовым словарем feature_categories: id характеристики -> id категории),
+    дальше каждое значение проверяется без обращения к бд.
+    Возвращает список InvalidFeatureValue для всех неверных значений сразу
+    """
+    rows = list(rows)
+    if feature_categories is None:
+        feature_categories = dict(CategoryFeature.objects.filter(
+            id__in={feature_id for _, feature_id, _ in rows}
+        ).values_list("id", "category_id"))
+    indexes = {}
+    invalid = []
+    for product, feature_id, value in rows:
+        category_id = feature_categories[feature_id]
+        if category_id not in indexes:
+            indexes[category_id] = get_validator_index(category_id)
+        index = indexes[category_id]
+        if not index.is_valid(feature_id, value):
+            invalid.append(InvalidFeatureValue(product, feature_id, value, sorted(index.allowed_values(feature_id))))
+    return invalid
@@ -0,0 +1,92 @@
+// страница корзины без перезагрузки: все измененные количества (и удаление товара) уходят
+// одним POST запросом в JSON API корзины, ответ - новые суммы строк и итоги корзины
+(function () {
+  var table = document.querySelector("[data-cart-api]");
+  if (!table) {
+    return;
+  }
+  var csrfToken = table.querySelector("[name=csrfmiddlewaretoken]").value;
+
+  function formatPrice(value) {    // API отдает "1234.50", Django для ru выводит "1234,50"
+    return String(value).replace(".", ",") + " грн.";
+  }
+
+  function rows() {
+    return Array.prototype.slice.call(table.querySelectorAll("[data-slug]"));
+  }
+
+  function changedItems() {    // строки, в которых количество отличается от сохраненного
+    return rows().filter(function (row) {
+      var input = row.querySelector("[name=qty]");
+      return input.value !== input.dataset.qty;
+    }).map(function (row) {
+      return {slug: row.dataset.slug, qty: parseInt(row.querySelector("[name=qty]").value, 10)};
+    });
+  }
+
+  function render(state) {
+    var lines = {};
+    state.lines.forEach(function (line) {
+      lines[line.slug] = line;
+    });
+    rows().forEach(function (row) {
+      var line = lines[row.dataset.slug];
+      if (!line) {
+        row.parentNode.removeChild(row);
+        return;
+      }
+      var input = row.querySelector("[name=qty]");
+      input.value = input.dataset.qty = line.qty;
+      row.querySelector("[data-line-total]").textContent = formatPrice(line.final_price);
+    });
+    table.querySelector("[data-cart-total-product]").textContent = state.summary.total_product;
+    table.querySelector("[data-cart-final-price]").textContent = formatPrice(state.summary.final_price);
+    document.querySelectorAll("[data-cart-badge]").forEach(function (badge) {
+      badge.textContent = state.summary.total_product;
+    });
+    if (!state.lines.length) {    // корзина опустела - страница с сообщением "Ваша корзина пуста"
+      window.location.reload();
+    }
+  }
+
+  function send(items) {
+    return fetch(table.dataset.cartApi, {
+      method: "POST",
+      credentials: "same-origin",
+      headers: {"Content-Type": "application/json", "X-CSRFToken": csrfToken},
+      body: JSON.stringify({items: items})
+    }).then(function (response) {
+      return response.json().then(function (data) {
+        if (!response.ok) {
+          throw data;
+        }
+        return data;
+      });
+    }).then(render).catch(function (error) {
+      var errors = error.errors ? Object.keys(error.errors).map(function (slug) {
+        return slug + ": " + error.errors[slug];
+      }) : [error.error || "Не удалось изменить корзину"];
+      window.alert(errors.join("\n"));
+    });
+  }
+
+  table.addEventListener("submit", function (event) {    // кнопка "Изменить количество" сохраняет все изменения сразу
+    event.preventDefault();
+    var items = changedItems();
+    if (items.length) {
+      send(items);
+    }
+  });
+
+  table.addEventListener("click", function (event) {
+    var link = event.target.closest("[data-remove]");
+    if (!link) {
+      return;
+    }
+    event.preventDefault();
+    var slug = link.closest("[data-slug]").dataset.slug;
+    send(changedItems().filter(function (item) {
+      return item.slug !== slug;
+    }).concat([{slug: slug, qty: 0}]));
+  });
+})();